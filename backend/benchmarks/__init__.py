@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for the generation pipeline. See benchmarks/run.py.
+"""
@@ -0,0 +1,53 @@
+import os
+import random
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+# Synthetic source documents by page count, from a short booklet to a full book
+CORPUS_SIZES = {"small": 5, "medium": 50, "large": 300}
+
+WORDS = (
+    "the prophet taught his companions to be honest kind and patient with neighbours "
+    "charity prayer fasting mercy family orphans travellers water bread garden market "
+    "morning evening story lesson children mosque city desert caravan promise truth "
+    "gratitude forgiveness knowledge teacher student book light journey friend help"
+).split()
+
+TOPICS = ("Charity", "Prayer", "Honesty", "Patience", "Kindness to animals", "Respect for parents")
+
+def _paragraph(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+def write_document(path: str, pages: int, seed: int = 0):
+    """
+    Write a deterministic text PDF: one chapter heading per page, named after a
+    rotating topic so section descriptions have something to match, followed
+    by body lines.
+    """
+    rng = random.Random(seed)
+    c = canvas.Canvas(path, pagesize=A4)
+    width, height = A4
+    for number in range(pages):
+        c.setFont("Helvetica-Bold", 16)
+        c.drawString(60, height - 70, f"Chapter {number + 1}: {TOPICS[number % len(TOPICS)]}")
+        c.setFont("Helvetica", 11)
+        y = height - 110
+        while y > 70:
+            c.drawString(60, y, _paragraph(rng, 14))
+            y -= 16
+        c.showPage()
+    c.save()
+
+def build_corpus(directory: str, sizes: dict = None) -> dict:
+    """
+    Create the corpus in directory (reusing files already there) and return {name: path}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    corpus = {}
+    for name, pages in (sizes or CORPUS_SIZES).items():
+        path = os.path.join(directory, f"{name}_{pages}p.pdf")
+        if not os.path.exists(path):
+            write_document(path, pages, seed=pages)
+        corpus[name] = path
+    return corpus
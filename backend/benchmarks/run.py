@@ -0,0 +1,322 @@
+"""
+Offline benchmarks for the generation pipeline.
+
+Run from backend/:
+    python -m benchmarks.run --mode stub                     # stub models, CI speed
+    python -m benchmarks.run --mode real --iterations 1      # local models, minutes
+    python -m benchmarks.run --baseline old.json --threshold 0.2
+
+Each service is measured on its own (ingestion cold and warm per corpus size,
+the story parser, story generation, image generation, PDF assembly), then
+the whole process_book_generation pipeline, then each image profile with
+its per-image latency and the resolution, sharpness and size of its PDF pages. Everything runs in a scratch
+directory, so caches and generated files never touch the real ones.
+
+The JSON report holds latency percentiles, throughput and memory per
+benchmark. With --baseline, any benchmark whose p50 or p90 latency got more
+than --threshold slower fails the run with exit code 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Latency differences below this are noise, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.005
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def summarize(latencies: list) -> dict:
+    return {
+        "p50": round(percentile(latencies, 0.5), 4),
+        "p90": round(percentile(latencies, 0.9), 4),
+        "p99": round(percentile(latencies, 0.99), 4),
+        "mean": round(sum(latencies) / len(latencies), 4),
+        "min": round(min(latencies), 4),
+        "max": round(max(latencies), 4)
+    }
+
+async def measure(name: str, iterations: int, run, setup=None) -> dict:
+    """
+    Await run() iterations times. run() returns the work it did, e.g. {"pages": 10},
+    which becomes throughput per second of measured time. setup() runs untimed first.
+    """
+    from services.metrics import rss_bytes, peak_rss_bytes
+
+    latencies = []
+    work = {}
+    rss_before = rss_bytes()
+    for _ in range(iterations):
+        if setup is not None:
+            await setup()
+        started = time.perf_counter()
+        done = await run() or {}
+        latencies.append(time.perf_counter() - started)
+        for unit, amount in done.items():
+            work[unit] = work.get(unit, 0) + amount
+    total = sum(latencies)
+    result = {
+        "iterations": iterations,
+        "latency_seconds": summarize(latencies),
+        "throughput": {f"{unit}_per_second": round(amount / total, 3) if total > 0 else None for unit, amount in work.items()},
+        "memory": {"rss_growth_bytes": rss_bytes() - rss_before, "peak_rss_bytes": peak_rss_bytes()}
+    }
+    print(f"{name:<24} p50 {result['latency_seconds']['p50']:>8.3f}s  p90 {result['latency_seconds']['p90']:>8.3f}s  {result['throughput']}")
+    return result
+
+async def run_benchmarks(args, corpus: dict) -> dict:
+    # Imported here, after the working directory has been switched to the scratch dir
+    import main
+    from services.ingestion import DocumentIngestionService
+    from services.page_cache import PageTextCache
+    from services.story_parser import StoryStreamParser
+    from benchmarks.stubs import stub_story
+
+    if args.mode == "stub":
+        from benchmarks.stubs import StubContentEngine, StubImageEngine
+        main.content_engine = StubContentEngine(seconds_per_token=args.stub_token_seconds)
+        main.image_engine = StubImageEngine(seconds_per_image=args.stub_image_seconds, cache=main.image_cache)
+    content_engine = main.content_engine
+    image_engine = main.image_engine
+    specs = {"theme": "Charity", "humor": 5, "ageGroup": "6-8"}
+    segmentation = {"sectionDescription": "charity", "additionalContext": ""}
+    results = {}
+    heavy = 1 if args.mode == "real" else args.iterations
+
+    # Ingestion, cold (empty caches) and warm (cached page text and index)
+    for size, path in corpus.items():
+        cold = {}
+
+        async def fresh_service():
+            shutil.rmtree("cache/bench_pages", ignore_errors=True)
+            cold["service"] = DocumentIngestionService(PageTextCache("cache/bench_pages"))
+
+        async def ingest_cold():
+            await cold["service"].ingest_pdf(path, section_description="charity")
+            return {"documents": 1}
+
+        results[f"ingest_cold[{size}]"] = await measure(f"ingest_cold[{size}]", args.iterations, ingest_cold, setup=fresh_service)
+
+        warm = DocumentIngestionService(PageTextCache("cache/bench_pages_warm"))
+        await warm.ingest_pdf(path, section_description="charity")
+
+        async def ingest_warm():
+            await warm.ingest_pdf(path, section_description="charity")
+            return {"documents": 1}
+
+        results[f"ingest_warm[{size}]"] = await measure(f"ingest_warm[{size}]", args.iterations, ingest_warm)
+
+    source_text = await main.ingestion_service.ingest_pdf(corpus["medium"], section_description="charity")
+
+    # Streaming story parser on its own, fed in small chunks like the decoder does
+    story_text = stub_story("Charity")
+
+    async def parse():
+        for _ in range(100):
+            parser = StoryStreamParser("Charity")
+            for i in range(0, len(story_text), 8):
+                parser.feed(story_text[i:i + 8])
+            parser.finish()
+        return {"stories": 100}
+
+    results["story_parser"] = await measure("story_parser", args.iterations, parse)
+
+    # Story generation (prefill + decode + parsing)
+    await content_engine.lifecycle.ensure_loaded()
+
+    async def story():
+        data = await content_engine.generate_story(source_text, specs)
+        stats = data.get("stats") or {}
+        return {"pages": len(data.get("pages", [])), "tokens": stats.get("generated_tokens", 0)}
+
+    results["story"] = await measure("story", heavy, story)
+
+    # Image generation for a whole book
+    await image_engine.lifecycle.ensure_loaded()
+    prompts = [main.style_prompt(specs, f"children in a sunny courtyard, scene {n}") for n in range(1, 11)]
+    rendered = {}
+
+    async def images():
+        paths = await image_engine.generate_images(prompts)
+        rendered["paths"] = paths
+        return {"images": sum(1 for path in paths if path)}
+
+    results["images"] = await measure("images", heavy, images)
+
+    # PDF assembly from the rendered images
+    pdf_pages = [
+        {"text": f"Page {n} text about charity and kindness.", "image_path": path}
+        for n, path in enumerate(rendered["paths"], 1)
+    ]
+
+    async def pdf():
+        await main.pdf_generator.create_book_pdf(pdf_pages, f"bench_{uuid.uuid4().hex}.pdf", "Benchmark Book")
+        return {"pages": len(pdf_pages)}
+
+    results["pdf"] = await measure("pdf", args.iterations, pdf)
+
+    # The whole pipeline, as run by the scheduler for POST /generate
+    with open(corpus["medium"], "rb") as f:
+        source = await main.source_store.save(f, os.path.basename(corpus["medium"]))
+    last = {}
+
+    async def pipeline():
+        job_id = str(uuid.uuid4())
+        main.job_store.create(job_id, specs=specs, source_file=source["name"], source_digest=source["digest"])
+        await main.process_book_generation(job_id, source, specs, segmentation, threading.Event())
+        job = main.job_store.get(job_id)
+        if job["status"] != "completed":
+            raise RuntimeError(f"Pipeline run failed: {job['message']}")
+        last["stages"] = job.get("metrics", {}).get("stages")
+        return {"pages": len(job.get("pages", [])), "books": 1}
+
+    results["pipeline"] = await measure("pipeline", heavy, pipeline)
+    results["pipeline"]["stages"] = last.get("stages")
+
+    # Image quality/speed profiles: per-image latency and what ends up in the PDF
+    for profile in args.image_profiles.split(","):
+        results[f"image_profile[{profile}]"] = await profile_benchmark(args, main, profile.strip(), prompts, heavy)
+    return results
+
+def image_quality(path: str, pdf_dpi: int) -> dict:
+    """
+    Resolution the image is printed at in the PDF and a sharpness score
+    (variance of its edge map; higher keeps more detail).
+    """
+    from PIL import Image, ImageFilter, ImageStat
+    from services.pdf_builder import IMAGE_BOX
+
+    image = Image.open(path).convert("L")
+    scale = min(IMAGE_BOX[0] / image.width, IMAGE_BOX[1] / image.height)
+    return {
+        "effective_dpi": min(pdf_dpi, round(72 / scale)),
+        "sharpness": ImageStat.Stat(image.filter(ImageFilter.FIND_EDGES)).var[0]
+    }
+
+async def profile_benchmark(args, main, profile: str, prompts: list, iterations: int) -> dict:
+    if args.mode == "stub":
+        from benchmarks.stubs import StubImageEngine
+        engine = StubImageEngine(seconds_per_image=args.stub_image_seconds, profile=profile)
+    else:
+        from services.image_gen import ImageEngine
+        engine = ImageEngine(profile=profile)
+    await engine.lifecycle.ensure_loaded()
+    rendered = {}
+
+    async def images():
+        paths = await engine.generate_images(prompts)
+        rendered["paths"] = [path for path in paths if path]
+        return {"images": len(rendered["paths"])}
+
+    name = f"image_profile[{profile}]"
+    result = await measure(name, iterations, images)
+    result["latency_seconds_per_image"] = {
+        stat: round(value / len(prompts), 4) for stat, value in result["latency_seconds"].items()
+    }
+    result["settings"] = engine.describe_profile()
+
+    # PDF built from this profile's images
+    pages = [{"text": f"Page {n} text.", "image_path": path} for n, path in enumerate(rendered["paths"], 1)]
+    pdf_path = await main.pdf_generator.create_book_pdf(pages, f"bench_{profile}.pdf", "Benchmark Book")
+    scores = [image_quality(path, main.pdf_generator.image_dpi) for path in rendered["paths"]]
+    result["pdf"] = {
+        "bytes_per_page": os.path.getsize(pdf_path) // max(1, len(pages)),
+        "effective_dpi": min(score["effective_dpi"] for score in scores) if scores else None,
+        "sharpness": round(sum(score["sharpness"] for score in scores) / len(scores), 2) if scores else None
+    }
+    print(f"{'':<24} {result['settings']['size']} -> {result['pdf']}")
+    await engine.lifecycle.unload()
+    return result
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    Benchmarks whose p50 or p90 latency is more than threshold slower than the baseline.
+    """
+    regressions = []
+    for name, result in report["benchmarks"].items():
+        old = baseline.get("benchmarks", {}).get(name)
+        if old is None:
+            continue
+        for stat in ("p50", "p90"):
+            before = old["latency_seconds"][stat]
+            after = result["latency_seconds"][stat]
+            if after > before * (1 + threshold) and after - before > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{name} {stat}: {before:.4f}s -> {after:.4f}s (+{(after / before - 1) * 100 if before else float('inf'):.0f}%)")
+    return regressions
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the ICBG generation pipeline.")
+    parser.add_argument("--mode", choices=("stub", "real"), default="stub", help="stub models (fast, deterministic) or the real local models")
+    parser.add_argument("--iterations", type=int, default=5, help="runs per benchmark (model-bound benchmarks run once in real mode)")
+    parser.add_argument("--output", default=None, help="report path (default benchmarks/results/<mode>-<time>.json)")
+    parser.add_argument("--baseline", default=None, help="earlier report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown before failing (0.2 = 20%%)")
+    parser.add_argument("--corpus-dir", default=None, help="where the synthetic PDFs are kept (default: inside the scratch dir)")
+    parser.add_argument("--image-profiles", default="quality,balanced,fast", help="comma-separated image profiles to compare")
+    parser.add_argument("--stub-token-seconds", type=float, default=0.0, help="simulated decode time per token in stub mode")
+    parser.add_argument("--stub-image-seconds", type=float, default=0.0, help="simulated diffusion time per image in stub mode")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output or os.path.join(BACKEND_DIR, "benchmarks", "results", f"{args.mode}-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("mode") != args.mode:
+            print(f"Baseline was recorded in {baseline.get('mode')} mode, not {args.mode}.")
+            return 2
+
+    workdir = tempfile.mkdtemp(prefix="icbg-bench-")
+    corpus_dir = os.path.abspath(args.corpus_dir) if args.corpus_dir else os.path.join(workdir, "corpus")
+    sys.path.insert(0, BACKEND_DIR)
+    os.chdir(workdir)
+    try:
+        from benchmarks.corpus import build_corpus
+        corpus = build_corpus(corpus_dir)
+        started = time.perf_counter()
+        benchmarks = asyncio.run(run_benchmarks(args, corpus))
+        report = {
+            "mode": args.mode,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "duration_seconds": round(time.perf_counter() - started, 2),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "corpus": {name: os.path.basename(path) for name, path in corpus.items()},
+            "benchmarks": benchmarks
+        }
+    finally:
+        os.chdir(BACKEND_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {output}")
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions over {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"No regressions over {args.threshold:.0%} against {args.baseline}.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,109 @@
+"""
+Deterministic stand-ins for the models, so benchmarks can exercise the real
+engine, parser, scheduler and PDF code in seconds and without weights.
+
+The stubs replace only what loads and runs the networks (_load_models,
+_generate, the diffusion pipeline). Optional per-token and per-image delays
+simulate model speed so overlap between stages shows up in the timings.
+"""
+import time
+import zlib
+from PIL import Image
+from services.llm import ContentEngine
+from services.image_gen import ImageEngine
+from services.story_parser import MAX_PAGES, PAGE_BREAK
+
+def stub_story(theme: str, pages: int = MAX_PAGES) -> str:
+    blocks = [
+        f"Page {n} Text: On day {n} the children learned about {theme.lower()} from their teacher, "
+        f"and they practised it at home with their family.\n"
+        f"Page {n} Image: children and their teacher in a sunny courtyard, scene {n}\n"
+        for n in range(1, pages + 1)
+    ]
+    return f"TITLE: A Story About {theme}\n" + f"\n{PAGE_BREAK}\n".join(blocks)
+
+class StubTextPipeline:
+    tokenizer = None
+
+class StubContentEngine(ContentEngine):
+    def __init__(self, seconds_per_token: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.seconds_per_token = seconds_per_token
+
+    def _load_models(self):
+        self.pipe = StubTextPipeline()
+
+    def _unload_models(self):
+        self.pipe = None
+
+    def _model_bytes(self) -> int:
+        return 0
+
+    def _warm_up(self):
+        pass
+
+    def _generate(self, prompt_suffix: str, streamer=None, max_new_tokens: int = None, cancel_event=None,
+                  max_pages: int = MAX_PAGES) -> tuple:
+        if max_pages == 1:
+            # A page rewrite continues after "Page N Text:"
+            output = " The children shared their bread with a traveller.\nPage 1 Image: children sharing bread\n"
+        else:
+            output = stub_story("Kindness", max_pages)
+        # Whitespace-separated words stand in for tokens
+        tokens = output.split(" ")
+        started = time.perf_counter()
+        for i, token in enumerate(tokens):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if self.seconds_per_token:
+                time.sleep(self.seconds_per_token)
+            if streamer is not None:
+                streamer.on_finalized_text(token if i == len(tokens) - 1 else token + " ")
+        elapsed = time.perf_counter() - started
+        stats = {
+            "backend": "stub",
+            "prompt_tokens": len(prompt_suffix.split()),
+            "generated_tokens": len(tokens),
+            "seconds": round(elapsed, 3),
+            "prefill_seconds": 0.0,
+            "decode_seconds": round(elapsed, 3),
+            "tokens_per_second": round(len(tokens) / elapsed, 2) if elapsed > 0 else 0.0,
+            "stop_reason": "stub"
+        }
+        return output, stats
+
+class StubImagePipeline:
+    """
+    Returns one flat image per prompt, coloured by a hash of the prompt.
+    """
+    def __init__(self, seconds_per_image: float = 0.0):
+        self.seconds_per_image = seconds_per_image
+
+    def __call__(self, prompt, height: int = 512, width: int = 512, callback_on_step_end=None, **kwargs):
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        if self.seconds_per_image:
+            time.sleep(self.seconds_per_image * len(prompts))
+        if callback_on_step_end is not None:
+            callback_on_step_end(self, 0, 0, {})
+        images = []
+        for text in prompts:
+            color = zlib.crc32(text.encode("utf-8"))
+            images.append(Image.new("RGB", (width, height), (color & 255, (color >> 8) & 255, (color >> 16) & 255)))
+        return type("StubOutput", (), {"images": images})
+
+class StubImageEngine(ImageEngine):
+    def __init__(self, seconds_per_image: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.seconds_per_image = seconds_per_image
+
+    def _load_models(self):
+        self.pipe = StubImagePipeline(self.seconds_per_image)
+
+    def _unload_models(self):
+        self.pipe = None
+
+    def _model_bytes(self) -> int:
+        return 0
+
+    def _warm_up(self):
+        pass
@@ -1,123 +1,657 @@
-from fastapi import FastAPI, BackgroundTasks, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
 from typing import Annotated
 import shutil
 import os
 import asyncio
 import json
+import time
 import uuid
-from services.pdf_builder import PDFGenerator
+from services.pdf_builder import PDFGenerator, BookAssembly, parts_dir, page_thumbnail, build_draft
 from services.ingestion import DocumentIngestionService
-from services.llm import ContentEngine
-from services.image_gen import ImageEngine
+from services.inference import inference_executor
+from services.residency import model_residency
+from services.image_cache import ImageCache
+from services.job_store import JobStore, TERMINAL_STATUSES
+from services.workers import WorkerRegistry
+from services.source_store import SourceStore, UploadTooLarge
+from services.storage import StorageManager
+from services.scheduler import JobScheduler, QueueFullError, PRIORITIES
+from services.metrics import metrics, JobMetrics, stage_estimate
+from services.story_parser import MAX_PAGES
 
 app = FastAPI(title="Islamic Children Book Generator API")
 
-# CORS configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins for dev
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# API workers sharing the job database (uvicorn --workers N): liveness, job slots, cancel requests
+workers = WorkerRegistry()
+WORKER_POLL_SECONDS = float(os.environ.get("ICBG_WORKER_POLL_SECONDS", "0.5"))
 
-# In-memory job store
-jobs = {}
+# Durable job store (SQLite) with push notifications for SSE watchers
+job_store = JobStore(workers=workers)
+
+# Admission control, priorities, per-stage concurrency and cancellation
+scheduler = JobScheduler(slots=workers)
+
+# Job fields streamed to the frontend
+EVENT_FIELDS = ("status", "progress", "message", "result_url", "book_title", "pages_ready")
+BATCH_EVENT_FIELDS = ("status", "progress", "message", "books")
+
+# Most books one POST /batches may ask for
+MAX_BATCH_BOOKS = int(os.environ.get("ICBG_MAX_BATCH_BOOKS", "10"))
+
+# Uploaded documents, stored once per content hash
+source_store = SourceStore()
+
+# Seeded illustrations shared between books (refcounted per book, see delete_book)
+image_cache = ImageCache()
 
 # Initialize Services
 print("Initializing Services...")
 pdf_generator = PDFGenerator()
 ingestion_service = DocumentIngestionService()
-content_engine = ContentEngine()
-image_engine = ImageEngine()
+MODEL_SERVER = os.environ.get("ICBG_MODEL_SERVER")
+# "background": start loading models at startup; "lazy": load on the first job
+MODEL_LOAD = os.environ.get("ICBG_MODEL_LOAD", "background")
+if MODEL_SERVER:
+    # Models live in the shared model server (python -m services.model_server)
+    from services.model_client import RemoteContentEngine, RemoteImageEngine, server_status
+    content_engine = RemoteContentEngine(MODEL_SERVER)
+    image_engine = RemoteImageEngine(MODEL_SERVER)
+else:
+    from services.llm import ContentEngine
+    from services.image_gen import ImageEngine
+    content_engine = ContentEngine()
+    image_engine = ImageEngine(cache=image_cache)
 print("Services Initialized.")
 
-async def process_book_generation(job_id: str, filename: str, specs: dict, segmentation: dict):
+# Disk usage: book index, TTLs, quota and orphan sweeps (see services/storage.py)
+storage = StorageManager(source_store, lambda job_id: remove_book_files(job_id))
+STORAGE_SWEEP_INTERVAL = float(os.environ.get("ICBG_STORAGE_SWEEP_INTERVAL", "3600"))
+
+def cache_lookups() -> list:
+    caches = {"image": image_cache, "page_text": ingestion_service.page_cache, "bm25_index": ingestion_service.index_cache}
+    lookups = [({"cache": name, "result": "hit"}, cache.hits) for name, cache in caches.items()]
+    lookups += [({"cache": name, "result": "miss"}, cache.misses) for name, cache in caches.items()]
+    if hasattr(content_engine, "prefix_cache_hits"):
+        lookups.append(({"cache": "llm_prefix", "result": "hit"}, content_engine.prefix_cache_hits))
+    return lookups
+
+metrics.gauge("icbg_cache_lookups", "Cache lookups by cache and result (hit or miss).", cache_lookups)
+metrics.gauge("icbg_jobs_queued", "Jobs waiting in the scheduler queue.", lambda: scheduler.queued_count)
+metrics.gauge("icbg_jobs_running", "Jobs currently running.", lambda: scheduler.running_count)
+
+@app.on_event("startup")
+async def load_models():
+    # Bind the port right away; jobs that arrive before the models are ready wait for them
+    if not MODEL_SERVER and MODEL_LOAD == "background":
+        # Within a memory budget only what fits is preloaded; the rest loads when a job needs it
+        content_engine.lifecycle.preload()
+        image_engine.lifecycle.preload()
+
+@app.on_event("startup")
+async def start_storage_sweeper():
+    if STORAGE_SWEEP_INTERVAL > 0:
+        # Jobs of every worker are kept; only one worker sweeps
+        asyncio.create_task(storage.run_forever(STORAGE_SWEEP_INTERVAL, job_store.unfinished, workers.is_leader))
+
+@app.on_event("startup")
+async def start_worker_coordination():
+    asyncio.create_task(coordinate_workers())
+
+async def coordinate_workers():
+    """
+    Work shared with the other API workers: cancel requests for jobs running
+    here, slots they freed for jobs queued here, heartbeats and the recovery of
+    jobs whose worker has stopped.
+    """
+    last_heartbeat = time.monotonic()
+    while True:
+        await asyncio.sleep(WORKER_POLL_SECONDS)
+        try:
+            for job_id in workers.take_cancel_requests(scheduler.jobs()):
+                cancel_here(job_id)
+            scheduler.dispatch()
+            if time.monotonic() - last_heartbeat >= workers.heartbeat_seconds:
+                last_heartbeat = time.monotonic()
+                workers.heartbeat()
+                job_store.recover()
+        except Exception as e:
+            print(f"Worker coordination failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_inference():
+    # Stop the inference worker threads so uvicorn can exit cleanly
+    inference_executor.shutdown(wait=False)
+    # The other workers take over this worker's unfinished jobs right away
+    workers.unregister()
+
+async def engine_status() -> dict:
+    if MODEL_SERVER:
+        try:
+            return await server_status(MODEL_SERVER)
+        except OSError as e:
+            return {"model_server": {"state": "unreachable", "error": str(e)}}
+    return {"llm": content_engine.lifecycle.status(), "image": image_engine.lifecycle.status()}
+
+@app.get("/health")
+async def health():
+    # Liveness only: the process is up and serving requests
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness: 200 once every model is loaded (or unloaded and reloadable on demand), 503 otherwise.
+    """
+    engines = await engine_status()
+    is_ready = all(engine["state"] in ("ready", "unloaded") for engine in engines.values())
+    return JSONResponse(status_code=200 if is_ready else 503, content={"ready": is_ready, "engines": engines})
+
+@app.get("/metrics")
+async def metrics_endpoint():
     """
-    Executes the book generation pipeline.
+    Prometheus text exposition of stage timings, throughput, queue, cache and model residency metrics.
     """
+    if not MODEL_SERVER:
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+    # The models, and so their residency metrics, live in the model server
+    text = metrics.render(skip="icbg_model_")
     try:
-        jobs[job_id]["status"] = "processing"
-        jobs[job_id]["progress"] = 5
-        jobs[job_id]["message"] = "Starting ingestion..."
-        
-        # 1. Ingestion
-        file_path = f"source_files/{filename}"
+        text += await server_status(MODEL_SERVER, "metrics") or ""
+    except OSError as e:
+        print(f"Could not read model server metrics: {e}")
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+@app.get("/models/residency")
+async def residency_status():
+    """
+    Which models are resident, their sizes against the memory budget, and swap/eviction counts.
+    """
+    if MODEL_SERVER:
+        return await server_status(MODEL_SERVER, "residency")
+    return model_residency.status()
+
+def stored_pages(pages: list) -> list:
+    # Page records kept with the job, without in-memory images
+    return [{k: v for k, v in page.items() if k != "image"} for page in pages]
+
+def write_manifest(job_id: str, pdf_path: str, images: list, parts: str):
+    # Everything delete_book has to clean up for this book
+    manifest = {
+        "pdf_path": pdf_path,
+        "images": images,
+        "parts_dir": parts
+    }
+    manifest_path = f"generated_books/manifest_{job_id}.json"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    storage.record_book(job_id, manifest_path, manifest)
+
+def release_image(image_path: str):
+    if image_path and image_cache.owns(image_path):
+        # Cached images may be shared with other books: only drop this book's reference
+        image_cache.release(image_path)
+    elif image_path and os.path.exists(image_path):
+        os.remove(image_path)
+
+def style_prompt(specs: dict, image_prompt: str) -> str:
+    # Add style modifiers based on theme
+    return f"children's book illustration, {specs.get('theme', 'islamic art style')}, {image_prompt}, warm colors, soft lighting, high quality"
+
+class BookRun:
+    """
+    State of one book while it is being generated: its job, specs, pages and
+    incremental PDF. A regular job has one; a batch job has one per variant.
+
+    Progress is the share of expected work done: each stage is weighted by
+    its measured average duration (see stage_estimate) and advances with the
+    pages actually written, illustrated and assembled.
+    """
+    def __init__(self, job_id: str, specs: dict, cancel_event, queue_wait: float = None):
+        self.job_id = job_id
+        self.specs = specs
+        self.cancel_event = cancel_event
+        self.assembly = BookAssembly(pdf_generator, job_id)
+        self.pages = []
+        # Every illustration this book holds, in the order they were made
+        self.images = []
+        self.title = None
+        self.metrics = JobMetrics()
+        self.metrics.queue_wait_seconds = queue_wait
+        self.done = {"ingest": 0.0, "llm": 0.0, "image": 0.0, "pdf": 0.0}
+        self._written = 0
+        self._illustrated = 0
+        self._rendered = set()
+
+    @property
+    def expected_pages(self) -> int:
+        return len(self.pages) or max(MAX_PAGES, self._written)
+
+    def progress(self) -> int:
+        weights = {stage: stage_estimate(stage) for stage in self.done}
+        done = sum(weights[stage] * fraction for stage, fraction in self.done.items())
+        # 100 only once the job record says completed
+        return min(99, int(100 * done / sum(weights.values())))
+
+    def report(self, message: str, **fields):
+        if self.cancel_event.is_set() or job_store.get(self.job_id)["status"] in TERMINAL_STATUSES:
+            # Work still unwinding after a cancel or failure (e.g. pages of a batch book whose
+            # story failed, still being illustrated) must not overwrite the final record
+            return
+        job_store.update(self.job_id, progress=self.progress(), message=message, **fields)
+
+    def page_written(self):
+        self._written += 1
+        self.done["llm"] = min(1.0, self._written / self.expected_pages)
+        self.report(f"Wrote page {self._written}, illustrating...")
+
+    def page_illustrated(self, page: dict):
+        if page.get("image_path"):
+            image_cache.acquire(page["image_path"])
+            self.images.append(page["image_path"])
+        # Lay the page out into the book right away
+        self.assembly.add_page(page["number"], page, on_done=self._page_rendered)
+        self._illustrated += 1
+        self.done["image"] = min(1.0, self._illustrated / self.expected_pages)
+        self.report(f"Illustrated page {self._illustrated}...")
+
+    def _page_rendered(self, number: int):
+        self._rendered.add(number)
+        job_store.update(self.job_id, pages_ready=len(self._rendered))
+
+    def close(self):
+        """
+        Record the job's metrics and write its cleanup manifest, whatever the outcome.
+        A book that did not complete gives its cached images back right away; its
+        own image files stay listed in the manifest for delete_book and the sweeper.
+        """
+        job = job_store.get(self.job_id)
+        self.metrics.finish(job["status"])
+        job_store.update(self.job_id, metrics=self.metrics.to_dict())
+        images = self.images
+        if job["status"] != "completed":
+            for image_path in images:
+                if image_cache.owns(image_path):
+                    image_cache.release(image_path)
+            images = [image_path for image_path in images if not image_cache.owns(image_path)]
+        write_manifest(self.job_id, job.get("file_path"), images, self.assembly.parts_dir)
+
+async def illustrate_pages(queue: asyncio.Queue, cancel_event):
+    """
+    Illustrates (book, page) items as they arrive on the queue until a None sentinel.
+    Pages that pile up while the image model is busy are rendered as one batch,
+    across books when several are generated together.
+    """
+    finished = False
+    while not finished and not cancel_event.is_set():
+        item = await queue.get()
+        if item is None:
+            break
+        batch = [item]
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is None:
+                finished = True
+                break
+            batch.append(item)
+
+        cached = set()
+
+        def on_image(index, image_path, image):
+            book, page = batch[index]
+            page["image_path"] = image_path
+            if image is not None:
+                # Handed straight to the PDF builder, no need to read the PNG back
+                page["image"] = image
+            elif image_path:
+                cached.add(index)
+            book.page_illustrated(page)
+
+        prompts = [style_prompt(book.specs, page.get("image_prompt", "")) for book, page in batch]
+        async with scheduler.stage("image"):
+            started = time.perf_counter()
+            await image_engine.generate_images(prompts, on_image=on_image, cancel_event=cancel_event)
+            elapsed = time.perf_counter() - started
+        # Every book in the batch waited for the whole call
+        for book in {book for book, _ in batch}:
+            indexes = [i for i, (owner, _) in enumerate(batch) if owner is book]
+            book.metrics.record_diffusion(len(indexes), len(cached.intersection(indexes)), elapsed)
+
+async def ingest_source(book: BookRun, file_path: str, segmentation: dict, doc_id: str = None) -> str:
+    book.report("Starting ingestion...", status="processing")
+    async with scheduler.stage("ingest"), book.metrics.stage("ingest"):
         source_text = await ingestion_service.ingest_pdf(
             file_path,
             section_description=segmentation.get("sectionDescription"),
             additional_context=segmentation.get("additionalContext"),
             page_start=segmentation.get("pageStart"),
-            page_end=segmentation.get("pageEnd")
+            page_end=segmentation.get("pageEnd"),
+            doc_id=doc_id
         )
+    
+    if not source_text:
+        raise Exception("Failed to extract text from document.")
+    
+    book.done["ingest"] = 1.0
+    book.report("Generating story...")
+    return source_text
+
+async def write_story(book: BookRun, source_text: str, illustration_queue: asyncio.Queue, cancel_event):
+    """
+    Stream the story for a book, handing each page to the illustrator as soon as
+    it is written, so text decoding and diffusion run at the same time.
+    """
+    book.report("Generating story and title...")
+
+    queued = set()
+    story_data = {}
+    async with scheduler.stage("llm"), book.metrics.stage("llm"):
+        async for kind, payload in content_engine.stream_story(source_text, book.specs, cancel_event):
+            if kind == "page":
+                queued.add(id(payload))
+                payload["number"] = len(queued)
+                illustration_queue.put_nowait((book, payload))
+                book.page_written()
+            elif kind == "story":
+                story_data = payload
+
+    book.pages = story_data.get("pages", [])
+    book.title = story_data.get("title", "My Islamic Children's Book")
+    book.done["llm"] = 1.0
+    book.metrics.record_llm(story_data.get("stats"))
+    job_store.update(book.job_id, llm_stats=story_data.get("stats"))
+
+    # Pages produced by the final parse (last page, smart-split fallback)
+    for number, page in enumerate(book.pages, 1):
+        if id(page) not in queued:
+            page["number"] = number
+            illustration_queue.put_nowait((book, page))
+
+async def finish_book(book: BookRun):
+    # PDF Construction: pages were rendered as they were illustrated, only the merge is left
+    book.report("Assembling PDF...")
+    
+    output_path = os.path.join(pdf_generator.output_dir, f"book_{book.job_id}.pdf")
+    async with scheduler.stage("pdf"), book.metrics.stage("pdf"):
+        await book.assembly.finalize(book.pages, book.title, output_path)
+    for page in book.pages:
+        page.pop("image", None)
+    
+    job_store.update(
+        book.job_id,
+        progress=100,
+        status="completed",
+        message="Book generated successfully!",
+        result_url=f"/download/{book.job_id}",
+        file_path=output_path,
+        book_title=book.title, # Pass title to frontend
+        pages=stored_pages(book.pages) # Kept for single-page regeneration
+    )
+
+async def process_book_generation(job_id: str, source: dict, specs: dict, segmentation: dict, cancel_event):
+    """
+    Executes the book generation pipeline for a stored source document (see SourceStore.save).
+    Runs under the scheduler; cancel_event is set when the job is cancelled.
+    """
+    book = BookRun(job_id, specs, cancel_event, queue_wait=scheduler.queue_wait(job_id))
+    try:
+        # 1. Ingestion
+        source_text = await ingest_source(book, source["path"], segmentation, doc_id=source["digest"])
         
-        if not source_text:
-            raise Exception("Failed to extract text from document.")
-            
-        jobs[job_id]["progress"] = 20
-        jobs[job_id]["message"] = "Generating story..."
-        
-        # 2. Story Generation
-        # Content Generation
-        jobs[job_id]["progress"] = 40
-        jobs[job_id]["message"] = "Generating story and title..."
-        
-        story_data = await content_engine.generate_story(source_text, specs)
-        pages = story_data.get("pages", [])
-        book_title = story_data.get("title", "My Islamic Children's Book")
-        
-        # Image Generation
-        jobs[job_id]["progress"] = 60
-        jobs[job_id]["message"] = "Creating illustrations..."
-        
-        for i, page in enumerate(pages):
-            image_prompt = page.get("image_prompt", "")
-            if image_prompt:
-                # Add style modifiers based on theme
-                style_prompt = f"children's book illustration, {specs.get('theme', 'islamic art style')}, {image_prompt}, warm colors, soft lighting, high quality"
-                image_path = await image_engine.generate_image(style_prompt)
-                page["image_path"] = image_path
-            
-            # Update progress per page
-            jobs[job_id]["progress"] = 60 + int((i / len(pages)) * 30)
-            jobs[job_id]["message"] = f"Illustrating page {i+1} of {len(pages)}..."
-        
-        # PDF Construction
-        jobs[job_id]["progress"] = 90
-        jobs[job_id]["message"] = "Assembling PDF..."
-        
-        output_filename = f"book_{job_id}.pdf"
-        output_path = await pdf_generator.create_book_pdf(pages, output_filename, title=book_title)
+        # 2. Story Generation + Illustration
+        illustration_queue = asyncio.Queue()
+        illustrator = asyncio.create_task(illustrate_pages(illustration_queue, cancel_event))
+        try:
+            await write_story(book, source_text, illustration_queue, cancel_event)
+        finally:
+            illustration_queue.put_nowait(None)
+            await illustrator
         
-        jobs[job_id]["progress"] = 100
-        jobs[job_id]["status"] = "completed"
-        jobs[job_id]["message"] = "Book generated successfully!"
-        jobs[job_id]["result_url"] = f"/download/{job_id}"
-        jobs[job_id]["file_path"] = output_path
-        jobs[job_id]["book_title"] = book_title # Pass title to frontend
+        # 3. PDF
+        await finish_book(book)
         
     except Exception as e:
-        jobs[job_id]["status"] = "failed"
-        jobs[job_id]["message"] = f"Error: {str(e)}"
+        if not cancel_event.is_set():
+            job_store.update(job_id, status="failed", message=f"Error: {str(e)}")
         print(f"Job {job_id} failed: {e}")
     finally:
-        # Create manifest for cleanup
-        manifest = {
-            "pdf_path": jobs[job_id].get("file_path"),
-            "images": [p.get("image_path") for p in pages if p.get("image_path")]
-        }
-        manifest_path = f"generated_books/manifest_{job_id}.json"
-        with open(manifest_path, "w") as f:
-            json.dump(manifest, f)
+        # Metrics and manifest for cleanup
+        book.close()
             
         # NOTE: We no longer delete the source file here to allow for "Recent Source Files" download.
         # It will be deleted via the explicit DELETE endpoint.
 
+async def process_batch_generation(batch_id: str, source: dict, variants: list, cancel_event):
+    """
+    Generates a series of books from one source file as a single scheduled job.
+
+    The document is ingested under its content hash, so every variant's
+    excerpt is served from the shared page and chunk caches. Stories are written one after another (the
+    LLM reuses its cached prompt prefix) while one illustrator renders pages
+    from all books together, so diffusion batches span books. variants is a
+    list of (job_id, specs, segmentation).
+    """
+    books = [BookRun(job_id, specs, cancel_event, queue_wait=scheduler.queue_wait(batch_id)) for job_id, specs, _ in variants]
+    failed = set()
+
+    def fail(book, e):
+        failed.add(book.job_id)
+        job_store.update(book.job_id, status="failed", message=f"Error: {str(e)}")
+        print(f"Job {book.job_id} of batch {batch_id} failed: {e}")
+
+    try:
+        job_store.update(batch_id, status="processing", message="Ingesting source...")
+        sources = []
+        for book, (_, _, segmentation) in zip(books, variants):
+            try:
+                sources.append(await ingest_source(book, source["path"], segmentation, doc_id=source["digest"]))
+            except Exception as e:
+                fail(book, e)
+                sources.append(None)
+
+        illustration_queue = asyncio.Queue()
+        illustrator = asyncio.create_task(illustrate_pages(illustration_queue, cancel_event))
+        try:
+            for number, (book, source_text) in enumerate(zip(books, sources), 1):
+                if source_text is None:
+                    continue
+                job_store.update(batch_id, message=f"Writing book {number} of {len(books)}...")
+                try:
+                    await write_story(book, source_text, illustration_queue, cancel_event)
+                except Exception as e:
+                    fail(book, e)
+        finally:
+            illustration_queue.put_nowait(None)
+            await illustrator
+
+        job_store.update(batch_id, message="Assembling PDFs...")
+        for book in books:
+            if book.job_id not in failed:
+                try:
+                    await finish_book(book)
+                except Exception as e:
+                    fail(book, e)
+    finally:
+        for book in books:
+            job = job_store.get(book.job_id)
+            if job["status"] not in TERMINAL_STATUSES:
+                job_store.update(book.job_id, status="cancelled" if cancel_event.is_set() else "failed", message="Cancelled" if cancel_event.is_set() else "Batch stopped")
+            book.close()
+        if not cancel_event.is_set():
+            done = sum(1 for book in books if book.job_id not in failed)
+            job_store.update(batch_id, status="completed", progress=100, message=f"{done} of {len(books)} books generated.")
+
+def roll_up_batch(job: dict):
+    """
+    Job store listener: refresh a batch's aggregate progress when one of its books changes.
+    """
+    batch_id = job.get("batch_id")
+    if not batch_id:
+        return
+    batch = job_store.get(batch_id)
+    if batch is None:
+        return
+    books = [job_store.get(book_id) or {"id": book_id} for book_id in batch.get("book_ids", [])]
+    fields = {"books": [{field: book.get(field) for field in ("id", *EVENT_FIELDS)} for book in books]}
+    if batch["status"] not in TERMINAL_STATUSES:
+        fields["progress"] = sum(book.get("progress", 0) for book in books) // max(1, len(books))
+    job_store.update(batch_id, **fields)
+
+job_store.add_listener(roll_up_batch)
+
+async def process_page_regeneration(job_id: str, number: int, regenerate_text: bool, regenerate_image: bool, cancel_event):
+    """
+    Redo one page of a finished book: new text (LLM) and/or a new illustration
+    (one diffusion call), then merge the book again from the stored page renders.
+    The book stays available; on failure or cancel the old version is kept.
+    """
+    job = job_store.get(job_id)
+    specs = job.get("specs") or {}
+    pages = job["pages"]
+    page = dict(pages[number - 1])
+    message = f"Page {number} regenerated."
+    new_image = None
+    kept = False
+    try:
+        if regenerate_text:
+            job_store.update(job_id, progress=10, message=f"Rewriting page {number}...")
+            async with scheduler.stage("llm"):
+                rewritten = await content_engine.rewrite_page({"title": job.get("book_title"), "pages": pages}, number, specs, cancel_event)
+            if not rewritten:
+                raise Exception("Could not rewrite the page text.")
+            page.update(rewritten)
+
+        old_image = None
+        if regenerate_image:
+            job_store.update(job_id, progress=40, message=f"Redrawing page {number}...")
+            # A new variation so seeded mode doesn't hand back the same image
+            page["variation"] = page.get("variation", 0) + 1
+            async with scheduler.stage("image"):
+                results = await image_engine.generate_images(
+                    [style_prompt(specs, page.get("image_prompt", ""))], batch_size=1,
+                    cancel_event=cancel_event, variation=page["variation"]
+                )
+            if not results[0]:
+                raise Exception("Could not redraw the illustration.")
+            old_image = page.get("image_path")
+            new_image = page["image_path"] = results[0]
+            image_cache.acquire(new_image)
+
+        async def update_pdf():
+            pages[number - 1] = page
+            assembly = BookAssembly(pdf_generator, job_id)
+            async with scheduler.stage("pdf"):
+                await assembly.rebuild(pages, job.get("book_title"), job["file_path"], changed={number})
+            job_store.update(job_id, pages=pages)
+            write_manifest(job_id, job["file_path"], [p["image_path"] for p in pages if p.get("image_path")], assembly.parts_dir)
+            release_image(old_image)
+
+        if cancel_event.is_set():
+            raise asyncio.CancelledError()
+        job_store.update(job_id, progress=80, message="Updating PDF...")
+        # Once the page renders are being replaced, finish the update even if a
+        # cancel arrives, so the parts, the PDF, the pages and the manifest agree
+        update = asyncio.ensure_future(update_pdf())
+        try:
+            await asyncio.shield(update)
+        except asyncio.CancelledError:
+            await update
+        kept = True
+    except asyncio.CancelledError:
+        message = f"Regeneration of page {number} cancelled."
+    except Exception as e:
+        message = f"Error regenerating page {number}: {str(e)}"
+        print(f"Job {job_id} page {number} regeneration failed: {e}")
+    finally:
+        if new_image and not kept:
+            release_image(new_image)
+        # A book deleted meanwhile (DELETE /books/{job_id}) stays deleted
+        if job_store.get(job_id)["status"] != "deleted":
+            job_store.update(job_id, status="completed", progress=100, message=message, restore=None)
+
+# Multipart overhead allowed on top of the file itself
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+class UploadSizeLimit:
+    """
+    ASGI middleware answering 413 to oversized uploads on `paths`: from their
+    Content-Length before the body is read, or, for chunked uploads without
+    one, as soon as the received body passes the limit. Starlette spools the
+    multipart body before the handler runs, so this is where the limit has to
+    apply; SourceStore.save checks the file itself again while copying it.
+    """
+    def __init__(self, app, paths: tuple):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        limit = source_store.max_bytes + UPLOAD_FORM_OVERHEAD
+        rejection = JSONResponse(status_code=413, content={"detail": str(UploadTooLarge(source_store.max_bytes))})
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            await rejection(scope, receive, send)
+            return
+
+        received = 0
+        too_large = False
+        rejected = []
+
+        async def reject():
+            if not rejected:
+                rejected.append(True)
+                await rejection(scope, receive, send)
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    too_large = True
+                    # Stops body parsing; the error response it leads to is replaced below
+                    raise UploadTooLarge(source_store.max_bytes)
+            return message
+
+        async def checked_send(message):
+            if not too_large:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                await reject()
+
+        try:
+            await self.app(scope, limited_receive, checked_send)
+        except UploadTooLarge:
+            await reject()
+
+app.add_middleware(UploadSizeLimit, paths=("/generate", "/batches"))
+
+# CORS configuration. Added last so it is the outermost middleware and its
+# headers also reach responses from the ones above (e.g. a 413 upload rejection)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Allow all origins for dev
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+async def store_upload(file: UploadFile) -> dict:
+    try:
+        source = await source_store.save(file.file, file.filename)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if source["deduplicated"]:
+        print(f"Upload {source['name']} matches stored document {source['digest'][:12]}, not stored again.")
+    return source
+
 @app.post("/generate")
 async def generate_book(
-    background_tasks: BackgroundTasks,
     file: Annotated[UploadFile, File()],
     theme: Annotated[str, Form()],
     humor: Annotated[int, Form()],
@@ -126,74 +660,169 @@ async def generate_book(
     sectionDescription: Annotated[str, Form()] = "",
     additionalContext: Annotated[str, Form()] = "",
     pageStart: Annotated[int | None, Form()] = None,
-    pageEnd: Annotated[int | None, Form()] = None
+    pageEnd: Annotated[int | None, Form()] = None,
+    # Optional cap on generated LLM tokens for this job
+    tokenBudget: Annotated[int | None, Form()] = None,
+    # Scheduling priority: high, normal or low
+    priority: Annotated[str, Form()] = "normal"
 ):
-    # Save uploaded file to persistent source_files directory
-    os.makedirs("source_files", exist_ok=True)
-    file_path = f"source_files/{file.filename}"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"priority must be one of {', '.join(PRIORITIES)}")
+    # Reject before storing the upload when there is no room in the queue
+    if scheduler.is_full():
+        retry_after = scheduler.retry_after()
+        raise HTTPException(status_code=429, detail="Too many queued jobs, please retry later", headers={"Retry-After": str(retry_after)})
+
+    # Store the upload by content hash; a known document is not stored twice
+    source = await store_upload(file)
     
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {
-        "id": job_id,
-        "status": "pending",
-        "progress": 0,
-        "message": "Queued",
-        "specs": {
-            "theme": theme,
-            "humor": humor,
-            "ageGroup": ageGroup
-        }
+    specs = {
+        "theme": theme,
+        "humor": humor,
+        "ageGroup": ageGroup,
+        "tokenBudget": tokenBudget
+    }
+    segmentation = {
+        "sectionDescription": sectionDescription,
+        "additionalContext": additionalContext,
+        "pageStart": pageStart,
+        "pageEnd": pageEnd
     }
+
+    try:
+        scheduler.submit(
+            job_id,
+            lambda cancel_event: process_book_generation(job_id, source, specs, segmentation, cancel_event),
+            priority=priority
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    job_store.create(job_id, specs=specs, source_file=source["name"], source_digest=source["digest"], priority=priority)
     
-    background_tasks.add_task(
-        process_book_generation, 
-        job_id, 
-        file.filename, 
-        jobs[job_id]["specs"],
-        {
-            "sectionDescription": sectionDescription,
-            "additionalContext": additionalContext,
-            "pageStart": pageStart,
-            "pageEnd": pageEnd
+    return {"job_id": job_id, "status": "submitted", "queue_position": scheduler.position(job_id)}
+
+class BookVariant(BaseModel):
+    """
+    One book of a batch: the /generate form fields.
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    theme: str = ""
+    humor: int = 5
+    ageGroup: str = ""
+    sectionDescription: str = ""
+    additionalContext: str = ""
+    pageStart: int | None = Field(default=None, ge=1)
+    pageEnd: int | None = Field(default=None, ge=1)
+    tokenBudget: int | None = Field(default=None, ge=1)
+
+BOOK_VARIANTS = TypeAdapter(list[BookVariant])
+
+@app.post("/batches")
+async def generate_batch(
+    file: Annotated[UploadFile, File()],
+    # JSON list of books to make from this file, each with the /generate fields:
+    # theme, humor, ageGroup, sectionDescription, additionalContext, pageStart, pageEnd, tokenBudget
+    variants: Annotated[str, Form()],
+    priority: Annotated[str, Form()] = "normal"
+):
+    """
+    Generate a series of books from one upload. The file is stored and ingested
+    once; progress of every book is streamed from /batches/{batch_id}/events.
+    """
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"priority must be one of {', '.join(PRIORITIES)}")
+    try:
+        variants = BOOK_VARIANTS.validate_json(variants)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=json.loads(e.json(include_url=False)))
+    if not variants:
+        raise HTTPException(status_code=422, detail="variants must be a non-empty list of objects")
+    if len(variants) > MAX_BATCH_BOOKS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_BATCH_BOOKS} books per batch")
+    if scheduler.is_full():
+        retry_after = scheduler.retry_after()
+        raise HTTPException(status_code=429, detail="Too many queued jobs, please retry later", headers={"Retry-After": str(retry_after)})
+
+    source = await store_upload(file)
+
+    batch_id = str(uuid.uuid4())
+    books = []
+    for variant in variants:
+        specs = {
+            "theme": variant.theme,
+            "humor": variant.humor,
+            "ageGroup": variant.ageGroup,
+            "tokenBudget": variant.tokenBudget
         }
-    )
-    
-    return {"job_id": job_id, "status": "submitted"}
+        segmentation = {
+            "sectionDescription": variant.sectionDescription,
+            "additionalContext": variant.additionalContext,
+            "pageStart": variant.pageStart,
+            "pageEnd": variant.pageEnd
+        }
+        books.append((str(uuid.uuid4()), specs, segmentation))
+
+    try:
+        scheduler.submit(
+            batch_id,
+            lambda cancel_event: process_batch_generation(batch_id, source, books, cancel_event),
+            priority=priority
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    job_store.create(batch_id, kind="batch", source_file=source["name"], source_digest=source["digest"], priority=priority,
+                     book_ids=[job_id for job_id, _, _ in books])
+    for job_id, specs, _ in books:
+        job_store.create(job_id, specs=specs, source_file=source["name"], source_digest=source["digest"], priority=priority, batch_id=batch_id)
+    roll_up_batch({"batch_id": batch_id})
+
+    return {"batch_id": batch_id, "job_ids": [job_id for job_id, _, _ in books], "status": "submitted",
+            "queue_position": scheduler.position(batch_id)}
+
+@app.get("/batches/{batch_id}/events")
+async def batch_event_stream(batch_id: str):
+    """
+    Aggregate progress of a batch plus the status of each of its books.
+    """
+    async def event_generator():
+        if job_store.get(batch_id) is None:
+            yield f"data: {json.dumps({'error': 'Batch not found'})}\n\n"
+            return
+
+        async for payload in job_store.subscribe(batch_id, BATCH_EVENT_FIELDS):
+            if payload is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {payload}\n\n"
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 @app.get("/events/{job_id}")
 async def event_stream(job_id: str):
     async def event_generator():
-        if job_id not in jobs:
+        if job_store.get(job_id) is None:
             yield f"data: {json.dumps({'error': 'Job not found'})}\n\n"
             return
 
-        while True:
-            job = jobs[job_id]
-            data = {
-                "status": job["status"],
-                "progress": job["progress"],
-                "message": job["message"],
-                "result_url": job.get("result_url"),
-                "book_title": job.get("book_title")
-            }
-            yield f"data: {json.dumps(data)}\n\n"
-            
-            if job["status"] in ["completed", "failed"]:
-                break
-            
-            await asyncio.sleep(1)
+        # Woken only when the job changes; a comment line keeps idle connections open
+        async for payload in job_store.subscribe(job_id, EVENT_FIELDS):
+            if payload is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {payload}\n\n"
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 @app.get("/download/{job_id}")
 async def download_book(job_id: str):
-    if job_id not in jobs or jobs[job_id]["status"] != "completed":
+    job = job_store.get(job_id)
+    if job is None or job["status"] != "completed":
         raise HTTPException(status_code=404, detail="Book not found or not ready")
     
-    file_path = jobs[job_id].get("file_path")
-    book_title = jobs[job_id].get("book_title", "my_islamic_book")
+    file_path = job.get("file_path")
+    book_title = job.get("book_title", "my_islamic_book")
     
     if not file_path or not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
@@ -201,23 +830,159 @@ async def download_book(job_id: str):
     # Sanitize filename
     safe_title = "".join([c for c in book_title if c.isalpha() or c.isdigit() or c==' ']).rstrip()
     filename = f"{safe_title}.pdf"
+    # Downloads keep a book from expiring (see StorageManager)
+    storage.touch(job_id)
         
     return FileResponse(file_path, filename=filename, media_type="application/pdf")
 
+def cancel_here(job_id: str):
+    """
+    Cancel a job queued or running in this worker and record it.
+    Returns "queued", "running" or None if this worker doesn't have it.
+    """
+    cancelled = scheduler.cancel(job_id)
+    if cancelled is None:
+        return None
+    if job_store.get(job_id).get("pages"):
+        # A page regeneration of a finished book: the book itself stays as it was
+        if cancelled == "queued":
+            job_store.update(job_id, status="completed", progress=100, message="Page regeneration cancelled.")
+    else:
+        job_store.update(job_id, status="cancelled", message="Cancelled")
+    return cancelled
+
+async def cancel_elsewhere(job: dict, timeout: float) -> dict:
+    """
+    Ask the worker running an unfinished job to cancel it, and wait until that
+    worker is done with it (status final, cleanup finished). Returns the job.
+    """
+    if job.get("worker") not in workers.live():
+        # Its worker has stopped: nobody will pick up a request
+        job_store.recover()
+        return job_store.get(job["id"])
+    workers.request_cancel(job["id"])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(WORKER_POLL_SECONDS)
+        job = job_store.get(job["id"])
+        if job["status"] in TERMINAL_STATUSES and not workers.is_running(job["id"]):
+            break
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancel a queued or running job and free the models it was using.
+    """
+    cancelled = cancel_here(job_id)
+    if cancelled is None:
+        job = job_store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job["status"] in TERMINAL_STATUSES:
+            return {"status": job["status"], "job_id": job_id, "note": "Job was not running"}
+        # Queued or running on another worker
+        was = "queued" if job["status"] == "pending" else "running"
+        job = await cancel_elsewhere(job, timeout=10)
+        return {"status": job["status"], "job_id": job_id, "was": was}
+
+    status = "completed" if job_store.get(job_id).get("pages") else "cancelled"
+    return {"status": status, "job_id": job_id, "was": cancelled}
+
+@app.post("/jobs/{job_id}/pages/{number}/regenerate")
+async def regenerate_page(
+    job_id: str,
+    number: int,
+    image: Annotated[bool, Form()] = True,
+    text: Annotated[bool, Form()] = False
+):
+    """
+    Regenerate page `number` (1-based) of a completed book: its illustration, its text, or both.
+    Progress is reported on /events/{job_id} like a regular job.
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "completed" or not job.get("pages"):
+        raise HTTPException(status_code=409, detail="Only completed books can be edited")
+    if not 1 <= number <= len(job["pages"]):
+        raise HTTPException(status_code=404, detail="Page not found")
+    if not (image or text):
+        raise HTTPException(status_code=422, detail="Nothing to regenerate")
+
+    try:
+        scheduler.submit(
+            job_id,
+            lambda cancel_event: process_page_regeneration(job_id, number, text, image, cancel_event),
+            priority=job.get("priority", "normal")
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    # The book itself is still complete: a restart mid-regeneration puts it back as it was
+    job_store.update(job_id, status="processing", progress=0, message=f"Regenerating page {number}...",
+                     restore={"status": "completed", "progress": 100, "message": f"Regeneration of page {number} was interrupted."})
+
+    return {"job_id": job_id, "status": "submitted", "queue_position": scheduler.position(job_id)}
+
+@app.get("/jobs/{job_id}/pages/{number}/thumbnail")
+async def get_page_thumbnail(job_id: str, number: int):
+    """
+    WebP preview of page `number` (1-based) once it has been illustrated.
+    """
+    thumbnail_path = page_thumbnail(parts_dir(pdf_generator.output_dir, job_id), number)
+    if not os.path.exists(thumbnail_path):
+        raise HTTPException(status_code=404, detail="Page not ready")
+    return FileResponse(thumbnail_path, media_type="image/webp")
+
+@app.get("/jobs/{job_id}/draft")
+async def download_draft(job_id: str):
+    """
+    PDF of the pages finished so far (the full book once the job has completed).
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == "completed" and job.get("file_path") and os.path.exists(job["file_path"]):
+        return FileResponse(job["file_path"], filename="draft.pdf", media_type="application/pdf")
+
+    directory = parts_dir(pdf_generator.output_dir, job_id)
+    draft_path = os.path.join(directory, f"draft_{uuid.uuid4().hex}.pdf")
+    pages_ready = await asyncio.to_thread(build_draft, directory, draft_path) if os.path.isdir(directory) else 0
+    if not os.path.exists(draft_path):
+        raise HTTPException(status_code=404, detail="No pages finished yet")
+    return FileResponse(
+        draft_path, filename="draft.pdf", media_type="application/pdf",
+        headers={"X-Pages-Ready": str(pages_ready)},
+        background=BackgroundTask(os.remove, draft_path)
+    )
+
 # --- Source File Management ---
 
+@app.get("/storage")
+async def storage_status():
+    """
+    Indexed disk usage and the report of the last sweep.
+    """
+    return storage.status()
+
+@app.post("/storage/sweep")
+async def sweep_storage():
+    """
+    Run a sweep now and return what it reclaimed.
+    """
+    return await storage.sweep_async(job_store.unfinished())
+
 @app.get("/source_files/{filename}")
 async def download_source_file(filename: str):
-    file_path = f"source_files/{filename}"
-    if not os.path.exists(file_path):
+    file_path = source_store.resolve(filename)
+    if file_path is None:
         raise HTTPException(status_code=404, detail="Source file not found")
+    source_store.touch(filename)
     return FileResponse(file_path, filename=filename)
 
 @app.delete("/source_files/{filename}")
 async def delete_source_file(filename: str):
-    file_path = f"source_files/{filename}"
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    if source_store.remove(filename) is not None:
         return {"status": "deleted", "file": filename}
     raise HTTPException(status_code=404, detail="Source file not found")
 
@@ -225,35 +990,62 @@ async def delete_source_file(filename: str):
 
 @app.delete("/books/{job_id}")
 async def delete_book(job_id: str):
+    # 0. Stop the job if it is still queued or running, here or on another worker
+    if cancel_here(job_id) is not None:
+        # Let the pipeline unwind and write its manifest before cleaning up
+        await scheduler.wait(job_id, timeout=30)
+    else:
+        job = job_store.get(job_id)
+        if job is not None and job["status"] not in TERMINAL_STATUSES:
+            await cancel_elsewhere(job, timeout=30)
+
+    try:
+        removed = remove_book_files(job_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error cleaning up book: {str(e)}")
+    if removed and job_store.get(job_id) is not None:
+        # Nothing left to download or edit, whatever a job still unwinding reports
+        job_store.update(job_id, status="deleted", message="Book deleted", result_url=None)
+    if removed == "manifest":
+        return {"status": "deleted", "job_id": job_id}
+    if removed == "pdf":
+        return {"status": "deleted", "job_id": job_id, "note": "Manifest not found, deleted PDF only"}
+    raise HTTPException(status_code=404, detail="Book resources not found")
+
+def remove_book_files(job_id: str):
+    """
+    Delete everything a book left on disk, as listed in its manifest.
+    Returns "manifest", "pdf" (no manifest, only the PDF was found) or None.
+    """
     # 1. Try to find manifest
     manifest_path = f"generated_books/manifest_{job_id}.json"
+    storage.forget_book(job_id)
     
     if os.path.exists(manifest_path):
-        try:
-            with open(manifest_path, "r") as f:
-                manifest = json.load(f)
-            
-            # Delete PDF
-            pdf_path = manifest.get("pdf_path")
-            if pdf_path and os.path.exists(pdf_path):
-                os.remove(pdf_path)
-                
-            # Delete Images
-            for img_path in manifest.get("images", []):
-                if img_path and os.path.exists(img_path):
-                    os.remove(img_path)
-            
-            # Delete Manifest
-            os.remove(manifest_path)
-            
-            return {"status": "deleted", "job_id": job_id}
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error cleaning up book: {str(e)}")
-    else:
-        # Fallback: Try to find just the PDF if manifest missing
-        pdf_path = f"generated_books/book_{job_id}.pdf"
-        if os.path.exists(pdf_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        
+        # Delete PDF
+        pdf_path = manifest.get("pdf_path")
+        if pdf_path and os.path.exists(pdf_path):
             os.remove(pdf_path)
-            return {"status": "deleted", "job_id": job_id, "note": "Manifest not found, deleted PDF only"}
             
-        raise HTTPException(status_code=404, detail="Book resources not found")
+        # Delete Images
+        for img_path in manifest.get("images", []):
+            release_image(img_path)
+        
+        # Delete per-page renders and thumbnails
+        if manifest.get("parts_dir"):
+            shutil.rmtree(manifest["parts_dir"], ignore_errors=True)
+
+        # Delete Manifest
+        os.remove(manifest_path)
+        return "manifest"
+
+    # Fallback: Try to find just the PDF if manifest missing
+    pdf_path = f"generated_books/book_{job_id}.pdf"
+    shutil.rmtree(parts_dir(pdf_generator.output_dir, job_id), ignore_errors=True)
+    if os.path.exists(pdf_path):
+        os.remove(pdf_path)
+        return "pdf"
+    return None
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# How long a freshly written or served image is kept for the book that is about to acquire it
+DEFAULT_PIN_SECONDS = 600
+
+class ImageCache:
+    """
+    Content-addressed store for seeded illustrations.
+
+    An image is keyed by sha256(model, prompt, seed, steps, size), so the same
+    style prompt renders once and is then served from <cache_dir>/<key>.png.
+    Metadata lives in SQLite (<cache_dir>/index.db) so the API process and the
+    model server can share one cache.
+
+    Books hold references: acquire(path) when a page takes a cached image,
+    release(path) when the book is deleted. Once the cache is over max_bytes,
+    unreferenced images are evicted least-recently-used; referenced ones stay.
+    Images put or served within the last pin_seconds are not evicted either:
+    they are on their way to a book (possibly in another process) that has not
+    acquired them yet.
+    """
+    def __init__(self, cache_dir: str = "cache/images", max_bytes: int = None, pin_seconds: float = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes or int(os.environ.get("ICBG_IMAGE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.pin_seconds = pin_seconds if pin_seconds is not None else float(os.environ.get("ICBG_IMAGE_CACHE_PIN_SECONDS", DEFAULT_PIN_SECONDS))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "index.db"), check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    key TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    refs INTEGER NOT NULL DEFAULT 0,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_last_used ON images(last_used)")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_id: str, prompt: str, seed: int, steps: int, width: int, height: int) -> str:
+        return hashlib.sha256(f"{model_id}\0{prompt}\0{seed}\0{steps}\0{width}x{height}".encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def owns(self, path: str) -> bool:
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.cache_dir)
+
+    def get(self, key: str):
+        """
+        Path of the cached image, or None.
+        """
+        path = self.path(key)
+        with self._lock:
+            found = self._conn.execute("UPDATE images SET last_used = ? WHERE key = ?", (time.time(), key)).rowcount
+        if found and os.path.exists(path):
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def put(self, key: str, image) -> str:
+        """
+        Save a PIL image under its key and evict old entries if over budget.
+        """
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO images (key, bytes, last_used) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET bytes = excluded.bytes, last_used = excluded.last_used",
+                (key, os.path.getsize(path), time.time())
+            )
+        self._evict()
+        return path
+
+    def _key_for(self, path: str) -> str:
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def acquire(self, path: str):
+        """
+        Take a reference for a book that uses this cached image.
+        """
+        if not self.owns(path):
+            return
+        with self._lock:
+            self._conn.execute("UPDATE images SET refs = refs + 1 WHERE key = ?", (self._key_for(path),))
+
+    def release(self, path: str):
+        """
+        Drop a book's reference. The file stays cached until evicted.
+        """
+        if not self.owns(path):
+            return
+        with self._lock:
+            self._conn.execute("UPDATE images SET refs = MAX(0, refs - 1) WHERE key = ?", (self._key_for(path),))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM images").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            pinned_after = time.time() - self.pin_seconds
+            candidates = self._conn.execute(
+                "SELECT key, bytes FROM images WHERE refs = 0 AND last_used < ? ORDER BY last_used", (pinned_after,)
+            ).fetchall()
+            for key, size in candidates:
+                if total <= self.max_bytes:
+                    break
+                # Re-checked here: another process may have acquired or served it since
+                deleted = self._conn.execute(
+                    "DELETE FROM images WHERE key = ? AND refs = 0 AND last_used < ?", (key, pinned_after)
+                ).rowcount
+                if not deleted:
+                    continue
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+                total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, total, referenced = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(refs > 0), 0) FROM images"
+            ).fetchone()
+        return {"images": count, "bytes": total, "referenced": referenced,
+                "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
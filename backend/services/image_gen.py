@@ -1,48 +1,303 @@
-from diffusers import AutoPipelineForText2Image
+from diffusers import AutoPipelineForText2Image, AutoencoderTiny
 import torch
+import gc
 import os
+import time
 import uuid
+from services.inference import inference_executor
+from services.model_lifecycle import ModelLifecycle
+from services.residency import model_residency, module_bytes
+from services.image_cache import ImageCache
+from services.metrics import metrics, diffusion_seconds, images_total
+
+# Rough peak memory for one 512x512 SD-Turbo image inside a batch (UNet activations + VAE decode)
+BYTES_PER_IMAGE_FP32 = 1536 * 1024 * 1024
+BYTES_PER_IMAGE_FP16 = 768 * 1024 * 1024
+
+# Approximate size of the SD-Turbo weights (UNet + text encoder + VAE), until measured
+EXPECTED_BYTES_FP32 = 5_200_000_000
+EXPECTED_BYTES_FP16 = 2_600_000_000
+
+# Quality/speed profiles (ICBG_IMAGE_PROFILE). The PDF draws illustrations into a 4:3
+# box, so a square 512x512 render is letterboxed and mostly downsampled anyway:
+#   quality   SD-Turbo's native 512x512 with the full VAE (the reference)
+#   balanced  512x384 (4:3, 25% fewer latents), full VAE
+#   fast      384x288 (4:3, 58% fewer latents) decoded by the tiny TAESD VAE
+# Images are stored at the size they were rendered; the PDF scales them into place.
+IMAGE_PROFILES = {
+    "quality": {"width": 512, "height": 512, "tiny_vae": False},
+    "balanced": {"width": 512, "height": 384, "tiny_vae": False},
+    "fast": {"width": 384, "height": 288, "tiny_vae": True},
+}
+
+# Lightweight latent decoder for SD 1.x/2.x latents, used by profiles with tiny_vae
+TINY_VAE_MODEL = os.environ.get("ICBG_TINY_VAE_MODEL", "madebyollin/taesd")
+
+image_seconds = metrics.histogram("icbg_image_seconds", "Diffusion time per image (batch time / batch size), by profile.")
+
+def _available_memory(device: str) -> int:
+    """
+    Best-effort estimate of memory available for a diffusion batch, in bytes.
+    """
+    if device == "mps":
+        try:
+            return torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory()
+        except Exception:
+            pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+def _is_oom(error: Exception) -> bool:
+    if isinstance(error, MemoryError):
+        return True
+    oom_type = getattr(torch, "OutOfMemoryError", None)
+    if oom_type is not None and isinstance(error, oom_type):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
 
 class ImageEngine:
-    def __init__(self):
-        print("Loading Image Generation model...")
+    def __init__(self, executor=None, cache=None, profile: str = None):
+        self.executor = executor or inference_executor
         self.model_id = "stabilityai/sd-turbo"
-        
+
         # Determine device
         self.device = "mps" if torch.backends.mps.is_available() else "cpu"
         print(f"Using device: {self.device}")
-        
-        try:
-            self.pipe = AutoPipelineForText2Image.from_pretrained(
-                self.model_id, 
-                torch_dtype=torch.float16 if self.device == "mps" else torch.float32, 
-                variant="fp16" if self.device == "mps" else None
-            )
-            self.pipe.to(self.device)
-            print("Image Gen model loaded successfully.")
-        except Exception as e:
-            print(f"Failed to load Image Gen model: {e}")
-            self.pipe = None
-            
+
+        self.profile = (profile or os.environ.get("ICBG_IMAGE_PROFILE", "quality")).lower()
+        if self.profile not in IMAGE_PROFILES:
+            print(f"Unknown image profile '{self.profile}', using quality.")
+            self.profile = "quality"
+        settings = IMAGE_PROFILES[self.profile]
+        # CPU options: bfloat16 weights (needs AVX512-BF16/AMX to pay off) and channels-last UNet/VAE
+        self.cpu_bf16 = self.device == "cpu" and os.environ.get("ICBG_IMAGE_BF16") == "1"
+        self.channels_last = os.environ.get("ICBG_IMAGE_CHANNELS_LAST") == "1"
+        self.half = self.device == "mps" or self.cpu_bf16
+
+        # Loaded on first use or by lifecycle.start(), not here
+        self.pipe = None
+        self.lifecycle = ModelLifecycle(
+            "image", self.executor, self._load_models, self._unload_models, self._warm_up,
+            expected_bytes=EXPECTED_BYTES_FP16 if self.half else EXPECTED_BYTES_FP32,
+            measure=self._model_bytes, residency=model_residency
+        )
+
         self.output_dir = "generated_images"
         os.makedirs(self.output_dir, exist_ok=True)
 
-    async def generate_image(self, prompt: str) -> str:
-        if not self.pipe:
-            print("Image Gen model not loaded, skipping.")
-            return ""
+        # SD-Turbo needs only 1-4 steps
+        self.steps = 1
+        self.width = settings["width"]
+        self.height = settings["height"]
+        self.tiny_vae = settings["tiny_vae"]
 
-        try:
-            # Generate image
-            # SD-Turbo needs only 1-4 steps
-            image = self.pipe(prompt=prompt, num_inference_steps=1, guidance_scale=0.0).images[0]
-            
-            # Save to file
+        # Opt-in seeded mode: identical prompts render identical images, served from a content-addressed cache
+        seed = os.environ.get("ICBG_IMAGE_SEED")
+        self.seed = int(seed) if seed else None
+        self.cache = (cache or ImageCache()) if self.seed is not None else None
+
+        # Upper bound for auto-tuned batches. Lowered permanently when a batch runs out of memory.
+        self.max_batch_size = int(os.environ.get("ICBG_IMAGE_MAX_BATCH", "8"))
+        # Activation memory scales with the number of latents
+        pixels = (self.width * self.height) / (512 * 512)
+        self.bytes_per_image = int((BYTES_PER_IMAGE_FP16 if self.half else BYTES_PER_IMAGE_FP32) * pixels)
+        print(f"Image profile: {self.describe_profile()}")
+
+    def describe_profile(self) -> dict:
+        return {
+            "profile": self.profile,
+            "size": f"{self.width}x{self.height}",
+            "tiny_vae": self.tiny_vae,
+            "dtype": "bfloat16" if self.cpu_bf16 else ("float16" if self.device == "mps" else "float32"),
+            "channels_last": self.channels_last
+        }
+
+    def _load_models(self):
+        """
+        Load the diffusion pipeline. Runs on the image lane.
+        """
+        dtype = torch.float16 if self.device == "mps" else (torch.bfloat16 if self.cpu_bf16 else torch.float32)
+        self.pipe = AutoPipelineForText2Image.from_pretrained(
+            self.model_id,
+            torch_dtype=dtype,
+            variant="fp16" if self.half else None
+        )
+        self._apply_profile(dtype)
+        self.pipe.to(self.device)
+        print("Image Gen model loaded successfully.")
+
+    def _apply_profile(self, dtype):
+        if self.tiny_vae:
+            try:
+                self.pipe.vae = AutoencoderTiny.from_pretrained(TINY_VAE_MODEL, torch_dtype=dtype)
+                print(f"Decoding latents with {TINY_VAE_MODEL}.")
+            except Exception as e:
+                print(f"Failed to load tiny VAE, keeping the full decoder: {e}")
+                self.tiny_vae = False
+        if self.channels_last:
+            self.pipe.unet.to(memory_format=torch.channels_last)
+            self.pipe.vae.to(memory_format=torch.channels_last)
+
+    def _unload_models(self):
+        self.pipe = None
+        gc.collect()
+        self._release_cache()
+
+    def _model_bytes(self) -> int:
+        return sum(module_bytes(c) for c in self.pipe.components.values() if isinstance(c, torch.nn.Module))
+
+    def _warm_up(self):
+        # One small single-step image initializes the UNet and VAE kernels
+        self.pipe(prompt="warmup", num_inference_steps=1, guidance_scale=0.0, height=self.height, width=self.width)
+
+    def _auto_batch_size(self, remaining: int) -> int:
+        """
+        Pick the largest batch that fits in ~80% of the currently available memory.
+        """
+        available = _available_memory(self.device)
+        fits = int(available * 0.8) // self.bytes_per_image if available else 1
+        return max(1, min(remaining, self.max_batch_size, fits))
+
+    def _cache_key(self, prompt: str, variation: int = 0) -> str:
+        # Decoder and dtype change the pixels too
+        model = self.model_id
+        if self.tiny_vae:
+            model += "+taesd"
+        if self.cpu_bf16:
+            model += "+bf16"
+        return ImageCache.key(model, prompt, self.seed + variation, self.steps, self.width, self.height)
+
+    def _render_batch(self, prompts: list, cancel_event=None, variation: int = 0) -> list:
+        """
+        Blocking diffusion call over a batch of prompts + PNG saves. Runs on the inference executor.
+        Returns (path, PIL image) per prompt.
+        """
+        def interrupt_on_cancel(pipe, step, timestep, callback_kwargs):
+            if cancel_event is not None and cancel_event.is_set():
+                pipe._interrupt = True
+            return callback_kwargs
+
+        generator = None
+        if self.seed is not None:
+            # One generator per image so each result is independent of the batch it ran in
+            generator = [torch.Generator(device="cpu").manual_seed(self.seed + variation) for _ in prompts]
+
+        images = self.pipe(
+            prompt=prompts,
+            num_inference_steps=self.steps,
+            guidance_scale=0.0,
+            height=self.height,
+            width=self.width,
+            generator=generator,
+            callback_on_step_end=interrupt_on_cancel
+        ).images
+        if cancel_event is not None and cancel_event.is_set():
+            return [("", None) for _ in prompts]
+
+        rendered = []
+        for prompt, image in zip(prompts, images):
+            if self.cache is not None:
+                rendered.append((self.cache.put(self._cache_key(prompt, variation), image), image))
+                continue
             filename = f"{uuid.uuid4()}.png"
             filepath = os.path.join(self.output_dir, filename)
             image.save(filepath)
-            
-            return filepath
-        except Exception as e:
-            print(f"Error generating image: {e}")
-            return ""
+            rendered.append((filepath, image))
+        return rendered
+
+    def _release_cache(self):
+        if self.device == "mps":
+            torch.mps.empty_cache()
+
+    async def generate_images(self, prompts: list, batch_size: int = None, on_image=None, cancel_event=None,
+                              variation: int = 0) -> list:
+        """
+        Generate one image per prompt, running the pipeline over batches of prompts.
+
+        If batch_size is None it is tuned to the available memory. A batch that runs
+        out of memory is retried at half the size. on_image(index, path, image) is
+        called as each image becomes available, with the PIL image so callers don't
+        have to read the file back (None for cache hits). Failed images are returned as "".
+        Setting cancel_event skips the remaining batches. Waits for the model to
+        finish loading first. In seeded mode cached images are returned without
+        touching the model, and `variation` shifts the seed to get a different image
+        for the same prompt.
+        """
+        results = ["" for _ in prompts]
+        pending = list(range(len(prompts)))
+        if self.cache is not None:
+            pending = []
+            for index, prompt in enumerate(prompts):
+                path = self.cache.get(self._cache_key(prompt, variation))
+                if path:
+                    results[index] = path
+                    images_total.inc(source="cache")
+                    if on_image:
+                        on_image(index, path, None)
+                else:
+                    pending.append(index)
+            if not pending:
+                return results
+
+        def on_rendered(j, path, image):
+            if on_image:
+                on_image(pending[j], path, image)
+
+        async with self.lifecycle.use():
+            rendered = await self._generate_batches([prompts[i] for i in pending], batch_size, on_rendered, cancel_event, variation)
+        for j, path in enumerate(rendered):
+            results[pending[j]] = path
+        return results
+
+    async def _generate_batches(self, prompts: list, batch_size: int = None, on_image=None, cancel_event=None,
+                                variation: int = 0) -> list:
+        results = ["" for _ in prompts]
+        if not self.pipe:
+            print("Image Gen model not loaded, skipping.")
+            return results
+
+        i = 0
+        while i < len(prompts):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            remaining = len(prompts) - i
+            size = min(batch_size or self._auto_batch_size(remaining), self.max_batch_size, remaining)
+            batch = prompts[i:i + size]
+            try:
+                started = time.perf_counter()
+                rendered = await self.executor.run("image", self._render_batch, batch, cancel_event, variation)
+                elapsed = time.perf_counter() - started
+                diffusion_seconds.observe(elapsed, batch_size=len(batch))
+                image_seconds.observe(elapsed / len(batch), profile=self.profile)
+                images_total.inc(sum(1 for path, _ in rendered if path), source="model")
+            except Exception as e:
+                if _is_oom(e) and size > 1:
+                    self._release_cache()
+                    self.max_batch_size = max(1, size // 2)
+                    if batch_size:
+                        batch_size = self.max_batch_size
+                    print(f"Out of memory with batch of {size}, retrying with {self.max_batch_size}.")
+                    continue
+                print(f"Error generating images: {e}")
+                rendered = [("", None) for _ in batch]
+
+            for j, (path, image) in enumerate(rendered):
+                results[i + j] = path
+                if on_image:
+                    on_image(i + j, path, image)
+            i += len(batch)
+
+        return results
+
+    async def generate_image(self, prompt: str) -> str:
+        results = await self.generate_images([prompt], batch_size=1)
+        return results[0]
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import threading
+
+class InferenceExecutor:
+    """
+    Runs blocking model inference off the event loop.
+
+    Work is submitted to named lanes ("llm", "image", ...). Each lane is a single
+    worker thread that owns one pipeline, so calls into the same model are
+    serialized while different models run side by side. PyTorch releases the GIL
+    during kernels, which is why threads are enough here.
+    """
+    def __init__(self, workers_per_lane: int = 1):
+        self.workers_per_lane = workers_per_lane
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def _get_lane(self, lane: str) -> ThreadPoolExecutor:
+        with self._lock:
+            executor = self._lanes.get(lane)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=self.workers_per_lane,
+                    thread_name_prefix=f"inference-{lane}"
+                )
+                self._lanes[lane] = executor
+            return executor
+
+    def submit(self, lane: str, fn, *args, **kwargs):
+        """
+        Submit a blocking call to a lane and return a concurrent.futures.Future.
+        """
+        return self._get_lane(lane).submit(fn, *args, **kwargs)
+
+    async def run(self, lane: str, fn, *args, **kwargs):
+        """
+        Run a blocking call on a lane and await its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_lane(lane), functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            lanes = list(self._lanes.values())
+            self._lanes = {}
+        for executor in lanes:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+# Shared by all engines in this process
+inference_executor = InferenceExecutor()
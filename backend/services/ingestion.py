@@ -1,54 +1,189 @@
 import fitz  # PyMuPDF
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from typing import Optional
+import asyncio
+import multiprocessing
+import os
+import threading
+from services.page_cache import PageTextCache, hash_file
+from services.retrieval import BM25Index, IndexCache, chunk_pages, join_chunks, CHARS_PER_TOKEN
+
+# Size of the source excerpt handed to the LLM (~2000 characters)
+SOURCE_TOKEN_BUDGET = int(os.environ.get("ICBG_SOURCE_TOKEN_BUDGET", "500"))
+
+# Ranges with at least this many uncached pages are extracted by a process pool
+PARALLEL_MIN_PAGES = int(os.environ.get("ICBG_INGEST_PARALLEL_MIN_PAGES", "64"))
+# Pages per worker task; also the granularity at which results stream back
+CHUNK_PAGES = 32
+# How many chunks may be extracted ahead of the consumer (bounds memory)
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _worker_count() -> int:
+    return int(os.environ.get("ICBG_INGEST_WORKERS", "0")) or os.cpu_count() or 1
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a process that already runs torch threads can deadlock
+            _pool = ProcessPoolExecutor(max_workers=_worker_count(), mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def _extract_chunk(file_path: str, page_nums: list) -> list:
+    """
+    Worker process entry point: extract [(page_num, text)] for the given pages.
+    """
+    doc = fitz.open(file_path)
+    try:
+        return [(page_num, doc[page_num].get_text()) for page_num in page_nums]
+    finally:
+        doc.close()
 
 class DocumentIngestionService:
-    def __init__(self):
-        pass
+    def __init__(self, page_cache: PageTextCache = None):
+        self.page_cache = page_cache or PageTextCache()
+        self.index_cache = IndexCache()
 
     async def ingest_pdf(
-        self, 
+        self,
         file_path: str,
         section_description: str = "",
         additional_context: str = "",
         page_start: Optional[int] = None,
-        page_end: Optional[int] = None
+        page_end: Optional[int] = None,
+        token_budget: int = SOURCE_TOKEN_BUDGET,
+        doc_id: Optional[str] = None
     ) -> str:
         """
-        Extract text from PDF with optional section filtering.
+        Extract a source excerpt from the PDF that fits in token_budget.
+
+        With a section description or additional context, the page range is
+        chunked and the chunks most relevant to them (BM25) are selected.
+        Otherwise the leading text of the range is used. Page text is served
+        from the content-addressed page cache when possible. Callers that already
+        know the file's content hash pass it as doc_id to skip hashing.
         """
         try:
-            doc = fitz.open(file_path)
-            total_pages = len(doc)
-            
-            # Determine page range
-            start_idx = 0
-            end_idx = total_pages
-            
-            if page_start is not None:
-                start_idx = max(0, page_start - 1)  # Convert to 0-indexed
-            if page_end is not None:
-                end_idx = min(total_pages, page_end)
-            
-            # Extract text from specified page range
-            extracted_text = ""
-            for page_num in range(start_idx, end_idx):
-                if page_num < total_pages:
-                    page = doc[page_num]
-                    extracted_text += page.get_text() + "\n"
-            
-            doc.close()
-            
+            header = ""
             # Prepend context if provided
             if section_description:
-                extracted_text = f"FOCUS SECTION: {section_description}\nCONTEXT: {additional_context}\n\nDOCUMENT CONTENT:\n{extracted_text}"
-            
-            return extracted_text.strip()
-            
+                header = f"FOCUS SECTION: {section_description}\nCONTEXT: {additional_context}\n\nDOCUMENT CONTENT:\n"
+            char_budget = max(0, token_budget * CHARS_PER_TOKEN - len(header))
+            query = f"{section_description or ''} {additional_context or ''}"
+
+            # Hashing and extraction block, keep them off the event loop
+            extracted_text = await asyncio.to_thread(self._read_excerpt, file_path, page_start, page_end, query, char_budget, doc_id)
+
+            return f"{header}{extracted_text}".strip()
+
         except Exception as e:
             print(f"Error extracting PDF: {e}")
             return ""
 
+    def _read_excerpt(self, file_path: str, page_start: Optional[int], page_end: Optional[int], query: str, char_budget: int,
+                      doc_id: Optional[str] = None) -> str:
+        doc_id = doc_id or hash_file(file_path)
+
+        if not query.strip():
+            # No focus given: the start of the range is what we would keep anyway,
+            # so read pages one chunk at a time and stop once the budget is covered
+            parts = []
+            size = 0
+            for _, text in self.iter_pages(file_path, doc_id, page_start, page_end, parallel=False):
+                parts.append(text + "\n")
+                size += len(text) + 1
+                if size >= char_budget:
+                    break
+            return "".join(parts)[:char_budget]
+
+        index = self.index_cache.get_or_build(
+            (doc_id, page_start, page_end),
+            lambda: BM25Index(chunk_pages(self.iter_pages(file_path, doc_id, page_start, page_end)))
+        )
+        return join_chunks(index.select(query, char_budget))
+
+    def iter_pages(self, file_path: str, doc_id: str, page_start: Optional[int] = None, page_end: Optional[int] = None,
+                   parallel: bool = True):
+        """
+        Yield (page_num, text) for the requested 1-indexed range, in order.
+
+        Cached pages are read from the page cache; the rest are extracted with
+        PyMuPDF (in parallel for large ranges) and cached as they stream in.
+        Only a bounded window of pages is held in memory at a time. Callers that
+        may stop early pass parallel=False, so no chunk is extracted ahead of
+        what they read.
+        """
+        total_pages = self.page_cache.page_count(doc_id)
+        if total_pages is None:
+            with fitz.open(file_path) as doc:
+                total_pages = len(doc)
+
+        # Determine page range
+        start_idx = 0
+        end_idx = total_pages
+
+        if page_start is not None:
+            start_idx = max(0, page_start - 1)  # Convert to 0-indexed
+        if page_end is not None:
+            end_idx = min(total_pages, page_end)
+
+        missing = self.page_cache.missing_pages(doc_id, start_idx, end_idx)
+        missing_set = set(missing)
+        extracted = self._stream_extract(file_path, doc_id, total_pages, missing, parallel)
+
+        for window_start in range(start_idx, end_idx, CHUNK_PAGES):
+            window = range(window_start, min(end_idx, window_start + CHUNK_PAGES))
+            cached = {}
+            if any(page_num not in missing_set for page_num in window):
+                cached, gone = self.page_cache.get_pages(doc_id, window.start, window.stop)
+                gone = [page_num for page_num in gone if page_num not in missing_set]
+                if gone:
+                    # Evicted since missing_pages() looked: extract them again
+                    results = _extract_chunk(file_path, gone)
+                    self.page_cache.put_pages(doc_id, total_pages, dict(results))
+                    cached.update(results)
+            for page_num in window:
+                if page_num in missing_set:
+                    # The extraction stream yields missing pages in the same order
+                    _, text = next(extracted)
+                else:
+                    text = cached[page_num]
+                yield page_num, text
+
+    def _stream_extract(self, file_path: str, doc_id: str, total_pages: int, page_nums: list, parallel: bool = True):
+        """
+        Yield (page_num, text) for page_nums in order, caching each chunk as it completes.
+        """
+        chunks = [page_nums[i:i + CHUNK_PAGES] for i in range(0, len(page_nums), CHUNK_PAGES)]
+
+        if not parallel or len(page_nums) < PARALLEL_MIN_PAGES:
+            for chunk in chunks:
+                results = _extract_chunk(file_path, chunk)
+                self.page_cache.put_pages(doc_id, total_pages, dict(results))
+                yield from results
+            return
+
+        pool = _get_pool()
+        max_in_flight = _worker_count() * CHUNKS_IN_FLIGHT_PER_WORKER
+        pending = deque()
+        next_chunk = 0
+        try:
+            while next_chunk < len(chunks) or pending:
+                while next_chunk < len(chunks) and len(pending) < max_in_flight:
+                    pending.append(pool.submit(_extract_chunk, file_path, chunks[next_chunk]))
+                    next_chunk += 1
+                results = pending.popleft().result()
+                self.page_cache.put_pages(doc_id, total_pages, dict(results))
+                yield from results
+        finally:
+            # The consumer stopped early: drop chunks no worker has started yet
+            for future in pending:
+                future.cancel()
+
     async def ingest_web(self, url: str) -> str:
         # Placeholder for web ingestion
         return ""
-
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled", "deleted")
+
+# Columns with their own index; every other job field lives in the JSON data column
+COLUMNS = ("status", "progress", "message")
+
+class JobStore:
+    """
+    Durable job records in SQLite with an in-process publish/subscribe.
+
+    Active jobs are kept in a write-through memory cache. Every update bumps the
+    job's version and wakes its subscribers, so SSE watchers sleep until
+    something actually changes instead of polling. Jobs that were still running
+    when the process stopped are marked failed on startup, or put back into the
+    state saved in their "restore" field.
+
+    With a WorkerRegistry the database is shared by several API workers. Each
+    unfinished job records the worker running it, and only that worker writes
+    it. Watchers on other workers re-read such a job every poll_seconds, and
+    recover() only touches the jobs of workers that are gone.
+    """
+    def __init__(self, db_path: str = None, workers=None, poll_seconds: float = None):
+        self.db_path = db_path or os.environ.get("ICBG_JOB_DB", "jobs.db")
+        self.workers = workers
+        self.poll_seconds = poll_seconds or float(os.environ.get("ICBG_JOB_POLL_SECONDS", "1"))
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    progress INTEGER NOT NULL DEFAULT 0,
+                    message TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    data TEXT NOT NULL DEFAULT '{}'
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at)")
+
+        self._active = {}
+        self._versions = {}
+        self._changed = {}
+        self._payloads = {}
+        self._loop = None
+        self._listeners = []
+        self.recover()
+
+    def recover(self) -> int:
+        """
+        Mark the unfinished jobs of stopped processes failed, or put them back into
+        the state saved in their "restore" field. Without a WorkerRegistry that is
+        every unfinished job (run once at startup); with one, those of workers that
+        are gone, which each worker checks again as it heartbeats.
+        """
+        live = self.workers.live() if self.workers is not None else set()
+        recovered = 0
+        with self._db_lock:
+            for job in self._unfinished_locked():
+                if job.get("worker") in live:
+                    continue
+                # A job may name the state to return to instead, e.g. a finished book whose page was being redone
+                restore = job.pop("restore", None) or {"status": "failed", "message": "Interrupted by server restart"}
+                job.update(restore, updated_at=time.time())
+                self._write_locked(job)
+                recovered += 1
+        if recovered:
+            print(f"Recovered {recovered} interrupted job(s).")
+        return recovered
+
+    # --- Persistence ---
+
+    def _write(self, job: dict):
+        with self._db_lock:
+            self._write_locked(job)
+
+    def _write_locked(self, job: dict):
+        data = {k: v for k, v in job.items() if k not in COLUMNS and k not in ("id", "created_at", "updated_at")}
+        self._conn.execute(
+            "INSERT OR REPLACE INTO jobs (id, status, progress, message, created_at, updated_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job["id"], job["status"], job.get("progress", 0), job.get("message"),
+             job["created_at"], job["updated_at"], json.dumps(data, default=str))
+        )
+
+    @staticmethod
+    def _from_row(row) -> dict:
+        job = json.loads(row[6])
+        job.update({
+            "id": row[0], "status": row[1], "progress": row[2], "message": row[3],
+            "created_at": row[4], "updated_at": row[5]
+        })
+        return job
+
+    def _unfinished_locked(self) -> list:
+        rows = self._conn.execute(
+            "SELECT * FROM jobs WHERE status NOT IN (%s)" % ",".join("?" for _ in TERMINAL_STATUSES),
+            TERMINAL_STATUSES
+        ).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def create(self, job_id: str, **fields) -> dict:
+        now = time.time()
+        job = {"status": "pending", "progress": 0, "message": "Queued", **fields,
+               "id": job_id, "created_at": now, "updated_at": now}
+        if self.workers is not None:
+            job["worker"] = self.workers.worker_id
+        self._write(job)
+        self._active[job_id] = job
+        self._publish(job_id)
+        return dict(job)
+
+    def get(self, job_id: str):
+        """
+        Return a copy of the job record, or None.
+        """
+        job = self._active.get(job_id)
+        if job is not None:
+            return dict(job)
+        with self._db_lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def update(self, job_id: str, **fields):
+        job = self._active.get(job_id) or self.get(job_id)
+        if job is None:
+            return
+        job.update(fields)
+        job["updated_at"] = time.time()
+        if self.workers is not None and job["status"] not in TERMINAL_STATUSES:
+            # Whoever runs a job writes it, e.g. the worker regenerating a page of a finished book
+            job["worker"] = self.workers.worker_id
+        self._write(job)
+        if job["status"] in TERMINAL_STATUSES:
+            self._active.pop(job_id, None)
+        else:
+            self._active[job_id] = job
+        self._publish(job_id)
+        if job["status"] in TERMINAL_STATUSES:
+            # Watchers have been woken and re-read the job; nothing else needs its version
+            self._versions.pop(job_id, None)
+            for key in [k for k in self._payloads if k[0] == job_id]:
+                self._payloads.pop(key, None)
+        for listener in self._listeners:
+            listener(dict(job))
+
+    def active(self) -> list:
+        """
+        Copies of the jobs that have not finished yet in this process, from memory.
+        """
+        return [dict(job) for job in self._active.values()]
+
+    def unfinished(self) -> list:
+        """
+        The jobs that have not finished yet in any worker, from the database.
+        """
+        with self._db_lock:
+            return self._unfinished_locked()
+
+    def add_listener(self, listener):
+        """
+        Call listener(job) after every update, e.g. to roll book progress up into its batch.
+        """
+        self._listeners.append(listener)
+
+    def list(self, status: str = None, limit: int = 50) -> list:
+        with self._db_lock:
+            if status:
+                rows = self._conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit)
+                ).fetchall()
+            else:
+                rows = self._conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    # --- Publish / subscribe ---
+
+    def _publish(self, job_id: str):
+        self._versions[job_id] = self._versions.get(job_id, 0) + 1
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Updated from a worker thread: wake subscribers on their loop
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._wake, job_id)
+            return
+        self._wake(job_id)
+
+    def _wake(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    def snapshot(self, job_id: str, fields: tuple):
+        """
+        JSON for the given fields of a job, serialized once per version and shared by all watchers.
+        Only active jobs are cached; a finished job's payload is built on demand.
+        """
+        version = self._versions.get(job_id, 0)
+        key = (job_id, fields)
+        cached = self._payloads.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        job = self.get(job_id)
+        if job is None:
+            return None
+        payload = json.dumps({field: job.get(field) for field in fields})
+        if job_id in self._active:
+            self._payloads[key] = (version, payload)
+        return payload
+
+    async def subscribe(self, job_id: str, fields: tuple, keepalive: float = 15.0):
+        """
+        Yield a JSON snapshot now and after every change until the job is finished.
+        Yields None when nothing changed for `keepalive` seconds.
+        """
+        self._loop = asyncio.get_running_loop()
+        last = None
+        quiet_since = time.monotonic()
+        while True:
+            # Register for the next change before reading, so an update made while
+            # this generator is suspended at its yield still sets the event
+            event = self._changed.get(job_id)
+            if event is None:
+                event = self._changed[job_id] = asyncio.Event()
+            job = self.get(job_id)
+            if job is None or job["status"] in TERMINAL_STATUSES:
+                self._changed.pop(job_id, None)
+            if job is None:
+                return
+            payload = self.snapshot(job_id, fields)
+            if payload != last:
+                # Updates that don't touch the watched fields are not sent again
+                yield payload
+                last = payload
+                quiet_since = time.monotonic()
+            if job["status"] in TERMINAL_STATUSES:
+                return
+
+            timeout = max(0.0, quiet_since + keepalive - time.monotonic())
+            if job_id not in self._active:
+                # Run by another worker, whose updates don't wake this process: read it again shortly
+                timeout = min(timeout, self.poll_seconds)
+            try:
+                await asyncio.wait_for(event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                if time.monotonic() - quiet_since >= keepalive:
+                    yield None
+                    quiet_since = time.monotonic()
@@ -1,46 +1,121 @@
-from transformers import pipeline
+from transformers import pipeline, AutoModelForCausalLM, TextStreamer, StoppingCriteria, StoppingCriteriaList
 import torch
+import asyncio
+import copy
+import gc
+import os
+import re
+import time
+from services.inference import inference_executor
+from services.model_lifecycle import ModelLifecycle
+from services.residency import model_residency, module_bytes
+from services.metrics import llm_prefill_seconds, llm_decode_seconds, llm_tokens_total
+from services.story_parser import StoryStreamParser, PAGE_BREAK, MAX_PAGES, TITLE_PATTERN, parse_page
 
-class ContentEngine:
-    def __init__(self):
-        print("Loading LLM model...")
-        # Use a small, fast instruction-tuned model
-        self.model_id = "HuggingFaceTB/SmolLM-1.7B-Instruct"
-        
-        # Determine device
-        device = "mps" if torch.backends.mps.is_available() else "cpu"
-        print(f"Using device: {device}")
-        
-        try:
-            self.pipe = pipeline(
-                "text-generation",
-                model=self.model_id,
-                device=device,
-                torch_dtype=torch.float32, # Use float32 for stability on MPS
-                max_new_tokens=2048, # Increased for 10 pages
-            )
-            print("LLM loaded successfully.")
-        except Exception as e:
-            print(f"Failed to load LLM: {e}")
-            self.pipe = None
+# Engine-wide ceiling for generated tokens; jobs may ask for less via params["tokenBudget"]
+MAX_NEW_TOKENS = int(os.environ.get("ICBG_LLM_MAX_NEW_TOKENS", "2048"))
 
-    async def generate_story(self, source_text: str, params: dict) -> dict:
-        if not self.pipe:
-            print("LLM not loaded, returning dummy data.")
-            return {"title": "Error Generating Title", "pages": [{"text": "Error: Model not loaded.", "image_prompt": "Error icon"}]}
+# An image line terminated by a newline means the page is fully written
+PAGE_DONE_PATTERN = re.compile(r"(Image|Description):[^\n]*\S[^\n]*\n")
 
-        theme = params.get("theme", "General Islamic Values")
-        age_group = params.get("ageGroup", "6-8")
-        humor = params.get("humor", 5)
-        
-        # Truncate source text to avoid context window issues (approx 2000 chars)
-        truncated_source = source_text[:2000] + "..." if len(source_text) > 2000 else source_text
+class StoryStoppingCriteria(StoppingCriteria):
+    """
+    Stops decoding as soon as the rest of the output would be thrown away:
+    - the 10th page is complete (page breaks are counted after the title line),
+    - the model closes its turn (<|im_end|>) or starts a new one,
+    - the model starts a second story (another TITLE: line after the first page),
+    - the output degenerates into a repeated token n-gram,
+    - the job was cancelled (cancel_event is set).
+    The reason is kept in self.reason.
+    """
+    def __init__(self, tokenizer, prompt_length: int, max_pages: int = MAX_PAGES,
+                 max_ngram: int = 32, min_repeat_span: int = 48, cancel_event=None):
+        self.tokenizer = tokenizer
+        self.cancel_event = cancel_event
+        self.max_pages = max_pages
+        self.max_ngram = max_ngram
+        self.min_repeat_span = min_repeat_span
+        self.prompt_length = prompt_length
+        self.generated_tokens = 0
+        self.text = ""
+        self.reason = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        new_ids = input_ids[0, self.prompt_length + self.generated_tokens:].tolist()
+        self.generated_tokens = input_ids.shape[1] - self.prompt_length
+        self.text += self.tokenizer.decode(new_ids, skip_special_tokens=False)
+        self.reason = self.reason or self._check(input_ids[0])
+        return torch.full((input_ids.shape[0],), self.reason is not None, dtype=torch.bool, device=input_ids.device)
+
+    def _check(self, ids):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return "cancelled"
+        if "<|im_end|>" in self.text or "<|im_start|>" in self.text:
+            return "end_of_turn"
+
+        breaks = self.text.count(PAGE_BREAK)
+        if breaks >= self.max_pages:
+            return "max_pages"
+        if breaks == self.max_pages - 1:
+            last_section = self.text.rsplit(PAGE_BREAK, 1)[-1]
+            if PAGE_DONE_PATTERN.search(last_section):
+                return "max_pages"
+        if breaks > 0 and TITLE_PATTERN.search(self.text.split(PAGE_BREAK, 1)[1]):
+            return "second_story"
+
+        if self._is_repeating(ids):
+            return "repetition"
+        return None
+
+    def _is_repeating(self, ids) -> bool:
+        """
+        True if the tail of the output is one n-gram repeated back to back over at least min_repeat_span tokens.
+        """
+        tail = ids[-(self.min_repeat_span + self.max_ngram):].tolist()
+        for n in range(1, self.max_ngram + 1):
+            repeats = max(3, -(-self.min_repeat_span // n))
+            span = n * repeats
+            if span > len(tail):
+                break
+            window = tail[-span:]
+            if window == window[:n] * repeats:
+                return True
+        return False
+
+class _PageStreamer(TextStreamer):
+    """
+    Feeds decoded text into a StoryStreamParser and hands off each completed page.
+    """
+    def __init__(self, tokenizer, parser: StoryStreamParser, on_page):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.parser = parser
+        self.on_page = on_page
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        for page in self.parser.feed(text):
+            self.on_page(page)
+
+LLM_BACKENDS = ("fp32", "bf16", "int8")
 
-        prompt = f"""<|im_start|>system
+# Approximate resident size of the 1.7B model per backend, until it has been loaded once and measured
+EXPECTED_BYTES = {"fp32": 6_900_000_000, "bf16": 3_500_000_000, "int8": 2_200_000_000}
+
+# Startup self-check for non-fp32 backends (ICBG_LLM_SELFCHECK=1)
+SELF_CHECK_MIN_AGREEMENT = float(os.environ.get("ICBG_LLM_SELFCHECK_MIN_AGREEMENT", "0.9"))
+SELF_CHECK_MAX_PPL_RATIO = float(os.environ.get("ICBG_LLM_SELFCHECK_MAX_PPL_RATIO", "1.1"))
+SELF_CHECK_TEXT = """TITLE: The Boy Who Spoke Truth
+Page 1 Text: Once upon a time in Medina, a little boy named Yusuf found a lost purse near the market.
+Page 1 Image: A small boy holding a brown purse in a busy market street, warm sunlight.
+---PAGE BREAK---
+Page 2 Text: He remembered that the Prophet taught us to always be honest, even when nobody is watching.
+Page 2 Image: The boy thinking under a palm tree, with a gentle smile.
+"""
+
+# Invariant part of the story prompt. Everything job-specific lives in
+# STORY_PROMPT_SUFFIX so the KV cache for this prefix can be computed once.
+STORY_PROMPT_PREFIX = """<|im_start|>system
 You are a creative children's book author. You write engaging, fact-based stories for Muslim children based on provided source material.
-Your goal is to adapt the source text into a short story suitable for {age_group} year olds.
-The theme is: {theme}.
-Humor level: {humor}/10.
+Your goal is to adapt the source text into a short story suitable for the age group, theme and humor level given by the user.
 
 Output Format:
 1. The VERY FIRST line must be: "TITLE: [Insert Creative Title Here]"
@@ -57,133 +132,376 @@ Page 1 Image: A bright sunny day in Medina...
 Page 2 Text: ...
 <|im_end|>
 <|im_start|>user
+"""
+
+STORY_PROMPT_SUFFIX = """Age group: {age_group} year olds.
+The theme is: {theme}.
+Humor level: {humor}/10.
+
 Source Material:
-{truncated_source}
+{source}
 
 Write the story now.
 <|im_end|>
 <|im_start|>assistant
 """
+
+# Rewriting a single page reuses the story prefix cache; the assistant turn is
+# primed with the page header so the model answers with just that page
+PAGE_REWRITE_SUFFIX = """Age group: {age_group} year olds.
+The theme is: {theme}.
+Humor level: {humor}/10.
+
+Here is the finished story, "{title}":
+{story}
+
+Rewrite only page {number} so it still fits between the pages around it. Give its text and illustration description.
+<|im_end|>
+<|im_start|>assistant
+Page {number} Text:"""
+
+PAGE_MAX_NEW_TOKENS = 256
+
+class ContentEngine:
+    def __init__(self, executor=None):
+        self.executor = executor or inference_executor
+        # Use a small, fast instruction-tuned model
+        self.model_id = "HuggingFaceTB/SmolLM-1.7B-Instruct"
         
+        # Determine device
+        self.device = "mps" if torch.backends.mps.is_available() else "cpu"
+        print(f"Using device: {self.device}")
+
+        # Numeric backend: fp32 (reference), bf16 or int8 (dynamic quantization, CPU only)
+        self.backend = os.environ.get("ICBG_LLM_BACKEND", "fp32").lower()
+        if self.backend not in LLM_BACKENDS:
+            print(f"Unknown LLM backend '{self.backend}', using fp32.")
+            self.backend = "fp32"
+        self.self_check = None
+
+        # Optional small model that drafts tokens for the main model to verify (assisted generation)
+        self.draft_model_id = os.environ.get("ICBG_LLM_DRAFT_MODEL", "")
+        self.draft_model = None
+
+        # Past key/values for STORY_PROMPT_PREFIX, built on first use on the LLM worker
+        self._prefix_ids = None
+        self._prefix_cache = None
+        self.prefix_cache_hits = 0
+
+        # Models are loaded on first use or by lifecycle.start(), not here
+        self.pipe = None
+        self.lifecycle = ModelLifecycle(
+            "llm", self.executor, self._load_models, self._unload_models, self._warm_up,
+            expected_bytes=EXPECTED_BYTES[self.backend], measure=self._model_bytes, residency=model_residency
+        )
+
+    def _load_models(self):
+        """
+        Load the LLM (and the optional draft model). Runs on the LLM lane.
+        """
+        self.pipe = self._load_pipeline(self.backend)
+        print(f"LLM loaded successfully ({self.backend}).")
+        if self.backend != "fp32" and os.environ.get("ICBG_LLM_SELFCHECK") == "1":
+            self._run_self_check()
+
+        if self.draft_model_id:
+            try:
+                self.draft_model = self._load_draft_model()
+                print(f"Draft model {self.draft_model_id} loaded for assisted decoding.")
+            except Exception as e:
+                print(f"Failed to load draft model, decoding without it: {e}")
+
+    def _unload_models(self):
+        self.pipe = None
+        self.draft_model = None
+        self._prefix_ids = None
+        self._prefix_cache = None
+        gc.collect()
+        if self.device == "mps":
+            torch.mps.empty_cache()
+
+    def _model_bytes(self) -> int:
+        models = [self.pipe.model] + ([self.draft_model] if self.draft_model is not None else [])
+        return sum(module_bytes(model) for model in models)
+
+    def _warm_up(self):
+        # Prefilling the static prompt prefix exercises the model and fills the KV cache jobs start from
+        self._prefix()
+
+    def _load_pipeline(self, backend: str):
+        device = self.device
+        if backend == "int8" and device != "cpu":
+            # Dynamic int8 kernels only exist on CPU
+            print("int8 LLM backend runs on CPU only.")
+            device = "cpu"
+
+        pipe = pipeline(
+            "text-generation",
+            model=self.model_id,
+            device=device,
+            torch_dtype=torch.bfloat16 if backend == "bf16" else torch.float32, # Use float32 for stability on MPS
+            max_new_tokens=MAX_NEW_TOKENS, # Increased for 10 pages
+        )
+        if backend == "int8":
+            # Swap every Linear for an int8 weight / dynamic activation version, in place
+            # so the fp32 weights are released as we go
+            torch.ao.quantization.quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        pipe.model.eval()
+        return pipe
+
+    def _load_draft_model(self):
+        """
+        Load the draft model next to the main one. It must share the main model's tokenizer
+        (the SmolLM family does). int8 main models get an fp32 draft; the draft is small.
+        """
+        model = self.pipe.model
+        dtype = torch.bfloat16 if self.backend == "bf16" else torch.float32
+        draft = AutoModelForCausalLM.from_pretrained(self.draft_model_id, torch_dtype=dtype)
+        draft.to(model.device)
+        draft.eval()
+        return draft
+
+    def _run_self_check(self):
+        """
+        Compare the selected backend against the fp32 model on a fixed probe text.
+        Falls back to fp32 if next-token agreement or perplexity drift is out of bounds.
+        """
+        print(f"Running {self.backend} self-check against fp32...")
+        reference = self._load_pipeline("fp32")
+        tokenizer = self.pipe.tokenizer
+        ids = tokenizer(SELF_CHECK_TEXT, return_tensors="pt").input_ids
+
+        def score(model):
+            with torch.no_grad():
+                logits = model(input_ids=ids.to(model.device)).logits[0, :-1].float().cpu()
+            nll = torch.nn.functional.cross_entropy(logits, ids[0, 1:])
+            return logits.argmax(-1), torch.exp(nll).item()
+
+        ref_tokens, ref_ppl = score(reference.model)
+        tokens, ppl = score(self.pipe.model)
+        agreement = (tokens == ref_tokens).float().mean().item()
+        ppl_ratio = ppl / ref_ppl
+        passed = agreement >= SELF_CHECK_MIN_AGREEMENT and ppl_ratio <= SELF_CHECK_MAX_PPL_RATIO
+        self.self_check = {
+            "backend": self.backend,
+            "top1_agreement": round(agreement, 4),
+            "perplexity": round(ppl, 3),
+            "reference_perplexity": round(ref_ppl, 3),
+            "passed": passed
+        }
+        print(f"LLM self-check: {self.self_check}")
+
+        if passed:
+            del reference
+        else:
+            print(f"{self.backend} output drifted too far from fp32, falling back to fp32.")
+            self.pipe = reference
+            self.backend = "fp32"
+        gc.collect()
+
+    def _prefix(self):
+        """
+        Return (prefix_ids, prefix_cache), prefilling the static prompt prefix once.
+        Only called from the LLM lane, so no locking is needed.
+        """
+        if self._prefix_cache is None:
+            model = self.pipe.model
+            prefix_ids = self.pipe.tokenizer(STORY_PROMPT_PREFIX, return_tensors="pt").input_ids.to(model.device)
+            with torch.no_grad():
+                outputs = model(input_ids=prefix_ids, use_cache=True)
+            self._prefix_ids = prefix_ids
+            self._prefix_cache = outputs.past_key_values
+            print(f"Cached KV for {prefix_ids.shape[1]}-token prompt prefix.")
+        else:
+            self.prefix_cache_hits += 1
+        return self._prefix_ids, self._prefix_cache
+
+    def _generate(self, prompt_suffix: str, streamer=None, max_new_tokens: int = MAX_NEW_TOKENS, cancel_event=None,
+                  max_pages: int = MAX_PAGES) -> tuple:
+        """
+        Blocking generate call. Runs on the inference executor, never on the event loop.
+        Only prompt_suffix is prefilled; the static prefix comes from the KV cache.
+        Returns (generated_text, stats).
+        """
+        model = self.pipe.model
+        tokenizer = self.pipe.tokenizer
+
+        prefix_ids, prefix_cache = self._prefix()
+        suffix_ids = tokenizer(prompt_suffix, add_special_tokens=False, return_tensors="pt").input_ids.to(model.device)
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        prompt_length = input_ids.shape[1]
+
+        stopping = StoryStoppingCriteria(tokenizer, prompt_length, max_pages=max_pages, cancel_event=cancel_event)
+        generate_kwargs = {}
+        forward_counts = {"target": 0, "draft": 0}
+        prefilled = []
+
+        def count_target(*_):
+            # The first forward pass of the main model is the prefill of the suffix
+            forward_counts["target"] += 1
+            if not prefilled:
+                prefilled.append(time.perf_counter())
+
+        hooks = [model.register_forward_hook(count_target)]
+        if self.draft_model is not None:
+            # Speculative sampling: the draft proposes tokens, the main model accepts or
+            # resamples them, so the output distribution matches plain sampling
+            generate_kwargs["assistant_model"] = self.draft_model
+            hooks.append(self.draft_model.register_forward_hook(lambda *_: forward_counts.__setitem__("draft", forward_counts["draft"] + 1)))
+
+        started = time.perf_counter()
         try:
-            output = self.pipe(
-                prompt,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.95,
-                repetition_penalty=1.15
-            )[0]['generated_text']
-            
-            # DEBUG: Print raw output
-            print("RAW LLM OUTPUT:")
-            print(output)
-            print("-----------------")
-
-            # Extract the assistant's response
-            response = output.split("<|im_start|>assistant")[-1].strip()
-            
-            # Parse Title
-            import re
-            title = f"The Story of {theme}" # Default fallback
-            
-            # 1. Try strict regex for "TITLE: ..."
-            title_match = re.search(r"^TITLE:\s*(.*)$", response, re.MULTILINE | re.IGNORECASE)
-            if title_match:
-                raw_title = title_match.group(1).strip()
-                # Clean up quotes and extra spaces
-                title = raw_title.strip('"').strip("'").strip()
-                # Remove the title line from response
-                response = response.replace(title_match.group(0), "").strip()
-            else:
-                # 2. Fallback: Check first line if it looks like a title (short, no "Here is")
-                first_line = response.split('\n')[0].strip()
-                if len(first_line) < 60 and not any(x in first_line.lower() for x in ["here is", "sure", "certainly", "okay"]):
-                    title = first_line.strip('"').strip("'")
-                    response = "\n".join(response.split('\n')[1:]).strip()
-            
-            # Final cleanup of title just in case
-            title = title.replace("Book Title:", "").strip()
-            
-            pages = []
-            raw_pages = response.split("---PAGE BREAK---")
-            
-            for i, raw_page in enumerate(raw_pages):
-                if not raw_page.strip():
-                    continue
-                    
-                # Robust parsing logic
-                lines = raw_page.strip().split('\n')
-                text = ""
-                image_prompt = ""
-                
-                current_section = None # 'text' or 'image'
-                
-                for line in lines:
-                    clean_line = line.strip()
-                    if not clean_line:
-                        continue
-                        
-                    if "Text:" in clean_line:
-                        current_section = 'text'
-                        text += clean_line.split("Text:", 1)[1].strip() + " "
-                    elif "Image:" in clean_line:
-                        current_section = 'image'
-                        image_prompt += clean_line.split("Image:", 1)[1].strip() + " "
-                    elif "Description:" in clean_line:
-                        current_section = 'image'
-                        image_prompt += clean_line.split("Description:", 1)[1].strip() + " "
-                    else:
-                        # Append to current section if it's a continuation
-                        if current_section == 'text':
-                            text += clean_line + " "
-                        elif current_section == 'image':
-                            image_prompt += clean_line + " "
-                        else:
-                            # If no section defined yet, assume it's text
-                            current_section = 'text'
-                            text += clean_line + " "
-                
-                # Fallback if parsing failed but content exists
-                if not text.strip() and len(lines) > 0:
-                    text = raw_page.strip()
-                if not image_prompt.strip():
-                    image_prompt = f"Illustration for page {i+1} about {theme}"
-                
-                pages.append({"text": text.strip(), "image_prompt": image_prompt.strip()})
-            
-            # Ensure we have at least one page
-            if not pages or (len(pages) == 1 and len(pages[0]['text']) > 500):
-                print("Parsing failed or single long page detected. Using Smart Splitter.")
-                
-                # Use the raw response (or the single page text)
-                full_text = response
-                if pages:
-                    full_text = pages[0]['text']
-                
-                # Split into sentences (simple heuristic)
-                import re
-                sentences = re.split(r'(?<=[.!?]) +', full_text)
-                
-                # Group sentences into pages (e.g., 3 sentences per page)
-                sentences_per_page = 3
-                chunks = [sentences[i:i + sentences_per_page] for i in range(0, len(sentences), sentences_per_page)]
-                
-                pages = []
-                for i, chunk in enumerate(chunks):
-                    page_text = " ".join(chunk).strip()
-                    if not page_text: continue
-                    
-                    # Generate a generic image prompt based on the chunk
-                    # Ideally we'd ask the LLM, but for speed/fallback we use the text + theme
-                    image_prompt = f"Illustration for: {page_text[:50]}..., theme: {theme}"
-                    
-                    pages.append({"text": page_text, "image_prompt": image_prompt})
-                
-                # Ensure we have at least 10 pages if possible, or just use what we have
-                # If we have too many, truncate. If too few, that's okay for fallback.
-            
-            return {"title": title, "pages": pages[:10]}
+            with torch.no_grad():
+                output_ids = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    # generate() appends to the cache, so every job works on its own copy
+                    past_key_values=copy.deepcopy(prefix_cache),
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([stopping]),
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+                    do_sample=True,
+                    temperature=0.7,
+                    top_p=0.95,
+                    repetition_penalty=1.15,
+                    **generate_kwargs
+                )
+        finally:
+            for hook in hooks:
+                hook.remove()
+        elapsed = time.perf_counter() - started
+        prefill = (prefilled[0] - started) if prefilled else 0.0
+        decode = elapsed - prefill
+
+        generated = output_ids.shape[1] - prompt_length
+        stats = {
+            "backend": self.backend,
+            "prompt_tokens": suffix_ids.shape[1],
+            "generated_tokens": generated,
+            "seconds": round(elapsed, 3),
+            "prefill_seconds": round(prefill, 3),
+            "decode_seconds": round(decode, 3),
+            "tokens_per_second": round(generated / decode, 2) if decode > 0 else 0.0,
+            "stop_reason": stopping.reason or "budget_or_eos"
+        }
+        llm_prefill_seconds.observe(prefill)
+        llm_decode_seconds.observe(decode)
+        llm_tokens_total.inc(generated)
+        if self.draft_model is not None:
+            # Every verification pass of the main model yields one token of its own;
+            # everything beyond that was an accepted draft token
+            accepted = max(0, generated - forward_counts["target"])
+            stats["draft_model"] = self.draft_model_id
+            stats["draft_tokens"] = forward_counts["draft"]
+            stats["accepted_tokens"] = accepted
+            stats["acceptance_rate"] = round(accepted / forward_counts["draft"], 3) if forward_counts["draft"] else 0.0
+
+        return tokenizer.decode(output_ids[0, prompt_length:], skip_special_tokens=True), stats
 
+    def token_budget(self, params: dict) -> int:
+        """
+        Per-job generation budget, capped by the engine-wide maximum.
+        """
+        budget = params.get("tokenBudget")
+        if not budget:
+            return MAX_NEW_TOKENS
+        return max(1, min(int(budget), MAX_NEW_TOKENS))
+
+    async def stream_story(self, source_text: str, params: dict, cancel_event=None):
+        """
+        Generate a story, yielding ("page", page) as soon as each page has been
+        decoded and finally ("story", {"title", "pages"}) with the parsed book.
+        Setting cancel_event stops decoding at the next token.
+        Waits for the model to finish loading first.
+        """
+        async with self.lifecycle.use():
+            async for event in self._stream_story(source_text, params, cancel_event):
+                yield event
+
+    async def _stream_story(self, source_text: str, params: dict, cancel_event=None):
+        if not self.pipe:
+            print("LLM not loaded, returning dummy data.")
+            yield "story", {"title": "Error Generating Title", "pages": [{"text": "Error: Model not loaded.", "image_prompt": "Error icon"}]}
+            return
+
+        theme = params.get("theme", "General Islamic Values")
+        age_group = params.get("ageGroup", "6-8")
+        humor = params.get("humor", 5)
+        
+        # Truncate source text to avoid context window issues (approx 2000 chars)
+        truncated_source = source_text[:2000] + "..." if len(source_text) > 2000 else source_text
+
+        # Only the suffix varies per job; the system prefix is served from the KV cache
+        prompt = STORY_PROMPT_SUFFIX.format(
+            age_group=age_group,
+            theme=theme,
+            humor=humor,
+            source=truncated_source
+        )
+
+        parser = StoryStreamParser(theme)
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def emit(page):
+            # Called from the LLM worker thread
+            loop.call_soon_threadsafe(events.put_nowait, ("page", page))
+
+        streamer = _PageStreamer(self.pipe.tokenizer, parser, emit)
+        # Decoding takes minutes on CPU, so run it on the LLM worker
+        generation = asyncio.ensure_future(self.executor.run("llm", self._generate, prompt, streamer, self.token_budget(params), cancel_event))
+        generation.add_done_callback(lambda _: events.put_nowait(("end", None)))
+
+        while True:
+            kind, payload = await events.get()
+            if kind == "end":
+                break
+            yield kind, payload
+
+        try:
+            # The parser has already seen the whole output through the streamer;
+            # stats go to the job record and the LLM histograms
+            _, stats = generation.result()
+            story = parser.finish()
+            story["stats"] = stats
         except Exception as e:
             print(f"Error generating story: {e}")
-            return {"title": "Error", "pages": [{"text": "Sorry, I couldn't generate a story at this time.", "image_prompt": "Sad robot"}]}
+            story = {"title": "Error", "pages": [{"text": "Sorry, I couldn't generate a story at this time.", "image_prompt": "Sad robot"}]}
+
+        yield "story", story
+
+    async def generate_story(self, source_text: str, params: dict, cancel_event=None) -> dict:
+        story = None
+        async for kind, payload in self.stream_story(source_text, params, cancel_event):
+            if kind == "story":
+                story = payload
+        return story
+
+    async def rewrite_page(self, story: dict, number: int, params: dict, cancel_event=None):
+        """
+        Write a new version of page `number` (1-based) of a finished story.
+        Returns {"text", "image_prompt"}, or None if the model is unavailable.
+        """
+        async with self.lifecycle.use():
+            if not self.pipe:
+                print("LLM not loaded, cannot rewrite page.")
+                return None
+
+            theme = params.get("theme", "General Islamic Values")
+            story_text = "\n".join(f"Page {i} Text: {page.get('text', '')}" for i, page in enumerate(story["pages"], 1))
+            if len(story_text) > 2000:
+                story_text = story_text[:2000] + "..."
+            prompt = PAGE_REWRITE_SUFFIX.format(
+                age_group=params.get("ageGroup", "6-8"),
+                theme=theme,
+                humor=params.get("humor", 5),
+                title=story.get("title", ""),
+                story=story_text,
+                number=number
+            )
+            output, stats = await self.executor.run("llm", self._generate, prompt, None, PAGE_MAX_NEW_TOKENS, cancel_event, 1)
+
+        if stats["stop_reason"] == "cancelled":
+            return None
+        return parse_page(f"Page {number} Text:" + output.split(PAGE_BREAK)[0], number - 1, theme)
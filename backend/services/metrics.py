@@ -0,0 +1,236 @@
+import bisect
+import contextlib
+import os
+import resource
+import sys
+import threading
+import time
+
+# Histogram buckets in seconds, from a fast cache hit to a long CPU decode
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Stage durations assumed for progress until real jobs have been measured
+DEFAULT_STAGE_SECONDS = {"ingest": 5.0, "llm": 120.0, "image": 60.0, "pdf": 5.0}
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.type = "counter"
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Gauge(Counter):
+    """
+    A value that goes up and down. With a collect() callable it is read at scrape time.
+    """
+    def __init__(self, name: str, help_text: str, collect=None):
+        super().__init__(name, help_text)
+        self.type = "gauge"
+        self._collect = collect
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def samples(self):
+        if self._collect is not None:
+            # collect() returns a number or a list of (labels, value)
+            values = self._collect()
+            if not isinstance(values, list):
+                values = [({}, values)]
+            for labels, value in values:
+                self.set(value, **labels)
+        return super().samples()
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.type = "histogram"
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._series[key] = (counts, total + value)
+
+    def mean(self, **labels):
+        """
+        Average observed value, or None before the first observation.
+        """
+        series = self._series.get(_label_key(labels))
+        if series is None or not sum(series[0]):
+            return None
+        return series[1] / sum(series[0])
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key + (("le", "+Inf" if bound == float("inf") else f"{bound:g}"),), cumulative))
+                samples.append((f"{self.name}_count", key, cumulative))
+                samples.append((f"{self.name}_sum", key, total))
+        return samples
+
+class MetricsRegistry:
+    """
+    Minimal Prometheus-style registry: counters, gauges and histograms with
+    labels, rendered in the text exposition format by render().
+    """
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, collect=None) -> Gauge:
+        return self._register(Gauge(name, help_text, collect))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self, only: str = None, skip: str = None) -> str:
+        """
+        Text exposition of every metric, or of those whose name starts with `only`
+        and not with `skip`.
+        """
+        lines = []
+        for metric in self._metrics.values():
+            if (only and not metric.name.startswith(only)) or (skip and metric.name.startswith(skip)):
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value:g}" if isinstance(value, float) else f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+def peak_rss_bytes() -> int:
+    """
+    Highest resident set size of this process so far.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+# Shared by the whole process
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram("icbg_stage_seconds", "Time a job spent in each pipeline stage.")
+queue_wait_seconds = metrics.histogram("icbg_queue_wait_seconds", "Time jobs waited in the scheduler queue.")
+jobs_total = metrics.counter("icbg_jobs_total", "Finished jobs by final status.")
+llm_prefill_seconds = metrics.histogram("icbg_llm_prefill_seconds", "LLM prompt prefill time per generate call.")
+llm_decode_seconds = metrics.histogram("icbg_llm_decode_seconds", "LLM decode time per generate call.")
+llm_tokens_total = metrics.counter("icbg_llm_tokens_total", "Tokens generated by the LLM.")
+diffusion_seconds = metrics.histogram("icbg_diffusion_seconds", "Duration of each diffusion batch call.")
+images_total = metrics.counter("icbg_images_total", "Images produced, by source (model or cache).")
+metrics.gauge("icbg_process_resident_bytes", "Current resident set size of this process.", rss_bytes)
+metrics.gauge("icbg_process_peak_resident_bytes", "Peak resident set size of this process.", peak_rss_bytes)
+
+# Model residency (services/residency.py), kept up to date by ModelResidency
+model_resident = metrics.gauge("icbg_model_resident", "1 while a model is loaded or loading, by model.")
+model_resident_bytes = metrics.gauge("icbg_model_resident_bytes", "Memory held by each model while resident, 0 otherwise.")
+model_memory_budget_bytes = metrics.gauge("icbg_model_memory_budget_bytes", "Memory budget for resident models (0: unlimited).")
+model_loads_total = metrics.counter("icbg_model_loads_total", "Completed model loads (swap-ins), by model.")
+model_evictions_total = metrics.counter("icbg_model_evictions_total", "Models evicted to make room for another, by evicted model.")
+model_swaps_total = metrics.counter("icbg_model_swaps_total", "Loads that evicted another model first, by loaded model.")
+
+def stage_estimate(stage: str) -> float:
+    """
+    Expected duration of a stage: the measured mean once there is one, else a default.
+    """
+    measured = stage_seconds.mean(stage=stage)
+    return measured if measured else DEFAULT_STAGE_SECONDS.get(stage, 1.0)
+
+class JobMetrics:
+    """
+    Per-job measurements, attached to the job record as its "metrics" field.
+
+    Stage timings are summed per stage, since a job may enter a stage several
+    times (one diffusion call per batch of pages). finish() adds the totals to
+    the process-wide histograms, which in turn drive progress estimates.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.queue_wait_seconds = None
+        self.llm = {}
+        self.diffusion_calls = []
+        self.images = 0
+        self.cached_images = 0
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - started)
+
+    def add_stage_time(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record_llm(self, stats: dict):
+        if not stats:
+            return
+        for field in ("prompt_tokens", "generated_tokens", "prefill_seconds", "decode_seconds", "tokens_per_second"):
+            if field in stats:
+                self.llm[field] = stats[field]
+
+    def record_diffusion(self, images: int, cached: int, seconds: float):
+        self.diffusion_calls.append({"images": images, "cached": cached, "seconds": round(seconds, 3)})
+        self.images += images
+        self.cached_images += cached
+        self.add_stage_time("image", seconds)
+
+    def finish(self, status: str):
+        for name, seconds in self.stages.items():
+            stage_seconds.observe(seconds, stage=name)
+        jobs_total.inc(status=status)
+
+    def to_dict(self) -> dict:
+        image_seconds = sum(call["seconds"] for call in self.diffusion_calls)
+        rendered = self.images - self.cached_images
+        return {
+            "queue_wait_seconds": self.queue_wait_seconds,
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "llm": self.llm,
+            "diffusion_calls": self.diffusion_calls,
+            "images": self.images,
+            "images_per_second": round(rendered / image_seconds, 3) if rendered and image_seconds > 0 else None,
+            "image_cache_hit_rate": round(self.cached_images / self.images, 3) if self.images else None,
+            "peak_rss_bytes": peak_rss_bytes()
+        }
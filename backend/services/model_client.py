@@ -0,0 +1,143 @@
+from multiprocessing.connection import Client
+import asyncio
+import os
+import threading
+
+DEFAULT_ADDRESS = "/tmp/icbg-models.sock"
+
+def server_authkey() -> bytes:
+    """
+    Shared secret for the model server socket (ICBG_MODEL_SERVER_KEY). Messages
+    are pickled, so there is no default: both sides refuse to start without it.
+    """
+    key = os.environ.get("ICBG_MODEL_SERVER_KEY", "")
+    if not key:
+        raise RuntimeError("ICBG_MODEL_SERVER_KEY must be set to use the model server")
+    return key.encode()
+
+async def remote_call(address: str, request: tuple, cancel_event=None):
+    """
+    Send one request to the model server and yield its reply messages until a
+    terminal one ("story", "done" or "error") has been yielded.
+
+    The connection is read on a helper thread. If cancel_event is set, a
+    ("cancel",) message is sent; if the caller stops iterating, the connection
+    is closed, which the server also treats as a cancellation.
+    """
+    loop = asyncio.get_running_loop()
+    replies = asyncio.Queue()
+    conn = await asyncio.to_thread(Client, address, family="AF_UNIX", authkey=server_authkey())
+    closed = threading.Event()
+
+    def reader():
+        cancel_sent = False
+        try:
+            conn.send(request)
+            while not closed.is_set():
+                if cancel_event is not None and cancel_event.is_set() and not cancel_sent:
+                    conn.send(("cancel",))
+                    cancel_sent = True
+                if conn.poll(0.2):
+                    message = conn.recv()
+                    loop.call_soon_threadsafe(replies.put_nowait, message)
+                    if message[0] in ("story", "done", "error", "status"):
+                        return
+        except (EOFError, OSError) as e:
+            if not closed.is_set():
+                loop.call_soon_threadsafe(replies.put_nowait, ("error", f"Model server connection lost: {e}"))
+
+    thread = threading.Thread(target=reader, name="model-client", daemon=True)
+    thread.start()
+    try:
+        while True:
+            message = await replies.get()
+            yield message
+            if message[0] in ("story", "done", "error", "status"):
+                return
+    finally:
+        closed.set()
+        await asyncio.to_thread(thread.join)
+        conn.close()
+
+class RemoteContentEngine:
+    """
+    ContentEngine API backed by the shared model server.
+    """
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        self.address = address
+        # Fail at startup rather than on the first job
+        server_authkey()
+
+    async def stream_story(self, source_text: str, params: dict, cancel_event=None):
+        request = ("story", {"source_text": source_text, "params": params})
+        streamed = []
+        async for message in remote_call(self.address, request, cancel_event):
+            if message[0] == "page":
+                streamed.append(message[1])
+                yield "page", message[1]
+            elif message[0] == "story":
+                story = message[1]
+                # Hand back the already streamed page objects, as the local engine does,
+                # so callers can tell which pages they have seen
+                pages = story.get("pages", [])
+                for i, page in enumerate(pages[:len(streamed)]):
+                    if page == streamed[i]:
+                        pages[i] = streamed[i]
+                yield "story", story
+            elif message[0] == "error":
+                print(f"Error generating story: {message[1]}")
+                yield "story", {"title": "Error", "pages": [{"text": "Sorry, I couldn't generate a story at this time.", "image_prompt": "Sad robot"}]}
+
+    async def generate_story(self, source_text: str, params: dict, cancel_event=None) -> dict:
+        story = None
+        async for kind, payload in self.stream_story(source_text, params, cancel_event):
+            if kind == "story":
+                story = payload
+        return story
+
+    async def rewrite_page(self, story: dict, number: int, params: dict, cancel_event=None):
+        request = ("rewrite_page", {"story": story, "number": number, "params": params})
+        async for message in remote_call(self.address, request, cancel_event):
+            if message[0] == "done":
+                return message[1]
+            if message[0] == "error":
+                print(f"Error rewriting page: {message[1]}")
+        return None
+
+class RemoteImageEngine:
+    """
+    ImageEngine API backed by the shared model server. Image paths are relative
+    to the server's working directory, so both must run from backend/.
+    """
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        self.address = address
+        # Fail at startup rather than on the first job
+        server_authkey()
+
+    async def generate_images(self, prompts: list, batch_size: int = None, on_image=None, cancel_event=None,
+                              variation: int = 0) -> list:
+        results = ["" for _ in prompts]
+        request = ("images", {"prompts": prompts, "batch_size": batch_size, "variation": variation})
+        async for message in remote_call(self.address, request, cancel_event):
+            if message[0] == "image":
+                _, index, path, image = message
+                results[index] = path
+                if on_image:
+                    on_image(index, path, image)
+            elif message[0] == "error":
+                print(f"Error generating images: {message[1]}")
+        return results
+
+    async def generate_image(self, prompt: str) -> str:
+        results = await self.generate_images([prompt], batch_size=1)
+        return results[0]
+
+async def server_status(address: str = DEFAULT_ADDRESS, kind: str = "status") -> dict:
+    """
+    Engine load state ("status"), memory residency ("residency") or the
+    icbg_model_* metrics in text exposition format ("metrics") of the model server.
+    """
+    async for message in remote_call(address, (kind,)):
+        if message[0] == "status":
+            return message[1]
+    return {}
@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import os
+import time
+
+# Seconds a model may sit unused before it is unloaded; 0 keeps models resident
+IDLE_TIMEOUT = float(os.environ.get("ICBG_MODEL_IDLE_TIMEOUT", "0"))
+
+# Run a small inference right after loading so the first job doesn't pay for it
+WARMUP = os.environ.get("ICBG_MODEL_WARMUP", "1") == "1"
+
+class ModelLifecycle:
+    """
+    Load state of one engine's model: unloaded -> loading -> ready (or failed).
+
+    load, unload and warmup are blocking callables that run on the engine's
+    inference lane (named like the lifecycle), so they never overlap with
+    inference on the same model. Callers await ensure_loaded() or wrap their
+    work in `async with lifecycle.use():`; concurrent callers share one load.
+    A failed load is retried by the next caller. With an idle timeout the model
+    is unloaded once nobody has used it for that long and reloaded on demand.
+
+    With a residency manager, use() first waits for the model to fit in the
+    memory budget. expected_bytes is its size until measure() can report the
+    real footprint after the first load.
+    """
+    def __init__(self, name: str, executor, load, unload, warmup=None, idle_timeout: float = None,
+                 expected_bytes: int = 0, measure=None, residency=None):
+        self.name = name
+        self.executor = executor
+        self._load = load
+        self._unload = unload
+        self._warmup = warmup
+        self.idle_timeout = IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.state = "unloaded"
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.loads = 0
+        self.unloads = 0
+        self._loading = None
+        self._users = 0
+        self._last_used = time.monotonic()
+        self._idle_task = None
+        self.expected_bytes = expected_bytes
+        self.measured_bytes = None
+        self._measure = measure
+        self.residency = residency
+        if residency is not None:
+            residency.register(self)
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def is_resident(self) -> bool:
+        return self.state in ("loading", "ready")
+
+    @property
+    def resident_bytes(self) -> int:
+        return self.measured_bytes or self.expected_bytes
+
+    @property
+    def in_use(self) -> int:
+        return self._users
+
+    @property
+    def last_used(self) -> float:
+        return self._last_used
+
+    def start(self):
+        """
+        Start loading in the background unless loaded or already loading. Must be
+        called from the event loop. Returns the loading task, or None if ready.
+        """
+        if self.state == "ready":
+            return None
+        if self._loading is None:
+            self.state = "loading"
+            self._loading = asyncio.ensure_future(self._load_and_warm_up())
+            self._observe()
+        return self._loading
+
+    def preload(self):
+        """
+        start() if the model fits in the memory budget without evicting anything.
+        """
+        if self.residency is not None and not self.residency.fits(self):
+            print(f"Not preloading {self.name} model: it doesn't fit in the memory budget next to the others.")
+            return None
+        return self.start()
+
+    async def ensure_loaded(self) -> bool:
+        """
+        Wait until the model is loaded. Returns False if loading failed.
+        """
+        loading = self.start()
+        if loading is not None:
+            # Shielded so a cancelled job doesn't abort a load other jobs wait on
+            await asyncio.shield(loading)
+        return self.ready
+
+    @contextlib.asynccontextmanager
+    async def use(self):
+        """
+        Hold the model loaded for the duration of the block. Yields ensure_loaded()'s result.
+        """
+        if self.residency is not None:
+            await self.residency.acquire(self)
+        self._users += 1
+        try:
+            yield await self.ensure_loaded()
+        finally:
+            self._users -= 1
+            self._last_used = time.monotonic()
+            if self.residency is not None:
+                self.residency.release(self)
+
+    async def _load_and_warm_up(self):
+        print(f"Loading {self.name} model...")
+        started = time.perf_counter()
+        try:
+            await self.executor.run(self.name, self._load)
+        except Exception as e:
+            print(f"Failed to load {self.name} model: {e}")
+            self.state = "failed"
+            self.error = str(e)
+            self._loading = None
+            self._observe()
+            return
+        self.load_seconds = round(time.perf_counter() - started, 2)
+        if self._measure is not None:
+            self.measured_bytes = self._measure()
+
+        if self._warmup and WARMUP:
+            started = time.perf_counter()
+            try:
+                await self.executor.run(self.name, self._warmup)
+                self.warmup_seconds = round(time.perf_counter() - started, 2)
+            except Exception as e:
+                print(f"Warmup of {self.name} model failed: {e}")
+
+        self.state = "ready"
+        self.error = None
+        self.loads += 1
+        self._loading = None
+        self._last_used = time.monotonic()
+        self._observe(loaded=True)
+        print(f"{self.name} model ready (load {self.load_seconds}s, warmup {self.warmup_seconds}s).")
+        if self.idle_timeout > 0 and self._idle_task is None:
+            self._idle_task = asyncio.ensure_future(self._unload_when_idle())
+
+    async def _unload_when_idle(self):
+        try:
+            while self.state == "ready":
+                idle_for = time.monotonic() - self._last_used
+                if self._users == 0 and idle_for >= self.idle_timeout:
+                    await self.unload()
+                    break
+                await asyncio.sleep(max(1.0, self.idle_timeout - idle_for))
+        finally:
+            self._idle_task = None
+
+    async def unload(self) -> bool:
+        """
+        Release the model unless it is loading or in use. Returns True if it was unloaded.
+        """
+        if self.state != "ready" or self._users:
+            return False
+        self.state = "unloaded"
+        self._observe()
+        await self.executor.run(self.name, self._unload)
+        self.unloads += 1
+        print(f"Unloaded {self.name} model.")
+        return True
+
+    def _observe(self, loaded: bool = False):
+        if self.residency is not None:
+            self.residency.observe(self, loaded)
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "in_use": self._users,
+            "bytes": self.resident_bytes,
+            "idle_seconds": round(time.monotonic() - self._last_used, 1)
+        }
@@ -0,0 +1,137 @@
+"""
+Shared model server: one process owns the LLM and diffusion pipelines and
+serves them to any number of API workers over a local Unix socket.
+
+Run from backend/ (image paths are relative to it):
+    ICBG_MODEL_SERVER=/tmp/icbg-models.sock python -m services.model_server
+then start the API workers with the same ICBG_MODEL_SERVER value. The
+workers coordinate jobs through the job database (see services/workers.py).
+"""
+from multiprocessing.connection import Listener
+import asyncio
+import os
+import threading
+from services.model_client import DEFAULT_ADDRESS, server_authkey
+from services.residency import model_residency
+from services.metrics import metrics
+
+class ModelServer:
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        self.address = address
+        # Raises before any model is loaded if ICBG_MODEL_SERVER_KEY is missing
+        self.authkey = server_authkey()
+        self.loop = None
+        self.content_engine = None
+        self.image_engine = None
+
+    def serve_forever(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        from services.llm import ContentEngine
+        from services.image_gen import ImageEngine
+
+        self.loop = asyncio.get_running_loop()
+        self.content_engine = ContentEngine()
+        self.image_engine = ImageEngine()
+        self.content_engine.lifecycle.preload()
+        self.image_engine.lifecycle.preload()
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        # Create the socket owner-only from the start, not chmod it after binding
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        print(f"Model server listening on {self.address}")
+
+        threading.Thread(target=self._accept_loop, args=(listener,), name="model-server-accept", daemon=True).start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            listener.close()
+
+    def _accept_loop(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError as e:
+                print(f"Model server accept failed: {e}")
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn):
+        """
+        Handle one request per connection. While it runs, watch the connection
+        for a ("cancel",) message or a disconnect and cancel the model work.
+        """
+        cancel_event = threading.Event()
+        try:
+            request = conn.recv()
+            future = asyncio.run_coroutine_threadsafe(self._handle(request, conn, cancel_event), self.loop)
+            while not future.done():
+                if conn.poll(0.2):
+                    try:
+                        message = conn.recv()
+                    except (EOFError, OSError):
+                        cancel_event.set()
+                        break
+                    if message and message[0] == "cancel":
+                        cancel_event.set()
+            future.result()
+        except Exception as e:
+            print(f"Model server request failed: {e}")
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _send(conn, message, cancel_event):
+        try:
+            conn.send(message)
+        except (OSError, ValueError):
+            # Client went away: stop the work it asked for
+            cancel_event.set()
+
+    async def _handle(self, request: tuple, conn, cancel_event):
+        kind = request[0]
+        try:
+            if kind == "story":
+                args = request[1]
+                async for event, payload in self.content_engine.stream_story(args["source_text"], args["params"], cancel_event):
+                    self._send(conn, (event, payload), cancel_event)
+            elif kind == "images":
+                args = request[1]
+                results = await self.image_engine.generate_images(
+                    args["prompts"],
+                    batch_size=args.get("batch_size"),
+                    on_image=lambda index, path, image: self._send(conn, ("image", index, path, image), cancel_event),
+                    cancel_event=cancel_event,
+                    variation=args.get("variation", 0)
+                )
+                self._send(conn, ("done", results), cancel_event)
+            elif kind == "rewrite_page":
+                args = request[1]
+                page = await self.content_engine.rewrite_page(args["story"], args["number"], args["params"], cancel_event)
+                self._send(conn, ("done", page), cancel_event)
+            elif kind == "status":
+                self._send(conn, ("status", self.status()), cancel_event)
+            elif kind == "residency":
+                self._send(conn, ("status", model_residency.status()), cancel_event)
+            elif kind == "metrics":
+                # Residency metrics live here; the API adds them to its /metrics
+                self._send(conn, ("status", metrics.render(only="icbg_model_")), cancel_event)
+            else:
+                self._send(conn, ("error", f"Unknown request {kind!r}"), cancel_event)
+        except Exception as e:
+            self._send(conn, ("error", str(e)), cancel_event)
+
+    def status(self) -> dict:
+        return {
+            "llm": self.content_engine.lifecycle.status(),
+            "image": self.image_engine.lifecycle.status()
+        }
+
+if __name__ == "__main__":
+    ModelServer(os.environ.get("ICBG_MODEL_SERVER", DEFAULT_ADDRESS)).serve_forever()
@@ -0,0 +1,155 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import zlib
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    SHA-256 of a file's content, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class PageTextCache:
+    """
+    Persistent cache of extracted page text, keyed by document content hash.
+
+    Each document gets a directory:
+        <cache_dir>/<sha256>/pages.bin   zlib-compressed page texts, append-only
+        <cache_dir>/<sha256>/index.json  {"page_count": N, "pages": {"<page>": [offset, length]}}
+    Pages are 0-indexed and cached sparsely, so a range request only extracts
+    the pages not seen before. Whole documents are evicted least-recently-used
+    once the cache grows past max_bytes.
+
+    The directory may be shared by several processes: writes
+    and evictions hold an exclusive flock on <cache_dir>/.lock, reads a shared one.
+    """
+    def __init__(self, cache_dir: str = "cache/pages", max_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes or int(os.environ.get("ICBG_PAGE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(self.cache_dir, ".lock")
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool):
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            # Released when the file is closed
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _doc_dir(self, doc_id: str) -> str:
+        return os.path.join(self.cache_dir, doc_id)
+
+    def _read_index(self, doc_id: str):
+        try:
+            with open(os.path.join(self._doc_dir(doc_id), "index.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def page_count(self, doc_id: str):
+        """
+        Total pages of the document, or None if it has never been seen.
+        """
+        index = self._read_index(doc_id)
+        return index["page_count"] if index else None
+
+    def missing_pages(self, doc_id: str, start: int, end: int) -> list:
+        """
+        Pages in [start, end) that are not cached yet (index lookup only).
+        This is the lookup that counts towards the hit/miss statistics.
+        """
+        index = self._read_index(doc_id)
+        entries = index["pages"] if index else {}
+        missing = [page_num for page_num in range(start, end) if str(page_num) not in entries]
+        self.hits += (end - start) - len(missing)
+        self.misses += len(missing)
+        return missing
+
+    def get_pages(self, doc_id: str, start: int, end: int) -> tuple:
+        """
+        Look up pages [start, end). Returns ({page: text}, [missing pages]).
+        Pages of a document evicted since its index was read come back as missing.
+        """
+        with self._locked(exclusive=False):
+            index = self._read_index(doc_id)
+            if not index:
+                return {}, list(range(start, end))
+
+            found = {}
+            missing = []
+            entries = index["pages"]
+            try:
+                with open(os.path.join(self._doc_dir(doc_id), "pages.bin"), "rb") as f:
+                    for page_num in range(start, end):
+                        entry = entries.get(str(page_num))
+                        if entry is None:
+                            missing.append(page_num)
+                            continue
+                        f.seek(entry[0])
+                        found[page_num] = zlib.decompress(f.read(entry[1])).decode("utf-8")
+
+                # Mark as recently used for eviction
+                os.utime(self._doc_dir(doc_id))
+            except (OSError, zlib.error):
+                return {}, list(range(start, end))
+            return found, missing
+
+    def put_pages(self, doc_id: str, page_count: int, pages: dict):
+        """
+        Store {page: text} for a document and evict old documents if over budget.
+        """
+        with self._locked(exclusive=True):
+            doc_dir = self._doc_dir(doc_id)
+            os.makedirs(doc_dir, exist_ok=True)
+            index = self._read_index(doc_id) or {"page_count": page_count, "pages": {}}
+            index["page_count"] = page_count
+
+            with open(os.path.join(doc_dir, "pages.bin"), "ab") as f:
+                offset = f.tell()
+                for page_num in sorted(pages):
+                    if str(page_num) in index["pages"]:
+                        continue
+                    blob = zlib.compress(pages[page_num].encode("utf-8"))
+                    f.write(blob)
+                    index["pages"][str(page_num)] = [offset, len(blob)]
+                    offset += len(blob)
+
+            # Write the index last so readers never see offsets past the data
+            tmp_path = os.path.join(doc_dir, "index.json.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(index, f, separators=(",", ":"))
+            os.replace(tmp_path, os.path.join(doc_dir, "index.json"))
+
+            self._evict(keep=doc_id)
+
+    def _evict(self, keep: str):
+        docs = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir():
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            docs.append((entry.stat().st_mtime, size, entry.name))
+            total += size
+
+        for _, size, doc_id in sorted(docs):
+            if total <= self.max_bytes:
+                break
+            if doc_id == keep:
+                continue
+            shutil.rmtree(self._doc_dir(doc_id), ignore_errors=True)
+            total -= size
+            print(f"Evicted cached pages for document {doc_id[:12]}.")
@@ -1,87 +1,280 @@
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
+from PIL import Image
+import asyncio
+import fitz  # PyMuPDF
+import io
 import os
 
+# Illustration box on each page, in points
+IMAGE_BOX = (400, 300)
+
+# Longest side of the per-page WebP previews, in pixels
+THUMBNAIL_SIZE = 256
+
 class PDFGenerator:
     def __init__(self):
         self.output_dir = "generated_books"
         os.makedirs(self.output_dir, exist_ok=True)
 
-    async def create_book_pdf(self, pages: list, filename: str, title: str = "My Islamic Children's Book") -> str:
+        # Illustrations are downsampled to this resolution at their placed size and
+        # embedded as JPEG (DCT, passed through as-is) or lossless Flate
+        self.image_dpi = int(os.environ.get("ICBG_PDF_IMAGE_DPI", "150"))
+        self.image_format = os.environ.get("ICBG_PDF_IMAGE_FORMAT", "jpeg").lower()
+        self.jpeg_quality = int(os.environ.get("ICBG_PDF_JPEG_QUALITY", "85"))
+
+    def _image_reader(self, page: dict):
         """
-        Generates a PDF from a list of pages.
-        Each page in the list is a dict with 'text' and optional 'image_path'.
+        ImageReader for a page's illustration: the in-memory image if the pipeline
+        handed one over, else the file at image_path. None if there is no image.
         """
-        output_path = os.path.join(self.output_dir, filename)
-        c = canvas.Canvas(output_path, pagesize=letter)
-        width, height = letter
+        image = page.get("image")
+        if image is None:
+            image_path = page.get("image_path")
+            if not image_path or not os.path.exists(image_path):
+                return None
+            image = Image.open(image_path)
+        image = image.convert("RGB")
 
-        # Title Page
+        # Size the image is drawn at (aspect ratio preserved), then pixels for the target DPI
+        scale = min(IMAGE_BOX[0] / image.width, IMAGE_BOX[1] / image.height)
+        target = (round(image.width * scale * self.image_dpi / 72), round(image.height * scale * self.image_dpi / 72))
+        if target[0] < image.width:
+            image = image.resize(target, Image.LANCZOS)
+
+        if self.image_format == "jpeg":
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=self.jpeg_quality, optimize=True)
+            buffer.seek(0)
+            return ImageReader(buffer)
+        return ImageReader(image)
+
+    def _draw_title(self, c, title: str):
+        width, height = letter
         c.setFont("Helvetica-Bold", 24)
         c.drawCentredString(width / 2, height / 2 + 50, title)
         c.setFont("Helvetica", 14)
         c.drawCentredString(width / 2, height / 2, "Generated by ICBG")
         c.showPage()
 
-        # Content Pages
-        for i, page in enumerate(pages):
-            # Image (Top Half)
-            image_path = page.get("image_path")
-            if image_path and os.path.exists(image_path):
-                try:
-                    # Draw image at the top
-                    # Page height is ~792 points (Letter)
-                    # Let's place image from y=400 to y=700 (height 300)
-                    img_width = 400
-                    img_height = 300
-                    x = (width - img_width) / 2
-                    y = height - 350 # Top margin
-                    c.drawImage(image_path, x, y, width=img_width, height=img_height, preserveAspectRatio=True)
-                except Exception as e:
-                    print(f"Error drawing image {image_path}: {e}")
-                    c.drawString(50, height - 200, f"[Error loading image]")
+    def _draw_page(self, c, number: int, page: dict):
+        width, height = letter
+        # Image (Top Half)
+        try:
+            reader = self._image_reader(page)
+            if reader is not None:
+                # Draw image at the top
+                # Page height is ~792 points (Letter)
+                # Let's place image from y=400 to y=700 (height 300)
+                img_width, img_height = IMAGE_BOX
+                x = (width - img_width) / 2
+                y = height - 350 # Top margin
+                c.drawImage(reader, x, y, width=img_width, height=img_height, preserveAspectRatio=True)
             else:
                 # Placeholder
                 c.drawString(50, height - 200, f"[Image Placeholder]")
+        except Exception as e:
+            print(f"Error drawing image for page {number}: {e}")
+            c.drawString(50, height - 200, f"[Error loading image]")
+
+        # Text (Bottom Half)
+        text = page.get("text", "")
+        c.setFont("Helvetica", 18) # Larger font for children
+        
+        # Start text below the image area with some padding
+        text_y_start = height - 400 
+        line_height = 24 # More spacing
+        
+        text_object = c.beginText(50, text_y_start)
+        text_object.setLeading(line_height)
+        
+        # Smart wrapping using textwrap
+        import textwrap
+        # Calculate chars per line based on font size and page width
+        # Letter width = 612. Margins = 50+50=100. Usable = 512.
+        # Approx char width for 18pt Helvetica is ~9-10pts. 512/9 = ~56 chars.
+        max_chars = 55 
+        
+        wrapped_lines = []
+        for paragraph in text.split('\n'):
+            wrapped_lines.extend(textwrap.wrap(paragraph, width=max_chars))
+        
+        # Center vertically in the available space if text is short
+        # Available height = text_y_start - bottom_margin (50) = ~350
+        total_text_height = len(wrapped_lines) * line_height
+        available_height = text_y_start - 50
+        
+        if total_text_height < available_height:
+            # Center it
+            offset = (available_height - total_text_height) / 2
+            text_object.setTextOrigin(50, text_y_start - offset)
+        
+        for line in wrapped_lines:
+            text_object.textLine(line)
+        c.drawText(text_object)
+
+        c.showPage()
+
+    def _build_book_pdf(self, pages: list, output_path: str, title: str):
+        c = canvas.Canvas(output_path, pagesize=letter)
+        # Title Page
+        self._draw_title(c, title)
+        # Content Pages
+        for i, page in enumerate(pages):
+            self._draw_page(c, i + 1, page)
+        c.save()
+
+    async def create_book_pdf(self, pages: list, filename: str, title: str = "My Islamic Children's Book") -> str:
+        """
+        Generates a PDF from a list of pages.
+        Each page in the list is a dict with 'text' and optional 'image' (PIL image)
+        or 'image_path'.
+        """
+        output_path = os.path.join(self.output_dir, filename)
+        # ReportLab and JPEG encoding are CPU-bound, keep them off the event loop
+        await asyncio.to_thread(self._build_book_pdf, pages, output_path, title)
+        return output_path
 
-            # Text (Bottom Half)
-            text = page.get("text", "")
-            c.setFont("Helvetica", 18) # Larger font for children
-            
-            # Start text below the image area with some padding
-            text_y_start = height - 400 
-            line_height = 24 # More spacing
-            
-            text_object = c.beginText(50, text_y_start)
-            text_object.setLeading(line_height)
-            
-            # Smart wrapping using textwrap
-            import textwrap
-            # Calculate chars per line based on font size and page width
-            # Letter width = 612. Margins = 50+50=100. Usable = 512.
-            # Approx char width for 18pt Helvetica is ~9-10pts. 512/9 = ~56 chars.
-            max_chars = 55 
-            
-            wrapped_lines = []
-            for paragraph in text.split('\n'):
-                wrapped_lines.extend(textwrap.wrap(paragraph, width=max_chars))
-            
-            # Center vertically in the available space if text is short
-            # Available height = text_y_start - bottom_margin (50) = ~350
-            total_text_height = len(wrapped_lines) * line_height
-            available_height = text_y_start - 50
-            
-            if total_text_height < available_height:
-                # Center it
-                offset = (available_height - total_text_height) / 2
-                text_object.setTextOrigin(50, text_y_start - offset)
-            
-            for line in wrapped_lines:
-                text_object.textLine(line)
-            c.drawText(text_object)
-
-            c.showPage()
+    def render_title(self, title: str, output_path: str):
+        """
+        Write the title page as a single-page PDF.
+        """
+        c = canvas.Canvas(output_path, pagesize=letter)
+        self._draw_title(c, title)
+        c.save()
 
+    def render_page(self, number: int, page: dict, output_path: str):
+        """
+        Write one content page as a single-page PDF.
+        """
+        c = canvas.Canvas(output_path, pagesize=letter)
+        self._draw_page(c, number, page)
         c.save()
+
+    def render_thumbnail(self, page: dict, output_path: str) -> bool:
+        """
+        Write a small WebP preview of the page's illustration. False if it has none.
+        """
+        image = page.get("image")
+        if image is None:
+            image_path = page.get("image_path")
+            if not image_path or not os.path.exists(image_path):
+                return False
+            image = Image.open(image_path)
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        thumbnail.save(output_path, format="WEBP", quality=80)
+        return True
+
+def merge_pdfs(parts: list, output_path: str):
+    """
+    Concatenate single-page PDFs into one document.
+    """
+    book = fitz.open()
+    for part in parts:
+        with fitz.open(part) as src:
+            book.insert_pdf(src)
+    tmp_path = f"{output_path}.tmp"
+    book.save(tmp_path)
+    book.close()
+    os.replace(tmp_path, output_path)
+
+class BookAssembly:
+    """
+    Builds a book while it is being generated.
+
+    Every page is rendered to its own single-page PDF (plus a WebP thumbnail)
+    as soon as its illustration is done, on a worker thread. draft() merges
+    what is finished so far; finalize() renders only what is still missing
+    and merges everything, which takes well under a second.
+
+    Parts live in generated_books/parts_<job_id>/ so any API worker can serve them.
+    """
+    def __init__(self, generator: PDFGenerator, job_id: str):
+        self.generator = generator
+        self.parts_dir = parts_dir(generator.output_dir, job_id)
+        os.makedirs(self.parts_dir, exist_ok=True)
+        self._rendered = {}
+        self._tasks = set()
+
+    def add_page(self, number: int, page: dict, on_done=None):
+        """
+        Render page `number` (1-based) in the background. on_done(number) runs when it is written.
+        """
+        task = asyncio.ensure_future(self._render(number, page))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if on_done:
+            task.add_done_callback(lambda t: on_done(number) if not t.cancelled() and t.exception() is None else None)
+
+    async def _render(self, number: int, page: dict):
+        await asyncio.to_thread(render_page_files, self.generator, self.parts_dir, number, page)
+        self._rendered[number] = page
+
+    async def finalize(self, pages: list, title: str, output_path: str) -> str:
+        """
+        Render the title and any page not rendered yet (or rendered from a different page object), then merge.
+        """
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        await asyncio.to_thread(self.generator.render_title, title, os.path.join(self.parts_dir, "title.pdf"))
+        for number, page in enumerate(pages, 1):
+            if self._rendered.get(number) is not page:
+                await self._render(number, page)
+        return await self._merge(len(pages), output_path)
+
+    async def rebuild(self, pages: list, title: str, output_path: str, changed: set) -> str:
+        """
+        Re-render the page numbers in `changed` (and any part that is missing on disk),
+        reuse every other page render, and merge.
+        """
+        title_part = os.path.join(self.parts_dir, "title.pdf")
+        if not os.path.exists(title_part):
+            await asyncio.to_thread(self.generator.render_title, title, title_part)
+        for number, page in enumerate(pages, 1):
+            if number in changed or not os.path.exists(page_part(self.parts_dir, number)):
+                await self._render(number, page)
+        return await self._merge(len(pages), output_path)
+
+    async def _merge(self, page_count: int, output_path: str) -> str:
+        parts = [os.path.join(self.parts_dir, "title.pdf")] + [page_part(self.parts_dir, n) for n in range(1, page_count + 1)]
+        await asyncio.to_thread(merge_pdfs, parts, output_path)
         return output_path
+
+def parts_dir(output_dir: str, job_id: str) -> str:
+    return os.path.join(output_dir, f"parts_{job_id}")
+
+def page_part(directory: str, number: int) -> str:
+    return os.path.join(directory, f"page_{number:02d}.pdf")
+
+def page_thumbnail(directory: str, number: int) -> str:
+    return os.path.join(directory, f"page_{number:02d}.webp")
+
+def render_page_files(generator: PDFGenerator, directory: str, number: int, page: dict):
+    """
+    Write a page's single-page PDF and thumbnail, each atomically.
+    """
+    tmp_path = f"{page_part(directory, number)}.tmp"
+    generator.render_page(number, page, tmp_path)
+    os.replace(tmp_path, page_part(directory, number))
+    tmp_path = f"{page_thumbnail(directory, number)}.tmp"
+    if generator.render_thumbnail(page, tmp_path):
+        os.replace(tmp_path, page_thumbnail(directory, number))
+
+def build_draft(directory: str, output_path: str) -> int:
+    """
+    Merge the title (if rendered) and the consecutive finished pages from page 1.
+    Returns the number of content pages included.
+    """
+    parts = []
+    title = os.path.join(directory, "title.pdf")
+    if os.path.exists(title):
+        parts.append(title)
+    number = 1
+    while os.path.exists(page_part(directory, number)):
+        parts.append(page_part(directory, number))
+        number += 1
+    if parts:
+        merge_pdfs(parts, output_path)
+    return number - 1
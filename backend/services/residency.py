@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from services.metrics import (model_resident, model_resident_bytes, model_memory_budget_bytes,
+                              model_loads_total, model_evictions_total, model_swaps_total)
+
+def module_bytes(module) -> int:
+    """
+    Memory held by a torch module's weights, including dynamically quantized Linear layers
+    (their int8 weights are packed params, not parameters).
+    """
+    total = sum(t.numel() * t.element_size() for t in module.parameters())
+    total += sum(t.numel() * t.element_size() for t in module.buffers())
+    for sub in module.modules():
+        if hasattr(sub, "_packed_params") and callable(getattr(sub, "weight", None)):
+            weight = sub.weight()
+            total += weight.numel() * weight.element_size()
+    return total
+
+class ModelResidency:
+    """
+    Keeps the models that are loaded at the same time within a memory budget.
+
+    Every engine's ModelLifecycle registers here. Before a job uses a model it
+    calls acquire(): if the model is not resident and doesn't fit, idle models
+    are evicted first (those no job is waiting for, least recently used first).
+    Models in use are never evicted; the caller waits for them to be released.
+
+    To batch jobs by stage, jobs asking for the model that is already resident
+    go ahead even while others wait to swap in a different model, so queued
+    jobs drain one stage before the next model is loaded. Once a swap has been
+    waiting longer than max_wait seconds, new users of the resident model queue
+    behind it, so no stage starves.
+
+    Evicted pipelines are simply dropped. Reloading reads the safetensors
+    weights again, which are memory-mapped and usually still in the OS page cache.
+    A budget of 0 disables all of this.
+
+    Residency, loads, evictions and swaps are exported as icbg_model_* metrics.
+    """
+    def __init__(self, budget_bytes: int = None, max_wait: float = None):
+        self.budget_bytes = budget_bytes if budget_bytes is not None else int(os.environ.get("ICBG_MODEL_MEMORY_BUDGET", "0"))
+        self.max_wait = max_wait if max_wait is not None else float(os.environ.get("ICBG_RESIDENCY_MAX_WAIT", "120"))
+        self._models = {}
+        self._waiting = {}
+        self._cond = asyncio.Condition()
+        self.evictions = {}
+        model_memory_budget_bytes.set(self.budget_bytes)
+
+    def register(self, lifecycle):
+        self._models[lifecycle.name] = lifecycle
+        self.evictions.setdefault(lifecycle.name, 0)
+        self.observe(lifecycle)
+
+    def observe(self, lifecycle, loaded: bool = False):
+        """
+        Refresh a model's metrics after its state changed. loaded counts a finished load.
+        """
+        model_resident.set(1 if lifecycle.is_resident else 0, model=lifecycle.name)
+        model_resident_bytes.set(lifecycle.resident_bytes if lifecycle.is_resident else 0, model=lifecycle.name)
+        if loaded:
+            model_loads_total.inc(model=lifecycle.name)
+
+    def resident_bytes(self) -> int:
+        return sum(m.resident_bytes for m in self._models.values() if m.is_resident)
+
+    def fits(self, lifecycle) -> bool:
+        """
+        True if the model can be loaded without evicting anything.
+        """
+        if not self.budget_bytes or lifecycle.is_resident:
+            return True
+        return self.resident_bytes() + lifecycle.resident_bytes <= self.budget_bytes
+
+    async def acquire(self, lifecycle):
+        """
+        Wait until the model may be used, evicting idle models to make room.
+        Models that were not resident have started loading when this returns.
+        """
+        if not self.budget_bytes:
+            return
+        name = lifecycle.name
+        since = time.monotonic()
+        waiting = self._waiting.setdefault(name, [])
+        waiting.append(since)
+        try:
+            async with self._cond:
+                while True:
+                    if lifecycle.is_resident:
+                        if not self._swap_overdue(name):
+                            return
+                    else:
+                        victims = self._victims(lifecycle)
+                        if victims is not None:
+                            evicted = 0
+                            for victim in victims:
+                                if await victim.unload():
+                                    self.evictions[victim.name] += 1
+                                    model_evictions_total.inc(model=victim.name)
+                                    evicted += 1
+                                    print(f"Evicted {victim.name} model to make room for {name}.")
+                            if evicted:
+                                model_swaps_total.inc(model=name)
+                            lifecycle.start()
+                            return
+                    try:
+                        # Re-check periodically: a swap can become overdue without any release
+                        await asyncio.wait_for(self._cond.wait(), timeout=5.0)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            waiting.remove(since)
+
+    def release(self, lifecycle):
+        """
+        Called when a job stops using a model, so waiting swaps can re-check.
+        """
+        if self.budget_bytes:
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def _swap_overdue(self, name: str) -> bool:
+        now = time.monotonic()
+        return any(
+            now - started > self.max_wait
+            for other, waiting in self._waiting.items() if other != name and not self._models[other].is_resident
+            for started in waiting
+        )
+
+    def _victims(self, lifecycle):
+        """
+        Idle models to evict so lifecycle fits, [] if it already fits, or None if it can't fit yet.
+        """
+        free = self.budget_bytes - self.resident_bytes()
+        if free >= lifecycle.resident_bytes:
+            return []
+        others = [m for m in self._models.values() if m is not lifecycle and m.is_resident]
+        idle = sorted(
+            (m for m in others if m.state == "ready" and m.in_use == 0),
+            key=lambda m: (len(self._waiting.get(m.name, [])), m.last_used)
+        )
+        victims = []
+        for model in idle:
+            if free >= lifecycle.resident_bytes:
+                break
+            victims.append(model)
+            free += model.resident_bytes
+        if free >= lifecycle.resident_bytes:
+            return victims
+        if len(victims) == len(others):
+            # Bigger than the whole budget on its own: load it alone
+            print(f"{lifecycle.name} model ({lifecycle.resident_bytes} bytes) exceeds the memory budget.")
+            return victims
+        return None
+
+    def status(self) -> dict:
+        return {
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": self.resident_bytes(),
+            "models": {
+                name: {
+                    "state": m.state,
+                    "resident": m.is_resident,
+                    "bytes": m.resident_bytes,
+                    "in_use": m.in_use,
+                    "waiting": len(self._waiting.get(name, [])),
+                    "swap_ins": m.loads,
+                    "evictions": self.evictions[name]
+                }
+                for name, m in self._models.items()
+            },
+            "swap_ins": sum(m.loads for m in self._models.values()),
+            "evictions": sum(self.evictions.values())
+        }
+
+# Shared by all engines in this process
+model_residency = ModelResidency()
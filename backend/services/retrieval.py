@@ -0,0 +1,137 @@
+from collections import Counter, OrderedDict
+import math
+import re
+import threading
+
+# Rough size of a token for budgeting prompt text without running the tokenizer
+CHARS_PER_TOKEN = 4
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have he her his i in is it its of on or she that the their them
+they this to was were which who will with you your we our not no so if then than there these those also
+""".split())
+
+def tokenize(text: str) -> list:
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+def chunk_pages(pages, target_chars: int = 600) -> list:
+    """
+    Split (page_num, text) pairs into chunks of roughly target_chars, built from
+    whole lines (PDF text rarely has blank lines between paragraphs).
+    Chunks never span pages. Returns [{"index": i, "page": n, "text": ...}] in document order.
+    """
+    chunks = []
+    for page_num, text in pages:
+        current = []
+        size = 0
+        for line in text.split("\n"):
+            line = " ".join(line.split())
+            if not line:
+                continue
+            if current and size + len(line) > target_chars:
+                chunks.append({"index": len(chunks), "page": page_num, "text": " ".join(current)})
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            chunks.append({"index": len(chunks), "page": page_num, "text": " ".join(current)})
+    return chunks
+
+class BM25Index:
+    """
+    Okapi BM25 over a document's chunks, used to pick the source excerpt most
+    relevant to the user's section description.
+    """
+    def __init__(self, chunks: list, k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize(chunk["text"])) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+        doc_freq = Counter()
+        for tf in self.term_freqs:
+            doc_freq.update(tf.keys())
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def scores(self, query: str) -> list:
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        scores = []
+        for tf, length in zip(self.term_freqs, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length) if self.avg_length else self.k1
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
+
+    def select(self, query: str, char_budget: int) -> list:
+        """
+        Highest scoring chunks that fit in char_budget, returned in document order.
+        Falls back to the leading chunks when nothing matches the query.
+        """
+        scores = self.scores(query) if query.strip() else []
+        ranked = [i for i in sorted(range(len(self.chunks)), key=lambda i: -scores[i]) if scores[i] > 0] if scores else []
+        if not ranked:
+            ranked = list(range(len(self.chunks)))
+
+        chosen = []
+        remaining = char_budget
+        for i in ranked:
+            size = len(self.chunks[i]["text"]) + 2
+            if size <= remaining:
+                chosen.append(i)
+                remaining -= size
+            if remaining < 80:
+                break
+        if not chosen and ranked:
+            # Even the best chunk is too big: keep its beginning
+            best = self.chunks[ranked[0]]
+            return [dict(best, text=best["text"][:char_budget])]
+        return [self.chunks[i] for i in sorted(chosen)]
+
+def join_chunks(chunks: list) -> str:
+    """
+    Join selected chunks, marking gaps between chunks that are not adjacent.
+    """
+    parts = []
+    previous = None
+    for chunk in chunks:
+        if previous is not None and chunk["index"] - previous > 1:
+            parts.append("...")
+        parts.append(chunk["text"])
+        previous = chunk["index"]
+    return "\n\n".join(parts)
+
+class IndexCache:
+    """
+    Small in-process LRU of BM25 indexes keyed by (doc_id, first_page, last_page).
+    """
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key: tuple, build) -> BM25Index:
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return index
+            self.misses += 1
+
+        index = build()
+        with self._lock:
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
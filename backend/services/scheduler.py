@@ -0,0 +1,173 @@
+from collections import deque
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from services.metrics import queue_wait_seconds
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+DEFAULT_STAGE_LIMITS = "ingest=4,llm=1,image=1,pdf=2"
+
+def _parse_stage_limits(spec: str) -> dict:
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            limits[name.strip()] = max(1, int(value))
+    return limits
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class JobScheduler:
+    """
+    Admission control and ordering for generation jobs.
+
+    - At most max_active jobs run at once; the rest wait in a priority queue
+      (high > normal > low, FIFO within a level) of at most max_queued entries.
+    - Each pipeline stage (ingest/llm/image/pdf) has its own concurrency limit,
+      taken with `async with scheduler.stage("llm"):`.
+    - Every job gets a threading.Event that is set on cancellation, so work
+      running on inference threads can stop early as well.
+    - With `slots` (a WorkerRegistry) a job also needs one of max_active slots
+      shared by all API workers before it starts, so the limit is global.
+      Queues stay per worker; dispatch() retries once another worker frees a slot.
+    """
+    def __init__(self, max_active: int = None, max_queued: int = None, stage_limits: dict = None, slots=None):
+        self.max_active = max_active or int(os.environ.get("ICBG_MAX_ACTIVE_JOBS", "2"))
+        self.slots = slots
+        self.max_queued = max_queued or int(os.environ.get("ICBG_MAX_QUEUED_JOBS", "20"))
+        limits = stage_limits or _parse_stage_limits(os.environ.get("ICBG_STAGE_LIMITS", DEFAULT_STAGE_LIMITS))
+        self._stages = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+        self._heap = []
+        self._counter = itertools.count()
+        self._queued = {}
+        self._running = {}
+        self._cancel_events = {}
+        self._submitted = {}
+        self._waits = {}
+        self._durations = deque(maxlen=20)
+
+    @property
+    def queued_count(self) -> int:
+        return len(self._queued)
+
+    @property
+    def running_count(self) -> int:
+        return len(self._running)
+
+    def is_full(self) -> bool:
+        return len(self._queued) >= self.max_queued
+
+    def retry_after(self) -> int:
+        """
+        Seconds until a queue slot is likely to free up, from recent job durations.
+        """
+        average = (sum(self._durations) / len(self._durations)) if self._durations else 60.0
+        return max(5, math.ceil(average * math.ceil((len(self._queued) + 1) / self.max_active)))
+
+    def submit(self, job_id: str, run, priority: str = "normal"):
+        """
+        Queue a job. run(cancel_event) must return the coroutine that executes it.
+        Raises QueueFullError when the queue is at capacity.
+        """
+        if self.is_full():
+            raise QueueFullError(self.retry_after())
+        heapq.heappush(self._heap, (PRIORITIES.get(priority, PRIORITIES["normal"]), next(self._counter), job_id))
+        self._queued[job_id] = run
+        self._cancel_events[job_id] = threading.Event()
+        self._submitted[job_id] = time.monotonic()
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Start queued jobs while there is room.
+        """
+        while self._heap and len(self._running) < self.max_active:
+            job_id = self._heap[0][2]
+            if job_id not in self._queued:
+                # Cancelled while queued
+                heapq.heappop(self._heap)
+                continue
+            if self.slots is not None and not self.slots.acquire_slot(job_id, self.max_active):
+                # Other workers hold every slot
+                return
+            heapq.heappop(self._heap)
+            run = self._queued.pop(job_id)
+            self._waits[job_id] = time.monotonic() - self._submitted.pop(job_id)
+            queue_wait_seconds.observe(self._waits[job_id])
+            self._running[job_id] = asyncio.create_task(self._run(job_id, run))
+
+    async def _run(self, job_id: str, run):
+        started = time.monotonic()
+        try:
+            await run(self._cancel_events[job_id])
+        except asyncio.CancelledError:
+            print(f"Job {job_id} cancelled.")
+        finally:
+            self._durations.append(time.monotonic() - started)
+            self._running.pop(job_id, None)
+            self._cancel_events.pop(job_id, None)
+            self._waits.pop(job_id, None)
+            if self.slots is not None:
+                self.slots.release_slot(job_id)
+            self.dispatch()
+
+    def jobs(self) -> set:
+        """
+        Ids of the jobs queued or running here.
+        """
+        return set(self._queued) | set(self._running)
+
+    def queue_wait(self, job_id: str):
+        """
+        Seconds a running job waited in the queue, or None if it is not running.
+        """
+        return self._waits.get(job_id)
+
+    def stage(self, name: str) -> asyncio.Semaphore:
+        """
+        Concurrency limit for a pipeline stage, used as an async context manager.
+        """
+        if name not in self._stages:
+            self._stages[name] = asyncio.Semaphore(1)
+        return self._stages[name]
+
+    def position(self, job_id: str):
+        """
+        1-based place in the queue, or None if the job is not queued.
+        """
+        if job_id not in self._queued:
+            return None
+        ahead = sorted(entry for entry in self._heap if entry[2] in self._queued)
+        return next(i for i, entry in enumerate(ahead, 1) if entry[2] == job_id)
+
+    async def wait(self, job_id: str, timeout: float = None):
+        """
+        Wait until a running job has finished unwinding (e.g. after cancel()).
+        """
+        task = self._running.get(job_id)
+        if task is not None:
+            await asyncio.wait({task}, timeout=timeout)
+
+    def cancel(self, job_id: str):
+        """
+        Cancel a queued or running job. Returns "queued", "running" or None if unknown.
+        """
+        if self._queued.pop(job_id, None) is not None:
+            self._cancel_events.pop(job_id, None)
+            self._submitted.pop(job_id, None)
+            return "queued"
+        task = self._running.get(job_id)
+        if task is not None:
+            # Stop in-flight model work first, then interrupt the coroutine
+            self._cancel_events[job_id].set()
+            task.cancel()
+            return "running"
+        return None
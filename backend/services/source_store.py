@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit")
+        self.max_bytes = max_bytes
+
+class SourceStore:
+    """
+    Content-addressed storage for uploaded source documents.
+
+    Each distinct document is stored once as <root>/blobs/<sha256><ext>; the
+    hash is computed while the upload is copied out of Starlette's spooled
+    file, so a re-upload of a known document only costs that read. Oversized
+    request bodies are refused before they are spooled (main.UploadSizeLimit). Upload names map to blobs in SQLite
+    (<root>/index.db), which keeps the /source_files/{filename} API working:
+    uploading a different file under an existing name repoints the name, and
+    the previous blob stays for the jobs that use it. Jobs refer to documents
+    by hash, which is also the ingestion caches' document id.
+
+    Files saved by name directly in <root> before this store existed are
+    still resolved by name.
+    """
+    def __init__(self, root: str = "source_files", max_bytes: int = None):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.max_bytes = max_bytes or int(os.environ.get("ICBG_MAX_UPLOAD_BYTES", DEFAULT_MAX_UPLOAD_BYTES))
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(root, "index.db"), check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS sources (
+                    name TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    ext TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL
+                )
+            """)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sources)")}
+            if "last_used" not in columns:
+                # Index created before last use was tracked
+                self._conn.execute("ALTER TABLE sources ADD COLUMN last_used REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sources_digest ON sources(digest)")
+        self.dedup_hits = 0
+
+    @staticmethod
+    def clean_name(name: str) -> str:
+        return os.path.basename(name or "") or "upload"
+
+    def blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.blob_dir, f"{digest}{ext}")
+
+    async def save(self, fileobj, name: str) -> dict:
+        """
+        Store an uploaded file under name. Returns {"name", "digest", "path", "bytes", "deduplicated"}.
+        Raises UploadTooLarge as soon as more than max_bytes have been read.
+        """
+        return await asyncio.to_thread(self._save, fileobj, self.clean_name(name))
+
+    def _save(self, fileobj, name: str) -> dict:
+        ext = os.path.splitext(name)[1].lower()
+        tmp_path = os.path.join(self.blob_dir, f".upload-{uuid.uuid4().hex}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadTooLarge(self.max_bytes)
+                    digest.update(chunk)
+                    out.write(chunk)
+            digest = digest.hexdigest()
+            path = self.blob_path(digest, ext)
+            deduplicated = os.path.exists(path)
+            if deduplicated:
+                self.dedup_hits += 1
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT INTO sources (name, digest, ext, bytes, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET digest = excluded.digest, ext = excluded.ext, "
+                "bytes = excluded.bytes, created_at = excluded.created_at, last_used = excluded.last_used",
+                (name, digest, ext, size, now, now)
+            )
+        return {"name": name, "digest": digest, "path": path, "bytes": size, "deduplicated": deduplicated}
+
+    def resolve(self, name: str):
+        """
+        Path of the document stored under name, or None.
+        """
+        name = self.clean_name(name)
+        with self._lock:
+            row = self._conn.execute("SELECT digest, ext FROM sources WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            path = self.blob_path(*row)
+            return path if os.path.exists(path) else None
+        legacy_path = os.path.join(self.root, name)
+        return legacy_path if os.path.isfile(legacy_path) else None
+
+    def remove(self, name: str):
+        """
+        Forget a name. Its blob is deleted once no other name refers to it.
+        Returns the bytes freed, or None if there is no such name.
+        """
+        name = self.clean_name(name)
+        with self._lock:
+            row = self._conn.execute("SELECT digest, ext, bytes FROM sources WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                legacy_path = os.path.join(self.root, name)
+                if os.path.isfile(legacy_path):
+                    size = os.path.getsize(legacy_path)
+                    os.remove(legacy_path)
+                    return size
+                return None
+            self._conn.execute("DELETE FROM sources WHERE name = ?", (name,))
+            shared = self._conn.execute("SELECT 1 FROM sources WHERE digest = ?", (row[0],)).fetchone()
+        if shared is not None:
+            return 0
+        try:
+            os.remove(self.blob_path(row[0], row[1]))
+        except OSError:
+            return 0
+        return row[2]
+
+    def touch(self, name: str):
+        """
+        Record a use of the document (a download), which keeps it from expiring.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE sources SET last_used = ? WHERE name = ?", (time.time(), self.clean_name(name)))
+
+    def digest(self, name: str):
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM sources WHERE name = ?", (self.clean_name(name),)).fetchone()
+        return row[0] if row else None
+
+    def entries(self) -> list:
+        """
+        All names as {"name", "digest", "bytes", "created_at", "last_used"}, from the index.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT name, digest, bytes, created_at, COALESCE(last_used, created_at) FROM sources").fetchall()
+        return [{"name": name, "digest": digest, "bytes": size, "created_at": created_at, "last_used": last_used}
+                for name, digest, size, created_at, last_used in rows]
+
+    def blobs(self):
+        """
+        Yield (path, digest, bytes, mtime) for every stored blob, finished uploads only.
+        """
+        for entry in os.scandir(self.blob_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                yield entry.path, os.path.splitext(entry.name)[0], stat.st_size, stat.st_mtime
+
+    def digests(self) -> set:
+        """
+        Hashes of all documents that still have a name.
+        """
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT DISTINCT digest FROM sources")}
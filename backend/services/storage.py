@@ -0,0 +1,294 @@
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from services.metrics import metrics
+
+DAY = 24 * 60 * 60
+
+# Seconds to keep each directory's content after its last use; 0 keeps it forever
+DEFAULT_TTLS = f"generated_books={30 * DAY},source_files={30 * DAY}"
+
+reclaimed_bytes_total = metrics.counter("icbg_storage_reclaimed_bytes_total", "Bytes freed by the storage sweeper, by reason.")
+
+def _parse_ttls(spec: str) -> dict:
+    ttls = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            ttls[name.strip()] = max(0.0, float(value))
+    return ttls
+
+def path_bytes(path: str) -> int:
+    """
+    Size of a file, or of everything under a directory. 0 if it doesn't exist.
+    """
+    try:
+        if os.path.isdir(path):
+            return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class StorageManager:
+    """
+    Index of generated books on disk and a sweeper that keeps storage bounded.
+
+    write_manifest() records every book here (its manifest, PDF, images and
+    page parts, with their size), and downloads touch its last use. A sweep
+    then works from the index instead of listing directories:
+
+    - TTL: books and source names unused (downloaded, uploaded again) for
+      longer than their directory's TTL (ICBG_STORAGE_TTL) are deleted.
+    - Quota: while books + source documents exceed ICBG_DISK_QUOTA_BYTES, the
+      least recently used are deleted. A document stored under several names
+      counts once and goes with all of them.
+    - Orphans: only here are the directories scanned, for files no manifest
+      or source name refers to (images and parts of failed jobs, PDFs without
+      a manifest, drafts left inside parts directories, unnamed source blobs).
+      Anything younger than the grace period, and any image made since the
+      oldest active job started, may still belong to a running job and is kept.
+
+    Deleting a book goes through remove_book(job_id), the same code as
+    DELETE /books/{job_id}. Books and sources of active jobs are never touched.
+    """
+    def __init__(self, source_store, remove_book, db_path: str = "storage.db", books_dir: str = "generated_books",
+                 images_dir: str = "generated_images", ttls: dict = None, quota_bytes: int = None,
+                 orphan_grace: float = None):
+        self.source_store = source_store
+        self.remove_book = remove_book
+        self.books_dir = books_dir
+        self.images_dir = images_dir
+        self.ttls = ttls if ttls is not None else _parse_ttls(os.environ.get("ICBG_STORAGE_TTL", DEFAULT_TTLS))
+        self.quota_bytes = quota_bytes if quota_bytes is not None else int(os.environ.get("ICBG_DISK_QUOTA_BYTES", "0"))
+        self.orphan_grace = orphan_grace if orphan_grace is not None else float(os.environ.get("ICBG_ORPHAN_GRACE_SECONDS", "3600"))
+        self.last_report = None
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS books (
+                    job_id TEXT PRIMARY KEY,
+                    manifest_path TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_books_last_used ON books(last_used)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS book_files (
+                    path TEXT PRIMARY KEY,
+                    job_id TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_book_files_job ON book_files(job_id)")
+
+    # --- Index ---
+
+    def record_book(self, job_id: str, manifest_path: str, manifest: dict):
+        """
+        Add or refresh a book from its manifest. Paths that were never created are left out.
+        """
+        paths = [manifest.get("pdf_path"), manifest.get("parts_dir"), *manifest.get("images", [])]
+        paths = [os.path.normpath(path) for path in paths if path and os.path.exists(path)]
+        size = path_bytes(manifest_path) + sum(path_bytes(path) for path in paths)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO books (job_id, manifest_path, bytes, created_at, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET manifest_path = excluded.manifest_path, bytes = excluded.bytes, "
+                "last_used = excluded.last_used",
+                (job_id, manifest_path, size, now, now)
+            )
+            self._conn.execute("DELETE FROM book_files WHERE job_id = ?", (job_id,))
+            self._conn.executemany("INSERT OR REPLACE INTO book_files (path, job_id) VALUES (?, ?)", [(path, job_id) for path in paths])
+
+    def touch(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE books SET last_used = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def forget_book(self, job_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM books WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM book_files WHERE job_id = ?", (job_id,))
+
+    def status(self) -> dict:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM books").fetchone()
+        sources = self.source_store.entries()
+        return {
+            "books": count,
+            "book_bytes": size,
+            "sources": len(sources),
+            "source_bytes": sum(entry["bytes"] for entry in {e["digest"]: e for e in sources}.values()),
+            "quota_bytes": self.quota_bytes,
+            "ttls": self.ttls,
+            "last_sweep": self.last_report
+        }
+
+    # --- Sweeping ---
+
+    async def run_forever(self, interval: float, active_jobs, enabled=None):
+        """
+        Sweep every interval seconds. active_jobs() returns the records of unfinished jobs.
+        enabled(), if given, is asked before each sweep (one sweeper among several workers).
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if enabled is not None and not enabled():
+                continue
+            try:
+                await self.sweep_async(active_jobs())
+            except Exception as e:
+                print(f"Storage sweep failed: {e}")
+
+    async def sweep_async(self, active: list) -> dict:
+        return await asyncio.to_thread(self.sweep, active)
+
+    def sweep(self, active: list) -> dict:
+        """
+        One pass of TTL expiry, quota eviction and orphan removal. Blocking; run off the event loop.
+        active is the list of unfinished job records, whose files are kept.
+        """
+        started = time.perf_counter()
+        active_jobs = {job["id"] for job in active} | {job.get("batch_id") for job in active if job.get("batch_id")}
+        active_digests = {job.get("source_digest") for job in active if job.get("source_digest")}
+        report = {"reclaimed_bytes": 0, "by_reason": {"ttl": 0, "quota": 0, "orphan": 0},
+                  "removed": {"books": 0, "sources": 0, "orphans": 0}}
+
+        def reclaimed(reason: str, kind: str, size: int):
+            report["reclaimed_bytes"] += size
+            report["by_reason"][reason] += size
+            report["removed"][kind] += 1
+            reclaimed_bytes_total.inc(size, reason=reason)
+
+        now = time.time()
+        # 1. TTLs
+        book_ttl = self.ttls.get(self.books_dir, 0)
+        if book_ttl:
+            with self._lock:
+                expired = self._conn.execute("SELECT job_id, bytes FROM books WHERE last_used < ?", (now - book_ttl,)).fetchall()
+            for job_id, size in expired:
+                if job_id not in active_jobs and self._remove_book(job_id):
+                    reclaimed("ttl", "books", size)
+        source_ttl = self.ttls.get(self.source_store.root, 0)
+        if source_ttl:
+            for entry in self.source_store.entries():
+                if entry["last_used"] < now - source_ttl and entry["digest"] not in active_digests:
+                    size = self.source_store.remove(entry["name"])
+                    if size is not None:
+                        reclaimed("ttl", "sources", size)
+
+        # 2. Quota, least recently used first across books and source documents
+        if self.quota_bytes:
+            with self._lock:
+                books = self._conn.execute("SELECT job_id, bytes, last_used FROM books").fetchall()
+            candidates = [(last_used, "book", job_id, size) for job_id, size, last_used in books]
+            # One candidate per stored document, however many names point at it
+            documents = {}
+            for entry in self.source_store.entries():
+                document = documents.setdefault(entry["digest"], {"last_used": 0.0, "bytes": entry["bytes"], "names": []})
+                document["last_used"] = max(document["last_used"], entry["last_used"])
+                document["names"].append(entry["name"])
+            candidates += [(d["last_used"], "source", digest, d["bytes"]) for digest, d in documents.items()]
+            total = sum(c[3] for c in candidates)
+            for _, kind, key, size in sorted(candidates):
+                if total <= self.quota_bytes:
+                    break
+                if kind == "book" and key not in active_jobs and self._remove_book(key):
+                    reclaimed("quota", "books", size)
+                    total -= size
+                elif kind == "source" and key not in active_digests:
+                    freed = sum(self.source_store.remove(name) or 0 for name in documents[key]["names"])
+                    reclaimed("quota", "sources", freed)
+                    total -= size
+
+        # 3. Orphans
+        for path, size in self._orphans(now, active, active_jobs, active_digests):
+            try:
+                if os.path.isdir(path):
+                    for entry in os.scandir(path):
+                        os.remove(entry.path)
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                continue
+            reclaimed("orphan", "orphans", size)
+
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        report["finished_at"] = time.time()
+        self.last_report = report
+        if report["reclaimed_bytes"]:
+            print(f"Storage sweep reclaimed {report['reclaimed_bytes']} bytes: {report['removed']}")
+        return report
+
+    def _remove_book(self, job_id: str) -> bool:
+        try:
+            self.remove_book(job_id)
+        except Exception as e:
+            print(f"Failed to remove book {job_id}: {e}")
+            return False
+        self.forget_book(job_id)
+        return True
+
+    def _orphans(self, now: float, active: list, active_jobs: set, active_digests: set):
+        """
+        Yield (path, bytes) of files nothing refers to, older than the grace period.
+        Also adopts manifests the index doesn't know yet (written before it existed).
+        """
+        with self._lock:
+            indexed = {row[0] for row in self._conn.execute("SELECT job_id FROM books")}
+            referenced = {row[0] for row in self._conn.execute("SELECT path FROM book_files")}
+        cutoff = now - self.orphan_grace
+
+        for manifest_path in glob.glob(os.path.join(self.books_dir, "manifest_*.json")):
+            job_id = os.path.basename(manifest_path)[len("manifest_"):-len(".json")]
+            if job_id in indexed:
+                continue
+            try:
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self.record_book(job_id, manifest_path, manifest)
+            indexed.add(job_id)
+            referenced.update(os.path.normpath(p) for p in [manifest.get("pdf_path"), manifest.get("parts_dir"), *manifest.get("images", [])] if p)
+
+        def unclaimed(entry, before: float = cutoff) -> bool:
+            return os.path.normpath(entry.path) not in referenced and entry.stat().st_mtime < before
+
+        if os.path.isdir(self.books_dir):
+            for entry in os.scandir(self.books_dir):
+                name = entry.name
+                if not (name.startswith("book_") or name.startswith("parts_")):
+                    continue
+                job_id = name.split("_", 1)[1].split(".")[0]
+                if job_id in active_jobs:
+                    continue
+                if unclaimed(entry):
+                    yield entry.path, path_bytes(entry.path)
+                elif entry.is_dir():
+                    # Drafts are removed once served; any still here are left over
+                    for part in os.scandir(entry.path):
+                        if part.name.startswith("draft_") and part.stat().st_mtime < cutoff:
+                            yield part.path, part.stat().st_size
+
+        if os.path.isdir(self.images_dir):
+            # Image files are not named after their job and only enter the index with
+            # its manifest, so keep everything made since the oldest active job started
+            started = [job["created_at"] for job in active if job.get("created_at")]
+            images_cutoff = min([cutoff, *started])
+            for entry in os.scandir(self.images_dir):
+                if entry.is_file() and unclaimed(entry, images_cutoff):
+                    yield entry.path, entry.stat().st_size
+
+        named = self.source_store.digests() | active_digests
+        for path, digest, size, mtime in self.source_store.blobs():
+            if digest not in named and mtime < cutoff:
+                yield path, size
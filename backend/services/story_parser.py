@@ -0,0 +1,194 @@
+import re
+
+PAGE_BREAK = "---PAGE BREAK---"
+MAX_PAGES = 10
+
+TITLE_PATTERN = re.compile(r"^TITLE:\s*(.*)$", re.MULTILINE | re.IGNORECASE)
+
+def parse_title(response: str, theme: str) -> tuple:
+    """
+    Extract the book title from the start of the LLM response.
+    Returns (title, response_without_title_line).
+    """
+    title = f"The Story of {theme}" # Default fallback
+
+    # 1. Try strict regex for "TITLE: ..."
+    title_match = TITLE_PATTERN.search(response)
+    if title_match:
+        raw_title = title_match.group(1).strip()
+        # Clean up quotes and extra spaces
+        title = raw_title.strip('"').strip("'").strip()
+        # Remove the title line from response
+        response = response.replace(title_match.group(0), "").strip()
+    else:
+        # 2. Fallback: Check first line if it looks like a title (short, no "Here is")
+        first_line = response.split('\n')[0].strip()
+        if len(first_line) < 60 and not any(x in first_line.lower() for x in ["here is", "sure", "certainly", "okay"]):
+            title = first_line.strip('"').strip("'")
+            response = "\n".join(response.split('\n')[1:]).strip()
+
+    # Final cleanup of title just in case
+    title = title.replace("Book Title:", "").strip()
+    return title, response
+
+def parse_page(raw_page: str, index: int, theme: str):
+    """
+    Parse one '---PAGE BREAK---' section into {"text", "image_prompt"}.
+    Returns None for empty sections.
+    """
+    if not raw_page.strip():
+        return None
+
+    # Robust parsing logic
+    lines = raw_page.strip().split('\n')
+    text = ""
+    image_prompt = ""
+
+    current_section = None # 'text' or 'image'
+
+    for line in lines:
+        clean_line = line.strip()
+        if not clean_line:
+            continue
+
+        if "Text:" in clean_line:
+            current_section = 'text'
+            text += clean_line.split("Text:", 1)[1].strip() + " "
+        elif "Image:" in clean_line:
+            current_section = 'image'
+            image_prompt += clean_line.split("Image:", 1)[1].strip() + " "
+        elif "Description:" in clean_line:
+            current_section = 'image'
+            image_prompt += clean_line.split("Description:", 1)[1].strip() + " "
+        else:
+            # Append to current section if it's a continuation
+            if current_section == 'text':
+                text += clean_line + " "
+            elif current_section == 'image':
+                image_prompt += clean_line + " "
+            else:
+                # If no section defined yet, assume it's text
+                current_section = 'text'
+                text += clean_line + " "
+
+    # Fallback if parsing failed but content exists
+    if not text.strip() and len(lines) > 0:
+        text = raw_page.strip()
+    if not image_prompt.strip():
+        image_prompt = f"Illustration for page {index+1} about {theme}"
+
+    return {"text": text.strip(), "image_prompt": image_prompt.strip()}
+
+def needs_smart_split(pages: list) -> bool:
+    return not pages or (len(pages) == 1 and len(pages[0]['text']) > 500)
+
+def smart_split(full_text: str, theme: str) -> list:
+    """
+    Fallback used when the model ignored the page format: group sentences into pages.
+    """
+    # Split into sentences (simple heuristic)
+    sentences = re.split(r'(?<=[.!?]) +', full_text)
+
+    # Group sentences into pages (e.g., 3 sentences per page)
+    sentences_per_page = 3
+    chunks = [sentences[i:i + sentences_per_page] for i in range(0, len(sentences), sentences_per_page)]
+
+    pages = []
+    for chunk in chunks:
+        page_text = " ".join(chunk).strip()
+        if not page_text: continue
+
+        # Generate a generic image prompt based on the chunk
+        # Ideally we'd ask the LLM, but for speed/fallback we use the text + theme
+        image_prompt = f"Illustration for: {page_text[:50]}..., theme: {theme}"
+
+        pages.append({"text": page_text, "image_prompt": image_prompt})
+
+    # Ensure we have at least 10 pages if possible, or just use what we have
+    # If we have too many, truncate. If too few, that's okay for fallback.
+    return pages
+
+class StoryStreamParser:
+    """
+    Incremental version of the story parser.
+
+    Feed it decoded text as the LLM produces it; every time a '---PAGE BREAK---'
+    closes a section the parsed page is returned, so illustration can start
+    before decoding finishes. finish() parses the trailing section and applies
+    the same fallbacks as a one-shot parse.
+
+    The first page is held back until a second one is complete: a story that
+    turns out to be a single long page is re-split by finish(), and only the
+    pages it returns are illustrated.
+    """
+    def __init__(self, theme: str, max_pages: int = MAX_PAGES):
+        self.theme = theme
+        self.max_pages = max_pages
+        self.text = ""
+        self.title = None
+        self.pages = []
+        self._buffer = ""
+        self._sections = 0
+        self._emitted = 0
+
+    @property
+    def complete(self) -> bool:
+        return len(self.pages) >= self.max_pages
+
+    def feed(self, chunk: str) -> list:
+        """
+        Add decoded text. Returns the pages that are final as of this chunk.
+        """
+        self.text += chunk
+        self._buffer += chunk
+        while PAGE_BREAK in self._buffer:
+            section, self._buffer = self._buffer.split(PAGE_BREAK, 1)
+            self._close_section(section)
+        if len(self.pages) < 2:
+            return []
+        completed = self.pages[self._emitted:]
+        self._emitted = len(self.pages)
+        return completed
+
+    def _close_section(self, section: str):
+        if self.title is None:
+            self.title, section = parse_title(section.strip(), self.theme)
+        index = self._sections
+        self._sections += 1
+        page = parse_page(section, index, self.theme)
+        if page is None or self.complete:
+            return None
+        self.pages.append(page)
+        return page
+
+    def finish(self) -> dict:
+        """
+        Close the trailing section and return {"title", "pages"}.
+        """
+        if self._sections == 0:
+            # No page breaks at all: parse the whole response at once
+            self.title, response = parse_title(self._buffer.strip(), self.theme)
+            page = parse_page(response, 0, self.theme)
+            if page:
+                self.pages.append(page)
+        else:
+            response = None
+            self._close_section(self._buffer)
+        self._buffer = ""
+
+        pages = self.pages
+        if needs_smart_split(pages):
+            print("Parsing failed or single long page detected. Using Smart Splitter.")
+            # Use the raw response (or the single page text)
+            full_text = pages[0]['text'] if pages else (response or "")
+            pages = smart_split(full_text, self.theme)
+
+        return {"title": self.title, "pages": pages[:self.max_pages]}
+
+def parse_story(response: str, theme: str, max_pages: int = MAX_PAGES) -> dict:
+    """
+    Parse a complete LLM response into {"title", "pages"}.
+    """
+    parser = StoryStreamParser(theme, max_pages=max_pages)
+    parser.feed(response)
+    return parser.finish()
@@ -0,0 +1,171 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# Seconds after which a cancel request for a job nobody picked up is dropped
+CANCEL_REQUEST_TTL = 60
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class WorkerRegistry:
+    """
+    API worker processes sharing one job database (uvicorn --workers N).
+
+    Each worker registers under its own id and heartbeats while it runs. The
+    rows here are what lets several workers act as one service:
+
+    - Liveness: a worker is gone once its heartbeat is older than three
+      intervals or, on this host, its process has exited. JobStore.recover()
+      fails (or restores) the unfinished jobs of gone workers.
+    - Job slots: the scheduler claims a slot per running job, so
+      ICBG_MAX_ACTIVE_JOBS holds across all workers, not per worker.
+    - Cancel requests: cancelling a job on another worker than the one running
+      it leaves a request here that the owner picks up.
+    - Leadership: the longest-running live worker does the storage sweeps.
+
+    Everything lives in the job database (ICBG_JOB_DB), next to the job records.
+    """
+    def __init__(self, db_path: str = None, heartbeat_seconds: float = None):
+        self.db_path = db_path or os.environ.get("ICBG_JOB_DB", "jobs.db")
+        self.heartbeat_seconds = heartbeat_seconds or float(os.environ.get("ICBG_WORKER_HEARTBEAT_SECONDS", "5"))
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.worker_id = f"{self.host}:{self.pid}:{uuid.uuid4().hex[:8]}"
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    id TEXT PRIMARY KEY,
+                    host TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    started_at REAL NOT NULL,
+                    heartbeat REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_slots (
+                    job_id TEXT PRIMARY KEY,
+                    worker TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cancel_requests (
+                    job_id TEXT PRIMARY KEY,
+                    requested_at REAL NOT NULL
+                )
+            """)
+        self.started_at = time.time()
+        self.heartbeat()
+
+    # --- Liveness ---
+
+    def heartbeat(self):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO workers (id, host, pid, started_at, heartbeat) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (self.worker_id, self.host, self.pid, self.started_at, now)
+            )
+
+    def unregister(self):
+        """
+        Leave on shutdown, so the other workers recover this worker's jobs right away.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE id = ?", (self.worker_id,))
+            self._conn.execute("DELETE FROM job_slots WHERE worker = ?", (self.worker_id,))
+
+    def _is_alive(self, worker_id: str, host: str, pid: int, heartbeat: float, now: float) -> bool:
+        if worker_id == self.worker_id:
+            return True
+        if heartbeat < now - 3 * self.heartbeat_seconds:
+            return False
+        if host == self.host:
+            # A reused pid (e.g. pid 1 in a restarted container) is a previous process
+            return pid != self.pid and _pid_alive(pid)
+        return True
+
+    def live(self) -> set:
+        """
+        Ids of the workers that are still running. Rows of gone workers and their slots are dropped.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT id, host, pid, heartbeat FROM workers").fetchall()
+            live = {row[0] for row in rows if self._is_alive(*row, now)}
+            gone = [(row[0],) for row in rows if row[0] not in live]
+            if gone:
+                self._conn.executemany("DELETE FROM workers WHERE id = ?", gone)
+                self._conn.executemany("DELETE FROM job_slots WHERE worker = ?", gone)
+        return live
+
+    def is_leader(self) -> bool:
+        """
+        True on exactly one live worker: the one started first.
+        """
+        live = self.live()
+        with self._lock:
+            rows = self._conn.execute("SELECT id, started_at FROM workers").fetchall()
+        first = min(((started_at, worker_id) for worker_id, started_at in rows if worker_id in live), default=(0, self.worker_id))
+        return first[1] == self.worker_id
+
+    # --- Job slots ---
+
+    def acquire_slot(self, job_id: str, limit: int) -> bool:
+        """
+        Claim one of `limit` slots shared by all workers for a job about to run.
+        """
+        self.live()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                taken = self._conn.execute("SELECT COUNT(*) FROM job_slots").fetchone()[0]
+                acquired = taken < limit
+                if acquired:
+                    self._conn.execute("INSERT OR REPLACE INTO job_slots (job_id, worker) VALUES (?, ?)", (job_id, self.worker_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return acquired
+
+    def release_slot(self, job_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM job_slots WHERE job_id = ? AND worker = ?", (job_id, self.worker_id))
+
+    def is_running(self, job_id: str) -> bool:
+        """
+        True while some worker still runs the job (including its cleanup).
+        """
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM job_slots WHERE job_id = ?", (job_id,)).fetchone() is not None
+
+    # --- Cancel requests ---
+
+    def request_cancel(self, job_id: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO cancel_requests (job_id, requested_at) VALUES (?, ?)", (job_id, time.time()))
+
+    def take_cancel_requests(self, job_ids: set) -> list:
+        """
+        Cancel requests for the given jobs (the ones this worker has), removed once taken.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM cancel_requests WHERE requested_at < ?", (time.time() - CANCEL_REQUEST_TTL,))
+            requested = [row[0] for row in self._conn.execute("SELECT job_id FROM cancel_requests")]
+            taken = [(job_id,) for job_id in requested if job_id in job_ids]
+            self._conn.executemany("DELETE FROM cancel_requests WHERE job_id = ?", taken)
+        return [job_id for job_id, in taken]
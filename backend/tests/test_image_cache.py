@@ -0,0 +1,81 @@
+import os
+from PIL import Image
+from services.image_cache import ImageCache
+
+def make_cache(tmp_path, **kwargs):
+    return ImageCache(str(tmp_path / "images"), **kwargs)
+
+def image(color: str = "red"):
+    return Image.new("RGB", (8, 8), color)
+
+def age(cache, key: str, seconds: float):
+    cache._conn.execute("UPDATE images SET last_used = last_used - ? WHERE key = ?", (seconds, key))
+
+def test_put_then_get_hits(tmp_path):
+    cache = make_cache(tmp_path)
+    path = cache.put("k1", image())
+
+    assert cache.get("k1") == path
+    assert cache.get("k2") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.owns(path)
+    assert not cache.owns(str(tmp_path / "elsewhere" / "k1.png"))
+
+def test_evicts_least_recently_used_unreferenced_images(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1, pin_seconds=60)
+    old = cache.put("old", image())
+    older = cache.put("older", image())
+    age(cache, "old", 100)
+    age(cache, "older", 200)
+    cache.acquire(old)
+
+    cache.put("new", image())
+
+    assert os.path.exists(old)
+    assert not os.path.exists(older)
+    assert cache.get("older") is None
+
+def test_released_images_become_evictable(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1, pin_seconds=60)
+    path = cache.put("k1", image())
+    cache.acquire(path)
+    cache.acquire(path)
+    age(cache, "k1", 100)
+
+    cache.release(path)
+    assert os.path.exists(path)
+    cache.release(path)
+    assert not os.path.exists(path)
+
+def test_full_and_fully_referenced_cache_keeps_new_images(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1, pin_seconds=60)
+    held = cache.put("held", image())
+    cache.acquire(held)
+    age(cache, "held", 100)
+
+    # A batch whose images are not acquired yet
+    batch = [cache.put(f"k{n}", image()) for n in range(3)]
+
+    assert all(os.path.exists(path) for path in batch)
+    assert os.path.exists(held)
+    assert cache.get("k0") == batch[0]
+
+def test_unacquired_images_are_evicted_after_the_pin(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1, pin_seconds=60)
+    stale = cache.put("stale", image())
+    age(cache, "stale", 100)
+
+    fresh = cache.put("fresh", image())
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+def test_index_is_shared_between_instances(tmp_path):
+    writer = make_cache(tmp_path)
+    path = writer.put("k1", image())
+    writer.acquire(path)
+
+    reader = make_cache(tmp_path)
+
+    assert reader.get("k1") == path
+    assert reader.stats()["referenced"] == 1
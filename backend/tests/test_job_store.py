@@ -0,0 +1,118 @@
+import asyncio
+import json
+from services.job_store import JobStore
+
+FIELDS = ("status", "progress")
+
+def make_store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.db"))
+
+def test_records_survive_a_restart(tmp_path):
+    store = make_store(tmp_path)
+    store.create("done", theme="foxes")
+    store.update("done", status="completed", progress=100)
+
+    reopened = make_store(tmp_path)
+
+    job = reopened.get("done")
+    assert (job["status"], job["progress"], job["theme"]) == ("completed", 100, "foxes")
+    assert reopened.active() == []
+
+def test_interrupted_jobs_fail_or_restore_on_startup(tmp_path):
+    store = make_store(tmp_path)
+    store.create("running")
+    store.update("running", status="processing", progress=40)
+    store.create("regenerating")
+    store.update("regenerating", status="processing",
+                 restore={"status": "completed", "progress": 100, "message": "Regeneration was interrupted."})
+
+    reopened = make_store(tmp_path)
+
+    assert reopened.get("running")["status"] == "failed"
+    assert reopened.get("running")["message"] == "Interrupted by server restart"
+    restored = reopened.get("regenerating")
+    assert (restored["status"], restored["progress"]) == ("completed", 100)
+    assert "restore" not in restored
+
+def test_list_filters_by_status(tmp_path):
+    store = make_store(tmp_path)
+    store.create("a")
+    store.create("b")
+    store.update("b", status="completed")
+
+    assert [job["id"] for job in store.list(status="completed")] == ["b"]
+    assert {job["id"] for job in store.list()} == {"a", "b"}
+
+def test_listeners_see_every_update(tmp_path):
+    store = make_store(tmp_path)
+    seen = []
+    store.add_listener(lambda job: seen.append((job["id"], job["progress"])))
+    store.create("a")
+    store.update("a", progress=10)
+    store.update("a", progress=20)
+
+    assert seen == [("a", 10), ("a", 20)]
+
+def test_snapshot_is_shared_per_version_and_dropped_when_finished(tmp_path):
+    store = make_store(tmp_path)
+    store.create("a")
+
+    first = store.snapshot("a", FIELDS)
+    assert store.snapshot("a", FIELDS) is first
+    store.update("a", progress=50)
+    assert json.loads(store.snapshot("a", FIELDS)) == {"status": "pending", "progress": 50}
+
+    store.update("a", status="completed", progress=100)
+    assert store._payloads == {} and store._versions == {}
+    assert json.loads(store.snapshot("a", FIELDS)) == {"status": "completed", "progress": 100}
+
+def test_subscribe_yields_changes_until_finished(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        store.create("a")
+        received = []
+
+        async def watch():
+            async for payload in store.subscribe("a", FIELDS, keepalive=5):
+                received.append(json.loads(payload))
+
+        watcher = asyncio.create_task(watch())
+        await asyncio.sleep(0.01)
+        store.update("a", message="Not a watched field")
+        store.update("a", progress=50)
+        await asyncio.sleep(0.01)
+        store.update("a", status="completed", progress=100)
+        await asyncio.wait_for(watcher, timeout=1)
+        return received
+
+    assert asyncio.run(scenario()) == [
+        {"status": "pending", "progress": 0},
+        {"status": "pending", "progress": 50},
+        {"status": "completed", "progress": 100}
+    ]
+
+def test_update_during_the_yield_wakes_the_watcher(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        store.create("a")
+        stream = store.subscribe("a", FIELDS, keepalive=5)
+
+        assert json.loads(await stream.__anext__())["status"] == "pending"
+        # The generator is suspended at its yield while the job finishes
+        store.update("a", status="completed", progress=100)
+        payload = await asyncio.wait_for(stream.__anext__(), timeout=1)
+        assert json.loads(payload)["status"] == "completed"
+
+    asyncio.run(scenario())
+
+def test_subscribe_sends_keepalives_and_stops_for_unknown_jobs(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path)
+        store.create("a")
+        stream = store.subscribe("a", FIELDS, keepalive=0.05)
+        await stream.__anext__()
+
+        assert await asyncio.wait_for(stream.__anext__(), timeout=1) is None
+        assert [payload async for payload in store.subscribe("missing", FIELDS)] == []
+
+    asyncio.run(scenario())
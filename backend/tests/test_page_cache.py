@@ -0,0 +1,103 @@
+import os
+import time
+from services.page_cache import PageTextCache, hash_file
+
+def make_cache(tmp_path, **kwargs):
+    return PageTextCache(str(tmp_path / "pages"), **kwargs)
+
+def age(cache, doc_id: str, seconds: float):
+    stamp = time.time() - seconds
+    os.utime(cache._doc_dir(doc_id), (stamp, stamp))
+
+def doc_bytes(cache, doc_id: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(cache._doc_dir(doc_id)))
+
+def test_put_then_get_pages(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_pages("doc", 5, {0: "first", 2: "third"})
+
+    found, missing = cache.get_pages("doc", 0, 4)
+
+    assert found == {0: "first", 2: "third"}
+    assert missing == [1, 3]
+    assert cache.page_count("doc") == 5
+
+def test_pages_are_added_sparsely(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_pages("doc", 3, {0: "first"})
+    # A page already cached is not written again
+    cache.put_pages("doc", 3, {0: "changed", 1: "second"})
+
+    assert cache.get_pages("doc", 0, 3) == ({0: "first", 1: "second"}, [2])
+
+def test_missing_pages_counts_hits_and_misses(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_pages("doc", 4, {1: "a", 2: "b"})
+
+    assert cache.missing_pages("doc", 0, 4) == [0, 3]
+    assert cache.missing_pages("unknown", 0, 2) == [0, 1]
+    assert (cache.hits, cache.misses) == (2, 4)
+
+def test_unknown_document(tmp_path):
+    cache = make_cache(tmp_path)
+
+    assert cache.page_count("unknown") is None
+    assert cache.get_pages("unknown", 2, 4) == ({}, [2, 3])
+
+def test_corrupted_pages_read_as_missing(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_pages("doc", 2, {0: "first", 1: "second"})
+    with open(os.path.join(cache._doc_dir("doc"), "pages.bin"), "r+b") as f:
+        f.write(b"garbage")
+
+    assert cache.get_pages("doc", 0, 2) == ({}, [0, 1])
+
+def test_lost_data_file_reads_as_missing(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_pages("doc", 1, {0: "first"})
+    os.remove(os.path.join(cache._doc_dir("doc"), "pages.bin"))
+
+    assert cache.get_pages("doc", 0, 1) == ({}, [0])
+
+def test_evicts_least_recently_used_documents(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1)
+    cache.put_pages("old", 1, {0: "old text"})
+    age(cache, "old", 200)
+    cache.put_pages("recent", 1, {0: "recent text"})
+
+    # The document just written is kept even though it alone is over the budget
+    assert cache.page_count("old") is None
+    assert cache.get_pages("recent", 0, 1) == ({0: "recent text"}, [])
+
+def test_reads_keep_a_document_from_eviction(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.put_pages("a", 1, {0: "a"})
+    cache.put_pages("b", 1, {0: "b"})
+    age(cache, "a", 200)
+    age(cache, "b", 100)
+    cache.get_pages("a", 0, 1)
+
+    # Room for two of the three documents
+    cache.max_bytes = 3 * doc_bytes(cache, "a") - 1
+    cache.put_pages("c", 1, {0: "c"})
+
+    assert cache.page_count("b") is None
+    assert cache.page_count("a") == 1
+    assert cache.page_count("c") == 1
+
+def test_directory_is_shared_between_instances(tmp_path):
+    writer = make_cache(tmp_path)
+    writer.put_pages("doc", 2, {0: "first"})
+
+    reader = make_cache(tmp_path)
+    reader.put_pages("doc", 2, {1: "second"})
+
+    assert writer.get_pages("doc", 0, 2) == ({0: "first", 1: "second"}, [])
+
+def test_hash_file_is_content_addressed(tmp_path):
+    first = tmp_path / "a.pdf"
+    second = tmp_path / "b.pdf"
+    first.write_bytes(b"same content")
+    second.write_bytes(b"same content")
+
+    assert hash_file(str(first), chunk_size=4) == hash_file(str(second))
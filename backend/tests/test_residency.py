@@ -0,0 +1,64 @@
+import asyncio
+from services.metrics import metrics
+from services.model_lifecycle import ModelLifecycle
+from services.residency import ModelResidency
+
+class InlineExecutor:
+    async def run(self, lane, fn, *args):
+        return fn(*args)
+
+def make_model(name: str, residency, size: int = 60) -> ModelLifecycle:
+    return ModelLifecycle(name, InlineExecutor(), lambda: None, lambda: None, expected_bytes=size, residency=residency)
+
+def sample(name: str, model: str):
+    rendered = metrics.render(only=name)
+    for line in rendered.splitlines():
+        if line.startswith(f'{name}{{model="{model}"}} '):
+            return float(line.split()[-1])
+    return None
+
+async def use(model: ModelLifecycle):
+    async with model.use() as ready:
+        assert ready
+
+def test_swaps_within_the_budget_and_exports_metrics():
+    async def scenario():
+        residency = ModelResidency(budget_bytes=100)
+        llm = make_model("test-llm", residency)
+        image = make_model("test-image", residency)
+        assert sample("icbg_model_resident", "test-llm") == 0
+
+        await use(llm)
+        assert sample("icbg_model_resident", "test-llm") == 1
+        assert sample("icbg_model_resident_bytes", "test-llm") == 60
+        assert sample("icbg_model_loads_total", "test-llm") == 1
+
+        # Both don't fit: the idle LLM is evicted for the image model
+        await use(image)
+        assert (llm.state, image.state) == ("unloaded", "ready")
+        assert sample("icbg_model_resident", "test-llm") == 0
+        assert sample("icbg_model_resident_bytes", "test-llm") == 0
+        assert sample("icbg_model_evictions_total", "test-llm") == 1
+        assert sample("icbg_model_swaps_total", "test-image") == 1
+        assert residency.status()["evictions"] == 1
+
+        # Resident already: no swap
+        await use(image)
+        assert sample("icbg_model_swaps_total", "test-image") == 1
+        assert sample("icbg_model_loads_total", "test-image") == 1
+
+    asyncio.run(scenario())
+
+def test_models_that_fit_together_are_not_evicted():
+    async def scenario():
+        residency = ModelResidency(budget_bytes=200)
+        first = make_model("test-fit-a", residency)
+        second = make_model("test-fit-b", residency)
+        await use(first)
+        await use(second)
+
+        assert first.is_resident and second.is_resident
+        assert sample("icbg_model_evictions_total", "test-fit-a") is None
+        assert residency.resident_bytes() == 120
+
+    asyncio.run(scenario())
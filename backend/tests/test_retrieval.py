@@ -0,0 +1,83 @@
+from services.retrieval import BM25Index, IndexCache, chunk_pages, join_chunks, tokenize
+
+PAGES = [
+    (1, "The village sat at the foot of the mountain.\nFarmers grew wheat and barley."),
+    (2, "A dragon lived in a cave above the village.\nThe dragon hoarded gold and slept for years."),
+    (3, "Children played by the river.\nThe river ran past the mill and the bakery."),
+]
+
+def test_tokenize_drops_stopwords_and_single_letters():
+    assert tokenize("The Dragon and a cave, x 42") == ["dragon", "cave", "42"]
+
+def test_chunks_are_built_from_whole_lines_and_never_span_pages():
+    chunks = chunk_pages(PAGES, target_chars=50)
+
+    assert [(c["index"], c["page"]) for c in chunks] == [(0, 1), (1, 1), (2, 2), (3, 2), (4, 3), (5, 3)]
+    assert chunks[2]["text"] == "A dragon lived in a cave above the village."
+
+def test_small_pages_stay_one_chunk_each():
+    chunks = chunk_pages(PAGES)
+
+    assert len(chunks) == 3
+    assert chunks[0]["text"] == "The village sat at the foot of the mountain. Farmers grew wheat and barley."
+
+def test_scores_rank_the_matching_chunk_first():
+    index = BM25Index(chunk_pages(PAGES))
+    scores = index.scores("the dragon's gold")
+
+    assert scores[1] > 0
+    assert scores[0] == scores[2] == 0
+
+def test_rarer_terms_weigh_more():
+    index = BM25Index(chunk_pages(PAGES))
+
+    # "village" is on two pages, "river" on one
+    assert index.scores("river")[2] > index.scores("village")[0]
+
+def test_select_keeps_document_order_within_the_budget():
+    chunks = chunk_pages(PAGES, target_chars=50)
+    index = BM25Index(chunks)
+
+    selected = index.select("river dragon", char_budget=200)
+
+    assert [c["index"] for c in selected] == sorted(c["index"] for c in selected)
+    assert {c["page"] for c in selected} == {2, 3}
+    assert sum(len(c["text"]) + 2 for c in selected) <= 200
+
+def test_select_falls_back_to_leading_chunks():
+    index = BM25Index(chunk_pages(PAGES))
+
+    assert [c["index"] for c in index.select("", char_budget=200)] == [0, 1]
+    assert [c["index"] for c in index.select("spaceship", char_budget=200)] == [0, 1]
+
+def test_select_truncates_a_chunk_larger_than_the_budget():
+    index = BM25Index(chunk_pages(PAGES))
+
+    selected = index.select("dragon", char_budget=20)
+
+    assert selected == [dict(index.chunks[1], text=index.chunks[1]["text"][:20])]
+
+def test_join_chunks_marks_gaps():
+    chunks = chunk_pages(PAGES)
+
+    assert join_chunks([chunks[0], chunks[1]]) == f"{chunks[0]['text']}\n\n{chunks[1]['text']}"
+    assert join_chunks([chunks[0], chunks[2]]) == f"{chunks[0]['text']}\n\n...\n\n{chunks[2]['text']}"
+
+def test_index_cache_reuses_and_evicts():
+    cache = IndexCache(max_entries=2)
+    built = []
+
+    def build(name):
+        def make():
+            built.append(name)
+            return BM25Index(chunk_pages(PAGES))
+        return make
+
+    first = cache.get_or_build(("a", 1, 3), build("a"))
+    assert cache.get_or_build(("a", 1, 3), build("a")) is first
+    cache.get_or_build(("b", 1, 3), build("b"))
+    cache.get_or_build(("c", 1, 3), build("c"))
+    cache.get_or_build(("a", 1, 3), build("a"))
+
+    assert built == ["a", "b", "c", "a"]
+    assert (cache.hits, cache.misses) == (1, 4)
@@ -0,0 +1,124 @@
+import asyncio
+import pytest
+from services.scheduler import JobScheduler, QueueFullError
+
+def make_scheduler(**kwargs):
+    kwargs.setdefault("max_active", 1)
+    kwargs.setdefault("max_queued", 10)
+    return JobScheduler(stage_limits={"llm": 1}, **kwargs)
+
+def recorder(order: list, gate: asyncio.Event = None):
+    def run_for(job_id):
+        def run(cancel_event):
+            async def job():
+                order.append(job_id)
+                if gate is not None:
+                    await gate.wait()
+            return job()
+        return run
+    return run_for
+
+async def drain(scheduler):
+    while scheduler.running_count or scheduler.queued_count:
+        await asyncio.sleep(0.01)
+
+def test_runs_by_priority_then_fifo():
+    async def scenario():
+        order = []
+        gate = asyncio.Event()
+        run = recorder(order, gate)
+        scheduler = make_scheduler()
+        scheduler.submit("first", run("first"))
+        scheduler.submit("low", run("low"), priority="low")
+        scheduler.submit("normal-1", run("normal-1"))
+        scheduler.submit("high", run("high"), priority="high")
+        scheduler.submit("normal-2", run("normal-2"))
+
+        assert [scheduler.position(j) for j in ("high", "normal-1", "normal-2", "low")] == [1, 2, 3, 4]
+        assert scheduler.position("first") is None
+        gate.set()
+        await drain(scheduler)
+        return order
+
+    assert asyncio.run(scenario()) == ["first", "high", "normal-1", "normal-2", "low"]
+
+def test_limits_running_jobs():
+    async def scenario():
+        order = []
+        gate = asyncio.Event()
+        run = recorder(order, gate)
+        scheduler = make_scheduler(max_active=2)
+        for job_id in ("a", "b", "c"):
+            scheduler.submit(job_id, run(job_id))
+        await asyncio.sleep(0.01)
+
+        assert order == ["a", "b"]
+        assert (scheduler.running_count, scheduler.queued_count) == (2, 1)
+        assert scheduler.queue_wait("a") is not None
+        gate.set()
+        await drain(scheduler)
+        assert order == ["a", "b", "c"]
+
+    asyncio.run(scenario())
+
+def test_rejects_when_the_queue_is_full():
+    async def scenario():
+        gate = asyncio.Event()
+        run = recorder([], gate)
+        scheduler = make_scheduler(max_queued=1)
+        scheduler.submit("running", run("running"))
+        scheduler.submit("queued", run("queued"))
+
+        with pytest.raises(QueueFullError) as error:
+            scheduler.submit("rejected", run("rejected"))
+        assert error.value.retry_after >= 5
+        gate.set()
+        await drain(scheduler)
+
+    asyncio.run(scenario())
+
+def test_cancel_queued_job_never_runs():
+    async def scenario():
+        order = []
+        gate = asyncio.Event()
+        run = recorder(order, gate)
+        scheduler = make_scheduler()
+        scheduler.submit("a", run("a"))
+        scheduler.submit("b", run("b"))
+        scheduler.submit("c", run("c"))
+
+        assert scheduler.cancel("b") == "queued"
+        assert scheduler.position("b") is None
+        assert scheduler.position("c") == 1
+        gate.set()
+        await drain(scheduler)
+        return order
+
+    assert asyncio.run(scenario()) == ["a", "c"]
+
+def test_cancel_running_job_sets_its_event_and_starts_the_next():
+    async def scenario():
+        seen = {}
+        started = asyncio.Event()
+        scheduler = make_scheduler()
+
+        def running(cancel_event):
+            async def job():
+                seen["event"] = cancel_event
+                started.set()
+                await asyncio.sleep(60)
+            return job()
+
+        order = []
+        scheduler.submit("a", running)
+        scheduler.submit("b", recorder(order)("b"))
+        await started.wait()
+
+        assert scheduler.cancel("a") == "running"
+        await scheduler.wait("a", timeout=1)
+        await drain(scheduler)
+        assert seen["event"].is_set()
+        assert order == ["b"]
+        assert scheduler.cancel("a") is None
+
+    asyncio.run(scenario())
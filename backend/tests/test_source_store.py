@@ -0,0 +1,98 @@
+import asyncio
+import io
+import os
+import sqlite3
+import pytest
+from services.source_store import SourceStore, UploadTooLarge
+
+def make_store(tmp_path, **kwargs):
+    return SourceStore(str(tmp_path / "sources"), **kwargs)
+
+def save(store, name: str, content: bytes = b"%PDF-1.4 content"):
+    return asyncio.run(store.save(io.BytesIO(content), name))
+
+def test_identical_uploads_share_one_blob(tmp_path):
+    store = make_store(tmp_path)
+    first = save(store, "a.pdf")
+    second = save(store, "b.pdf")
+
+    assert not first["deduplicated"] and second["deduplicated"]
+    assert first["digest"] == second["digest"]
+    assert first["path"] == second["path"] == store.resolve("a.pdf") == store.resolve("b.pdf")
+    assert len(list(store.blobs())) == 1
+    assert store.dedup_hits == 1
+
+def test_names_are_cleaned(tmp_path):
+    store = make_store(tmp_path)
+    source = save(store, "../../etc/book.pdf")
+
+    assert source["name"] == "book.pdf"
+    assert store.resolve("book.pdf") == source["path"]
+    assert os.path.dirname(source["path"]) == store.blob_dir
+
+def test_oversized_upload_is_refused_and_cleaned_up(tmp_path):
+    store = make_store(tmp_path, max_bytes=10)
+
+    with pytest.raises(UploadTooLarge):
+        save(store, "big.pdf", b"x" * 11)
+
+    assert store.resolve("big.pdf") is None
+    assert os.listdir(store.blob_dir) == []
+
+def test_reuploading_a_name_keeps_the_previous_blob(tmp_path):
+    store = make_store(tmp_path)
+    old = save(store, "book.pdf", b"first version")
+    new = save(store, "book.pdf", b"second version")
+
+    assert store.resolve("book.pdf") == new["path"]
+    assert store.digest("book.pdf") == new["digest"]
+    # Jobs started from the first version still read it by hash
+    assert os.path.exists(old["path"])
+    assert store.digests() == {new["digest"]}
+
+def test_shared_blob_is_removed_with_its_last_name(tmp_path):
+    store = make_store(tmp_path)
+    source = save(store, "a.pdf")
+    save(store, "b.pdf")
+
+    assert store.remove("a.pdf") == 0
+    assert os.path.exists(source["path"])
+    assert store.remove("b.pdf") == source["bytes"]
+    assert not os.path.exists(source["path"])
+    assert store.remove("b.pdf") is None
+
+def test_touch_records_last_use(tmp_path):
+    store = make_store(tmp_path)
+    save(store, "a.pdf")
+    store._conn.execute("UPDATE sources SET created_at = 100, last_used = 100")
+
+    store.touch("a.pdf")
+
+    entry, = store.entries()
+    assert entry["created_at"] == 100
+    assert entry["last_used"] > 100
+
+def test_legacy_files_resolve_by_name(tmp_path):
+    store = make_store(tmp_path)
+    legacy = tmp_path / "sources" / "old.pdf"
+    legacy.write_bytes(b"saved before the blob store")
+
+    assert store.resolve("old.pdf") == str(legacy)
+    assert store.remove("old.pdf") == len(b"saved before the blob store")
+    assert not legacy.exists()
+
+def test_index_without_last_used_is_migrated(tmp_path):
+    root = tmp_path / "sources"
+    root.mkdir()
+    conn = sqlite3.connect(str(root / "index.db"))
+    conn.execute("CREATE TABLE sources (name TEXT PRIMARY KEY, digest TEXT NOT NULL, ext TEXT NOT NULL, "
+                 "bytes INTEGER NOT NULL, created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO sources VALUES ('a.pdf', 'abc', '.pdf', 3, 100)")
+    conn.commit()
+    conn.close()
+
+    store = SourceStore(str(root))
+
+    assert store.entries() == [{"name": "a.pdf", "digest": "abc", "bytes": 3, "created_at": 100, "last_used": 100}]
+    store.touch("a.pdf")
+    assert store.entries()[0]["last_used"] > 100
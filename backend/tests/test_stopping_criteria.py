@@ -0,0 +1,89 @@
+import threading
+import torch
+from services.llm import StoryStoppingCriteria
+from services.story_parser import PAGE_BREAK
+
+PROMPT = [0, 0, 0]
+
+class PieceTokenizer:
+    """
+    Token id i decodes to pieces[i]; id 0 is the prompt filler.
+    """
+    def __init__(self):
+        self.pieces = [""]
+
+    def encode(self, text_pieces: list) -> list:
+        ids = []
+        for piece in text_pieces:
+            if piece not in self.pieces:
+                self.pieces.append(piece)
+            ids.append(self.pieces.index(piece))
+        return ids
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(self.pieces[i] for i in ids)
+
+def generate(pieces: list, **kwargs):
+    """
+    Feed pieces one token at a time. Returns (criteria, tokens generated when it stopped or None).
+    """
+    tokenizer = PieceTokenizer()
+    ids = tokenizer.encode(pieces)
+    criteria = StoryStoppingCriteria(tokenizer, len(PROMPT), **kwargs)
+    for step in range(1, len(ids) + 1):
+        stop = criteria(torch.tensor([PROMPT + ids[:step]]), None)
+        if stop[0]:
+            return criteria, step
+    return criteria, None
+
+def page(n: int) -> list:
+    return [f"Text: Page {n}.\n", f"Image: Picture {n}.", "\n"]
+
+def test_keeps_going_on_a_normal_story():
+    criteria, stopped = generate(["TITLE: Fox\n"] + page(1) + [PAGE_BREAK] + page(2))
+
+    assert stopped is None
+    assert criteria.reason is None
+
+def test_stops_once_the_last_page_is_written():
+    pieces = ["TITLE: Fox\n"]
+    for n in range(1, 3):
+        pieces += page(n) + [PAGE_BREAK]
+    pieces += page(3) + ["Text: extra"]
+
+    criteria, stopped = generate(pieces, max_pages=3)
+
+    assert criteria.reason == "max_pages"
+    # Right after the newline closing page 3's image line
+    assert stopped == len(pieces) - 1
+
+def test_stops_at_end_of_turn():
+    criteria, stopped = generate(["TITLE: Fox\n"] + page(1) + ["<|im_end|>", "more"])
+
+    assert criteria.reason == "end_of_turn"
+    assert stopped == 5
+
+def test_stops_at_a_second_story():
+    pieces = ["TITLE: Fox\n"] + page(1) + [PAGE_BREAK, "TITLE: Another Fox\n"] + page(1)
+
+    criteria, stopped = generate(pieces)
+
+    assert criteria.reason == "second_story"
+    assert stopped == 6
+
+def test_stops_on_repetition():
+    criteria, stopped = generate(["TITLE: Fox\n"] + ["la ", "di ", "da "] * 30, min_repeat_span=12)
+
+    assert criteria.reason == "repetition"
+    assert stopped == 1 + 12
+
+def test_stops_when_cancelled():
+    cancel_event = threading.Event()
+    tokenizer = PieceTokenizer()
+    ids = tokenizer.encode(["TITLE: Fox\n"] + page(1))
+    criteria = StoryStoppingCriteria(tokenizer, len(PROMPT), cancel_event=cancel_event)
+
+    assert not criteria(torch.tensor([PROMPT + ids[:2]]), None)[0]
+    cancel_event.set()
+    assert criteria(torch.tensor([PROMPT + ids[:3]]), None)[0]
+    assert criteria.reason == "cancelled"
@@ -0,0 +1,171 @@
+import io
+import json
+import os
+import time
+import pytest
+from services.source_store import SourceStore
+from services.storage import StorageManager
+
+@pytest.fixture
+def dirs(tmp_path):
+    paths = {name: tmp_path / name for name in ("books", "images", "sources")}
+    for path in paths.values():
+        path.mkdir()
+    return {name: str(path) for name, path in paths.items()}
+
+def make_storage(dirs, tmp_path, removed=None, **kwargs):
+    source_store = SourceStore(dirs["sources"])
+    removed = removed if removed is not None else []
+
+    def remove_book(job_id):
+        removed.append(job_id)
+        os.remove(os.path.join(dirs["books"], f"manifest_{job_id}.json"))
+
+    kwargs.setdefault("ttls", {})
+    kwargs.setdefault("orphan_grace", 3600)
+    return StorageManager(source_store, remove_book, db_path=str(tmp_path / "storage.db"),
+                          books_dir=dirs["books"], images_dir=dirs["images"], **kwargs)
+
+def write_file(path: str, size: int = 10, age: float = 0):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    if age:
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+    return path
+
+def add_book(storage, dirs, job_id: str, images: list = ()):
+    parts = os.path.join(dirs["books"], f"parts_{job_id}")
+    os.makedirs(parts, exist_ok=True)
+    manifest = {"pdf_path": write_file(os.path.join(dirs["books"], f"book_{job_id}.pdf"), 100), "images": list(images), "parts_dir": parts}
+    manifest_path = os.path.join(dirs["books"], f"manifest_{job_id}.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    storage.record_book(job_id, manifest_path, manifest)
+    return manifest
+
+def upload(storage, name: str, content: bytes) -> dict:
+    return storage.source_store._save(io.BytesIO(content), name)
+
+def test_ttl_removes_unused_books_but_not_active_ones(dirs, tmp_path):
+    removed = []
+    storage = make_storage(dirs, tmp_path, removed, ttls={dirs["books"]: 0.05})
+    add_book(storage, dirs, "old")
+    add_book(storage, dirs, "running")
+    time.sleep(0.1)
+
+    report = storage.sweep([{"id": "running", "created_at": time.time()}])
+
+    assert removed == ["old"]
+    assert report["removed"]["books"] == 1
+    assert storage.status()["books"] == 1
+
+def test_download_keeps_a_book_from_expiring(dirs, tmp_path):
+    removed = []
+    storage = make_storage(dirs, tmp_path, removed, ttls={dirs["books"]: 0.2})
+    add_book(storage, dirs, "read")
+    time.sleep(0.15)
+    storage.touch("read")
+    time.sleep(0.1)
+
+    storage.sweep([])
+
+    assert removed == []
+
+def test_source_ttl_follows_last_use_not_upload_time(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, ttls={dirs["sources"]: 0.2})
+    upload(storage, "kept.pdf", b"kept")
+    upload(storage, "stale.pdf", b"stale")
+    time.sleep(0.15)
+    storage.source_store.touch("kept.pdf")
+    time.sleep(0.1)
+
+    storage.sweep([])
+
+    assert storage.source_store.resolve("kept.pdf") is not None
+    assert storage.source_store.resolve("stale.pdf") is None
+
+def test_quota_counts_a_shared_document_once(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, quota_bytes=1000)
+    # Three names, one 600-byte document: under the quota
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        upload(storage, name, b"y" * 600)
+
+    report = storage.sweep([])
+
+    assert report["by_reason"]["quota"] == 0
+    assert storage.source_store.resolve("a.pdf") is not None
+
+def test_quota_evicts_least_recently_used_document_with_all_its_names(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, quota_bytes=1000)
+    upload(storage, "old-1.pdf", b"o" * 600)
+    upload(storage, "old-2.pdf", b"o" * 600)
+    upload(storage, "new.pdf", b"n" * 600)
+
+    report = storage.sweep([])
+
+    assert report["by_reason"]["quota"] == 600
+    assert storage.source_store.resolve("old-1.pdf") is None
+    assert storage.source_store.resolve("old-2.pdf") is None
+    assert storage.source_store.resolve("new.pdf") is not None
+
+def test_quota_skips_documents_of_active_jobs(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, quota_bytes=100)
+    source = upload(storage, "busy.pdf", b"b" * 600)
+
+    storage.sweep([{"id": "job", "source_digest": source["digest"], "created_at": time.time()}])
+
+    assert storage.source_store.resolve("busy.pdf") is not None
+
+def test_orphan_images_wait_for_grace_and_active_jobs(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, orphan_grace=60)
+    referenced = write_file(os.path.join(dirs["images"], "referenced.png"), age=3600)
+    add_book(storage, dirs, "done", images=[referenced])
+    stale = write_file(os.path.join(dirs["images"], "stale.png"), age=3600)
+    young = write_file(os.path.join(dirs["images"], "young.png"))
+    # Older than the grace period, but made after a job that is still running started
+    in_flight = write_file(os.path.join(dirs["images"], "in_flight.png"), age=120)
+
+    storage.sweep([{"id": "running", "created_at": time.time() - 600}])
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(referenced)
+    assert os.path.exists(young)
+    assert os.path.exists(in_flight)
+
+    storage.sweep([])
+    assert not os.path.exists(in_flight)
+
+def test_orphan_parts_and_left_over_drafts(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, orphan_grace=60)
+    manifest = add_book(storage, dirs, "done")
+    draft = write_file(os.path.join(manifest["parts_dir"], "draft_1.pdf"), age=3600)
+    fresh_draft = write_file(os.path.join(manifest["parts_dir"], "draft_2.pdf"))
+    failed_parts = os.path.join(dirs["books"], "parts_failed")
+    os.makedirs(failed_parts)
+    write_file(os.path.join(failed_parts, "page_01.pdf"), age=3600)
+    os.utime(failed_parts, (time.time() - 3600, time.time() - 3600))
+    running_parts = os.path.join(dirs["books"], "parts_running")
+    os.makedirs(running_parts)
+    os.utime(running_parts, (time.time() - 3600, time.time() - 3600))
+
+    storage.sweep([{"id": "running", "created_at": time.time() - 3600}])
+
+    assert not os.path.exists(draft)
+    assert os.path.exists(fresh_draft)
+    assert not os.path.exists(failed_parts)
+    assert os.path.exists(running_parts)
+    assert os.path.exists(manifest["pdf_path"])
+
+def test_unnamed_blobs_are_orphans(dirs, tmp_path):
+    storage = make_storage(dirs, tmp_path, orphan_grace=0)
+    source = upload(storage, "gone.pdf", b"g" * 50)
+    # Forget the name but leave the blob, as an interrupted delete would
+    with storage.source_store._lock:
+        storage.source_store._conn.execute("DELETE FROM sources")
+    time.sleep(0.01)
+
+    report = storage.sweep([])
+
+    assert not os.path.exists(source["path"])
+    assert report["by_reason"]["orphan"] == 50
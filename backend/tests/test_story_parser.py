@@ -0,0 +1,76 @@
+from services.story_parser import PAGE_BREAK, StoryStreamParser, parse_story, parse_title
+
+def page(n: int) -> str:
+    return f"Text: Page {n} text.\nImage: Picture {n}.\n"
+
+def story(count: int, title: str = "The Brave Fox") -> str:
+    return f"TITLE: {title}\n" + PAGE_BREAK.join(page(n) for n in range(1, count + 1))
+
+def test_parse_title_strips_the_title_line():
+    title, rest = parse_title('TITLE: "The Brave Fox"\nText: Once.', "foxes")
+
+    assert title == "The Brave Fox"
+    assert rest == "Text: Once."
+
+def test_parse_title_falls_back_to_the_theme():
+    title, rest = parse_title("Here is your story about foxes:\nText: Once.", "foxes")
+
+    assert title == "The Story of foxes"
+    assert rest.startswith("Here is")
+
+def test_parse_story_reads_pages():
+    result = parse_story(story(3), "foxes")
+
+    assert result["title"] == "The Brave Fox"
+    assert result["pages"] == [{"text": f"Page {n} text.", "image_prompt": f"Picture {n}."} for n in (1, 2, 3)]
+
+def test_parse_story_caps_pages():
+    assert len(parse_story(story(12), "foxes", max_pages=10)["pages"]) == 10
+
+def test_stream_emits_pages_as_breaks_arrive():
+    parser = StoryStreamParser("foxes")
+    text = story(4)
+    emitted = []
+    for i in range(0, len(text), 7):
+        emitted.extend(parser.feed(text[i:i + 7]))
+
+    # The last section has no closing break yet
+    assert [p["text"] for p in emitted] == ["Page 1 text.", "Page 2 text.", "Page 3 text."]
+    assert parser.finish()["pages"] == parse_story(text, "foxes")["pages"]
+
+def test_stream_holds_back_the_first_page_until_a_second_is_complete():
+    parser = StoryStreamParser("foxes")
+
+    assert parser.feed("TITLE: The Brave Fox\n" + page(1) + PAGE_BREAK) == []
+    assert [p["text"] for p in parser.feed(page(2) + PAGE_BREAK)] == ["Page 1 text.", "Page 2 text."]
+    assert [p["text"] for p in parser.feed(page(3) + PAGE_BREAK)] == ["Page 3 text."]
+
+def test_stream_never_emits_a_page_that_smart_split_replaces():
+    long_text = " ".join(f"Sentence number {n} is about a fox." for n in range(30))
+    parser = StoryStreamParser("foxes")
+
+    emitted = parser.feed(f"TITLE: The Brave Fox\nText: {long_text}\n{PAGE_BREAK}")
+    result = parser.finish()
+
+    assert emitted == []
+    assert len(result["pages"]) == 10
+    assert result["pages"][0]["text"].startswith("Sentence number 0")
+
+def test_unformatted_response_is_smart_split():
+    sentences = [f"The little fox went looking for shiny thing number {n}." for n in range(12)]
+    result = parse_story("Here is the story.\n" + " ".join(sentences), "foxes")
+
+    assert result["title"] == "The Story of foxes"
+    assert [p["text"] for p in result["pages"]] == [
+        "Here is the story. " + " ".join(sentences[:2]),
+        *(" ".join(sentences[i:i + 3]) for i in (2, 5, 8)),
+        sentences[11]
+    ]
+    assert all(p["image_prompt"].endswith("theme: foxes") for p in result["pages"])
+
+def test_stream_stops_at_max_pages():
+    parser = StoryStreamParser("foxes", max_pages=2)
+    emitted = parser.feed(story(4) + PAGE_BREAK)
+
+    assert parser.complete
+    assert len(emitted) == 2
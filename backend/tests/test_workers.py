@@ -0,0 +1,139 @@
+import asyncio
+import json
+import time
+from services.job_store import JobStore
+from services.scheduler import JobScheduler
+from services.workers import WorkerRegistry
+
+def make_worker(tmp_path, host: str) -> WorkerRegistry:
+    """
+    A registry that looks like a worker on another host, so several can run in one test process.
+    """
+    worker = WorkerRegistry(str(tmp_path / "jobs.db"), heartbeat_seconds=1)
+    worker._conn.execute("UPDATE workers SET host = ? WHERE id = ?", (host, worker.worker_id))
+    worker.host = host
+    return worker
+
+def stop(worker: WorkerRegistry):
+    # A worker that died without unregistering: its heartbeat just gets old
+    worker._conn.execute("UPDATE workers SET heartbeat = ? WHERE id = ?", (time.time() - 60, worker.worker_id))
+
+def test_liveness_and_leadership(tmp_path):
+    a = make_worker(tmp_path, "host-a")
+    b = make_worker(tmp_path, "host-b")
+
+    assert a.live() == b.live() == {a.worker_id, b.worker_id}
+    assert a.is_leader() and not b.is_leader()
+
+    stop(a)
+    assert b.live() == {b.worker_id}
+    assert b.is_leader()
+
+def test_unregister_leaves_at_once(tmp_path):
+    a = make_worker(tmp_path, "host-a")
+    b = make_worker(tmp_path, "host-b")
+    a.unregister()
+
+    assert b.live() == {b.worker_id}
+
+def test_slots_are_shared_and_freed_by_gone_workers(tmp_path):
+    a = make_worker(tmp_path, "host-a")
+    b = make_worker(tmp_path, "host-b")
+
+    assert a.acquire_slot("job-1", limit=2)
+    assert b.acquire_slot("job-2", limit=2)
+    assert not b.acquire_slot("job-3", limit=2)
+    assert a.is_running("job-1")
+
+    a.release_slot("job-1")
+    assert not a.is_running("job-1")
+    assert b.acquire_slot("job-3", limit=2)
+
+    stop(b)
+    assert a.acquire_slot("job-4", limit=2)
+    assert not a.is_running("job-2")
+
+def test_cancel_requests_go_to_the_worker_that_has_the_job(tmp_path):
+    a = make_worker(tmp_path, "host-a")
+    b = make_worker(tmp_path, "host-b")
+    b.request_cancel("job-1")
+
+    assert b.take_cancel_requests({"job-2"}) == []
+    assert a.take_cancel_requests({"job-1"}) == ["job-1"]
+    assert a.take_cancel_requests({"job-1"}) == []
+
+def test_recovery_only_touches_jobs_of_gone_workers(tmp_path):
+    a = make_worker(tmp_path, "host-a")
+    b = make_worker(tmp_path, "host-b")
+    store_a = JobStore(str(tmp_path / "jobs.db"), workers=a)
+    store_b = JobStore(str(tmp_path / "jobs.db"), workers=b)
+    store_a.create("on-a")
+    store_a.update("on-a", status="processing")
+    store_b.create("on-b")
+    store_b.update("on-b", status="processing",
+                   restore={"status": "completed", "progress": 100, "message": "Regeneration was interrupted."})
+
+    assert store_a.recover() == 0
+    stop(b)
+    assert store_a.recover() == 1
+
+    assert store_a.get("on-a")["status"] == "processing"
+    assert store_a.get("on-b")["status"] == "completed"
+    assert [job["id"] for job in store_a.unfinished()] == ["on-a"]
+
+def test_scheduler_limit_holds_across_workers(tmp_path):
+    async def scenario():
+        a = make_worker(tmp_path, "host-a")
+        b = make_worker(tmp_path, "host-b")
+        scheduler_a = JobScheduler(max_active=1, slots=a)
+        scheduler_b = JobScheduler(max_active=1, slots=b)
+        gate = asyncio.Event()
+        started = []
+
+        def run(job_id):
+            async def job(cancel_event):
+                started.append(job_id)
+                await gate.wait()
+            return job
+
+        scheduler_a.submit("a-1", run("a-1"))
+        scheduler_b.submit("b-1", run("b-1"))
+        await asyncio.sleep(0.01)
+        assert started == ["a-1"]
+        assert scheduler_b.position("b-1") == 1
+
+        gate.set()
+        await scheduler_a.wait("a-1", timeout=1)
+        # Worker b notices the freed slot on its next dispatch
+        scheduler_b.dispatch()
+        await scheduler_b.wait("b-1", timeout=1)
+        return started
+
+    assert asyncio.run(scenario()) == ["a-1", "b-1"]
+
+def test_watchers_on_another_worker_see_updates(tmp_path):
+    async def scenario():
+        a = make_worker(tmp_path, "host-a")
+        b = make_worker(tmp_path, "host-b")
+        runner = JobStore(str(tmp_path / "jobs.db"), workers=a)
+        watcher = JobStore(str(tmp_path / "jobs.db"), workers=b, poll_seconds=0.05)
+        runner.create("job")
+        received = []
+
+        async def watch():
+            async for payload in watcher.subscribe("job", ("status", "progress"), keepalive=5):
+                received.append(json.loads(payload))
+
+        task = asyncio.create_task(watch())
+        await asyncio.sleep(0.1)
+        runner.update("job", status="processing", progress=50)
+        await asyncio.sleep(0.1)
+        runner.update("job", status="completed", progress=100)
+        await asyncio.wait_for(task, timeout=1)
+        return received
+
+    assert asyncio.run(scenario()) == [
+        {"status": "pending", "progress": 0},
+        {"status": "processing", "progress": 50},
+        {"status": "completed", "progress": 100}
+    ]
@@ -193,6 +193,9 @@ export default function Home() {
           eventSource.close();
           setIsGenerating(false);
           alert(`Generation failed: ${eventData.message}`);
+        } else if (eventData.status === 'cancelled' || eventData.status === 'deleted') {
+          eventSource.close();
+          setIsGenerating(false);
         }
       };
 